@@ -3,7 +3,7 @@ from .models import Client, ClientSetting
 
 @admin.register(Client)
 class ClientAdmin(admin.ModelAdmin):
-    list_display = ('name', 'bigquery_dataset_id', 'is_active', 'created_at', 'created_by', 'updated_at', 'updated_by')
+    list_display = ('name', 'bigquery_dataset_id', 'is_active', 'daily_bytes_budget', 'monthly_bytes_budget', 'created_at', 'created_by', 'updated_at', 'updated_by')
     search_fields = ('name', 'bigquery_dataset_id')
     list_filter = ('is_active', 'created_at', 'updated_at')
     readonly_fields = ('bigquery_dataset_id', 'created_at', 'updated_at', 'created_by', 'updated_by')
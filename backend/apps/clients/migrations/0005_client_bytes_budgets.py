@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-17 03:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0004_remove_client_facebook_oauth_status_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='client',
+            name='daily_bytes_budget',
+            field=models.BigIntegerField(blank=True, help_text='Max BigQuery bytes billed per day (empty = unlimited)', null=True),
+        ),
+        migrations.AddField(
+            model_name='client',
+            name='monthly_bytes_budget',
+            field=models.BigIntegerField(blank=True, help_text='Max BigQuery bytes billed per month (empty = unlimited)', null=True),
+        ),
+    ]
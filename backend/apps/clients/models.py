@@ -14,6 +14,11 @@ class Client(models.Model):
     name = models.CharField(max_length=100, unique=True)
     bigquery_dataset_id = models.CharField(max_length=100, unique=True, blank=True, null=True, editable=False)
     is_active = models.BooleanField(default=True)
+    # BigQuery 查詢的 bytes billed 預算 (null 表示不限制)，以 TIME_ZONE 的日/月計算
+    daily_bytes_budget = models.BigIntegerField(null=True, blank=True,
+                                                help_text="Max BigQuery bytes billed per day (empty = unlimited)")
+    monthly_bytes_budget = models.BigIntegerField(null=True, blank=True,
+                                                  help_text="Max BigQuery bytes billed per month (empty = unlimited)")
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     created_by = models.ForeignKey(
@@ -16,8 +16,11 @@ class ClientSerializer(serializers.ModelSerializer):
             'name',
             'is_active',
             'bigquery_dataset_id',
+            'daily_bytes_budget',
+            'monthly_bytes_budget',
             'created_at',
             'created_by' # DRF 會自動處理關聯欄位和 datetime
         ]
         # 如果有不希望使用者能透過 API 修改的欄位，可以放在 read_only_fields
-        read_only_fields = ['bigquery_dataset_id', 'created_at', 'created_by']
\ No newline at end of file
+        # bytes 預算由管理員在 admin 設定，API 只提供讀取
+        read_only_fields = ['bigquery_dataset_id', 'daily_bytes_budget', 'monthly_bytes_budget', 'created_at', 'created_by']
\ No newline at end of file
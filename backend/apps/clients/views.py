@@ -6,6 +6,8 @@ from rest_framework_simplejwt.authentication import JWTAuthentication
 from apps.clients.models import Client, ClientSetting
 import re
 from rest_framework.response import Response
+from rest_framework.decorators import action
+from apps.queries.services.budget_services import get_budget_usage
 class ClientViewSet(viewsets.ModelViewSet):
 
     serializer_class = ClientSerializer
@@ -79,6 +81,12 @@ class ClientViewSet(viewsets.ModelViewSet):
 
         return Response(serializer.data, status=status.HTTP_201_CREATED) 
 
+    @action(detail=True, methods=["get"], url_path="bytes-usage")
+    def bytes_usage(self, request, pk=None):
+        """回傳 client 今日與本月的 BigQuery bytes billed 用量與預算。"""
+        client = self.get_object()
+        return Response({"client_id": str(client.id), **get_budget_usage(client)})
+
 # @ensure_csrf_cookie
 # def get_csrf_token(request):
 #     """
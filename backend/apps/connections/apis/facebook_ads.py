@@ -1,23 +1,200 @@
 # apps/connections/apis/facebook_ads.py
 from facebook_business.api import FacebookAdsApi
 from facebook_business.adobjects.adaccount import AdAccount
+from facebook_business.adobjects.adreportrun import AdReportRun
 from facebook_business.adobjects.adsinsights import AdsInsights # Make sure AdsInsights is imported
 from facebook_business.adobjects.user import User # Add this import
 from facebook_business.exceptions import FacebookRequestError
 import logging
+import random
+import threading
 import time
 import datetime
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import itertools
+import tempfile
 from django.conf import settings
 import os
 import json
+import uuid
 from django.urls import reverse
+import requests
 
 from google.cloud import bigquery
 from google.api_core.exceptions import GoogleAPICallError, NotFound
 
+from .rate_limiter import RateLimiter
+
 
 logger = logging.getLogger(__name__)
 
+# AdReportRun 的 async_status
+REPORT_STATUS_COMPLETED = "Job Completed"
+REPORT_STATUS_FAILED = ("Job Failed", "Job Skipped")
+
+# 估算報表大小用：date_preset 大約涵蓋的天數 (未列出的視為 30 天)
+DATE_PRESET_DAYS = {
+    "today": 1,
+    "yesterday": 1,
+    "last_3d": 3,
+    "last_7d": 7,
+    "last_14d": 14,
+    "last_28d": 28,
+    "last_30d": 30,
+    "last_90d": 90,
+    "this_week_mon_today": 7,
+    "this_week_sun_today": 7,
+    "last_week_mon_sun": 7,
+    "last_week_sun_sat": 7,
+    "this_month": 31,
+    "last_month": 31,
+    "this_quarter": 92,
+    "last_quarter": 92,
+    "this_year": 366,
+    "last_year": 366,
+    "maximum": 37 * 31,  # Insights 最多保留 37 個月
+    "data_maximum": 37 * 31,
+}
+# 每個層級每天大約的列數 (粗估，只用來判斷是否改用非同步報表)
+LEVEL_ROW_WEIGHT = {
+    "account": 1,
+    "campaign": 20,
+    "adset": 100,
+    "ad": 500,
+}
+# 每個 breakdown 大約讓列數變成幾倍
+BREAKDOWN_ROW_FACTOR = 5
+
+
+class FacebookReportError(Exception):
+    """非同步報表 (AdReportRun) 失敗、被略過或等待逾時。"""
+
+
+# 可以重試的網路錯誤 (連線中斷、逾時)
+NETWORK_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.Timeout)
+
+# 限流錯誤碼：4 (app)、17 (user)、32 (page)、613 (呼叫頻率)、80000~80014 (business use case)
+RATE_LIMIT_ERROR_CODES = {4, 17, 32, 613} | set(range(80000, 80015))
+
+
+def parse_usage_headers(headers) -> tuple:
+    """
+    解析 Facebook 回傳的用量 header，回傳 (最高用量 %, 預估恢復存取所需分鐘數)：
+    - x-business-use-case-usage：{business_id: [{call_count, total_cputime, total_time, estimated_time_to_regain_access}, ...]}
+    - x-ad-account-usage：{acc_id_util_pct, ...}
+    - x-fb-ads-insights-throttle：{app_id_util_pct, acc_id_util_pct}
+    """
+    usage, regain_minutes = 0.0, 0
+    if not headers:
+        return usage, regain_minutes
+    headers = {str(key).lower(): value for key, value in headers.items()}
+
+    def _load(name):
+        try:
+            value = json.loads(headers.get(name) or 'null')
+        except (TypeError, ValueError):
+            return {}
+        return value if isinstance(value, dict) else {}
+
+    for entries in _load('x-business-use-case-usage').values():
+        for entry in entries if isinstance(entries, list) else []:
+            usage = max(usage, *(float(entry.get(key) or 0) for key in ('call_count', 'total_cputime', 'total_time')))
+            regain_minutes = max(regain_minutes, int(entry.get('estimated_time_to_regain_access') or 0))
+    usage = max(usage, float(_load('x-ad-account-usage').get('acc_id_util_pct') or 0))
+    insights_throttle = _load('x-fb-ads-insights-throttle')
+    usage = max(usage, float(insights_throttle.get('app_id_util_pct') or 0), float(insights_throttle.get('acc_id_util_pct') or 0))
+    return usage, regain_minutes
+
+
+class FacebookUsageThrottle:
+    """
+    依 Facebook 回傳的用量 header 調整同時進行的請求數 (同一次抽取的所有 slice 共用)。
+    用量低於 FACEBOOK_USAGE_SLOWDOWN_PCT 時使用全部 worker，之後線性遞減到 1；
+    超過 FACEBOOK_USAGE_PAUSE_PCT 或收到限流錯誤時，所有 slice 暫停到預估恢復存取的時間。
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max(1, max_workers)
+        self.allowed = self.max_workers
+        self.usage = 0.0
+        self._active = 0
+        self._paused_until = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                wait = self._paused_until - time.monotonic()
+                if wait <= 0 and self._active < self.allowed:
+                    self._active += 1
+                    return
+                self._condition.wait(timeout=wait if wait > 0 else None)
+
+    def release(self):
+        with self._condition:
+            self._active -= 1
+            self._condition.notify_all()
+
+    def update(self, headers):
+        usage, regain_minutes = parse_usage_headers(headers)
+        slowdown, pause = settings.FACEBOOK_USAGE_SLOWDOWN_PCT, settings.FACEBOOK_USAGE_PAUSE_PCT
+        with self._condition:
+            self.usage = usage
+            if usage >= pause:
+                self.allowed = 1
+                self._pause(regain_minutes * 60 or settings.FACEBOOK_USAGE_PAUSE_SECONDS)
+                logger.warning(f"Facebook API usage at {usage:.0f}%, pausing requests (regain access in ~{regain_minutes} min).")
+            elif usage >= slowdown:
+                self.allowed = max(1, int(self.max_workers * (pause - usage) / (pause - slowdown)))
+            else:
+                self.allowed = self.max_workers
+            self._condition.notify_all()
+
+    def backoff(self, seconds: float):
+        """收到限流錯誤：降到單一請求並暫停所有 slice。"""
+        with self._condition:
+            self.allowed = 1
+            self._pause(seconds)
+            self._condition.notify_all()
+
+    def _pause(self, seconds: float):
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class RateLimitedFacebookAdsApi(FacebookAdsApi):
+    """
+    每個 HTTP 請求 (包含 Cursor 分頁、報表輪詢) 送出前先經過跨 worker 的 RateLimiter；
+    收到限流錯誤時暫停同一個帳戶 (app 層級的錯誤碼 4 則暫停整個 provider) 的所有請求。
+    batch 請求 (POST 到根路徑) 由 FacebookBatchExtractor 依子請求的廣告帳戶各自計算，這裡不重複扣除。
+    """
+    rate_limiter = None
+
+    def call(self, method, path, params=None, headers=None, files=None, url_override=None, api_version=None):
+        is_batch = not path and isinstance((params or {}).get('batch'), list)
+        if self.rate_limiter and not is_batch:
+            self.rate_limiter.acquire()
+        try:
+            return super().call(method, path, params=params, headers=headers, files=files,
+                                url_override=url_override, api_version=api_version)
+        except FacebookRequestError as e:
+            if self.rate_limiter and e.api_error_code() in RATE_LIMIT_ERROR_CODES:
+                provider_wide = e.api_error_code() == 4
+                # 帳戶層級的限流只暫停該帳戶；沒有帳戶 bucket 時不退而暫停整個 provider
+                if provider_wide or self.rate_limiter.scoped:
+                    self.rate_limiter.penalize(settings.FACEBOOK_USAGE_PAUSE_SECONDS, provider_wide=provider_wide)
+            raise
+
+
+def date_slices(since: datetime.date, until: datetime.date, slice_days: int):
+    """將 [since, until] 切成每段最多 slice_days 天的 (since, until) 區間。"""
+    start = since
+    while start <= until:
+        end = min(start + datetime.timedelta(days=slice_days - 1), until)
+        yield start, end
+        start = end + datetime.timedelta(days=1)
+
+
 class FacebookAdsAPIClient:
     """
     用於與 Facebook Marketing API 互動的用戶端。
@@ -54,12 +231,13 @@ class FacebookAdsAPIClient:
             raise
 
         try:
-            self._api = FacebookAdsApi.init( # Store the API instance
+            self._api = RateLimitedFacebookAdsApi.init( # Store the API instance
                 app_id=self.app_id,
                 app_secret=self.app_secret,
                 access_token=self.access_token,
                 crash_log=False
             )
+            self._api.rate_limiter = RateLimiter("FACEBOOK_ADS", account=self.ad_account_id)
             if self.ad_account_id:
                 self.account = AdAccount(self.ad_account_id, api=self._api)
                 logger.info(f"FacebookAdsApi instance initialized for account {self.ad_account_id}")
@@ -120,30 +298,64 @@ class FacebookAdsAPIClient:
             logger.error(f"Unexpected error fetching ad accounts: {e}")
         return []
 
-    def get_insights(self,
-                    fields,
-                    date_preset,
-                    level=AdsInsights.Level.campaign,
-                    time_increment=1,
-                    breakdowns=None,
-                    action_breakdowns=None,
-                    extra_params=None):
+    @staticmethod
+    def parse_async_mode(value):
         """
-        獲取指定配置的廣告洞察報告 (修改為同步 GET 模式)。
+        將 connection config 的 insights_async 轉成 get_insights 的 async_mode：
+        true / "always" → True (一律使用非同步報表)，false / "never" / "sync" → False，
+        其他 (未設定、"auto") → None (依預估的報表大小自動選擇)。
         """
-        if not self.account:
-            logger.error("AdAccount is not initialized. Cannot get insights.")
-            return []
+        if isinstance(value, bool):
+            return value
+        value = str(value or "").strip().lower()
+        if value in ("true", "1", "always", "async"):
+            return True
+        if value in ("false", "0", "never", "sync"):
+            return False
+        return None
 
-        if not fields or not isinstance(fields, list):
-            raise ValueError("The 'fields' argument must be a non-empty list of strings.")
+    @staticmethod
+    def estimate_report_rows(params: dict) -> int:
+        """依日期範圍、時間粒度、層級與 breakdowns 粗估報表的列數。"""
+        time_range = params.get('time_range')
+        if isinstance(time_range, dict) and time_range.get('since') and time_range.get('until'):
+            try:
+                since = datetime.date.fromisoformat(time_range['since'])
+                until = datetime.date.fromisoformat(time_range['until'])
+                days = max(1, (until - since).days + 1)
+            except (TypeError, ValueError):
+                days = 30
+        else:
+            days = DATE_PRESET_DAYS.get(params.get('date_preset'), 30)
+
+        # time_increment 為天數 (1 = 每日一列)；"monthly" / "all_days" 時每個物件的列數很少
+        try:
+            periods = max(1, days // int(params.get('time_increment') or 1))
+        except (TypeError, ValueError):
+            periods = 1
 
-        # --- 準備請求參數 ---
+        level_weight = LEVEL_ROW_WEIGHT.get(params.get('level') or AdsInsights.Level.campaign, LEVEL_ROW_WEIGHT['campaign'])
+        breakdown_factor = BREAKDOWN_ROW_FACTOR ** len(params.get('breakdowns') or [])
+        return periods * level_weight * breakdown_factor
+
+    @classmethod
+    def should_use_async_report(cls, params: dict) -> bool:
+        """預估列數超過 FACEBOOK_INSIGHTS_ASYNC_ROW_THRESHOLD 時改用非同步報表。"""
+        return cls.estimate_report_rows(params) >= settings.FACEBOOK_INSIGHTS_ASYNC_ROW_THRESHOLD
+
+    @staticmethod
+    def build_insights_params(date_preset, level=AdsInsights.Level.campaign, time_increment=1, breakdowns=None,
+                              action_breakdowns=None, extra_params=None, time_range=None) -> dict:
+        """準備 insights 請求參數；time_range ((since, until) 日期) 指定時取代 date_preset。"""
         params = {
             'level': level,
             'time_increment': time_increment,
-            'date_preset': date_preset,
         }
+        if time_range:
+            since, until = time_range
+            params['time_range'] = {'since': str(since), 'until': str(until)}
+        else:
+            params['date_preset'] = date_preset
         if breakdowns:
             params['breakdowns'] = breakdowns
         if action_breakdowns:
@@ -151,60 +363,288 @@ class FacebookAdsAPIClient:
 
         if extra_params:
             params.update(extra_params)
-            
+        return params
+
+    @staticmethod
+    def parse_slice_days(slice_days) -> int:
+        try:
+            return int(settings.FACEBOOK_INSIGHTS_SLICE_DAYS if slice_days is None else slice_days)
+        except (TypeError, ValueError):
+            return settings.FACEBOOK_INSIGHTS_SLICE_DAYS
+
+    @staticmethod
+    def needs_slicing(params: dict, time_range, slice_days: int) -> bool:
+        """只有每日粒度 (time_increment=1) 且 time_range 超過 slice_days 天時才切段。"""
+        if not time_range or slice_days <= 0 or str(params.get('time_increment')) != '1':
+            return False
+        since, until = (datetime.date.fromisoformat(str(value)) for value in time_range)
+        return (until - since).days + 1 > slice_days
+
+    def get_insights(self, fields, date_preset, **kwargs):
+        """
+        獲取指定配置的廣告洞察報告，回傳完整的列表 (參數與 iter_insights 相同)。
+        大量資料請改用 iter_insights + write_insights_stream_to_bigquery，不必把整份報表留在記憶體。
+        """
+        insights_data = list(self.iter_insights(fields, date_preset, **kwargs))
+        logger.info(f"Successfully fetched {len(insights_data)} insights records for account {self.ad_account_id}.")
+        return insights_data
+
+    def iter_insights(self,
+                      fields,
+                      date_preset,
+                      level=AdsInsights.Level.campaign,
+                      time_increment=1,
+                      breakdowns=None,
+                      action_breakdowns=None,
+                      extra_params=None,
+                      async_mode=None,
+                      time_range=None,
+                      slice_days=None):
+        """
+        逐頁讀取廣告洞察報告並逐筆 yield (不保證依日期排序)。
+
+        Args:
+            async_mode (bool, optional): True 使用非同步報表 (AdReportRun)，False 使用同步 GET 分頁，
+                                         None 依預估的報表大小自動選擇。
+            time_range (tuple, optional): (since, until) 日期 (含)；指定時取代 date_preset (增量同步)。
+            slice_days (int, optional): time_range 超過此天數時切成多段並行抓取 (預設 FACEBOOK_INSIGHTS_SLICE_DAYS，0 表示不切)。
+        """
+        if not self.account:
+            logger.error("AdAccount is not initialized. Cannot get insights.")
+            return
+
+        if not fields or not isinstance(fields, list):
+            raise ValueError("The 'fields' argument must be a non-empty list of strings.")
+
+        params = self.build_insights_params(date_preset, level, time_increment, breakdowns,
+                                            action_breakdowns, extra_params, time_range)
+
+        # 長日期範圍 (例如首次回補數個月) 切成多段，以 thread pool 並行抓取
+        slice_days = self.parse_slice_days(slice_days)
+        if self.needs_slicing(params, time_range, slice_days):
+            since, until = (datetime.date.fromisoformat(str(value)) for value in time_range)
+            yield from self._iter_sliced_insights(fields, params, since, until, slice_days, async_mode)
+            return
+
+        if async_mode is None:
+            async_mode = self.should_use_async_report(params)
+
+        if async_mode:
+            # 大型帳戶 (ad 層級、多個 breakdowns、長日期範圍) 的同步 GET 容易逾時，改由 Facebook 在背景產生報表
+            yield from self.iter_async_insights(fields, params)
+            return
+
         logger.info(f"Requesting insights for account {self.ad_account_id} with params: {params} and {len(fields)} fields.")
-        
-        max_retries = 3
-        for attempt in range(max_retries):
+        # SDK 的 get_insights 在同步模式下會發起 GET 請求並回傳 Cursor，之後每讀完一頁才請求下一頁
+        cursor = self._call_with_retry(
+            lambda: self.account.get_insights(fields=fields, params=params),
+            "request insights",
+        )
+        yield from self._iter_cursor(cursor, "insights")
+
+    def iter_async_insights(self, fields, params):
+        """
+        以非同步報表取得洞察資料：建立 AdReportRun (is_async=True)、以指數退避輪詢直到完成，
+        再逐頁讀取結果 (每頁 FACEBOOK_INSIGHTS_PAGE_SIZE 筆)，逐筆 yield，不必一次把整份報表留在記憶體。
+        """
+        logger.info(f"Starting async insights report for account {self.ad_account_id} with params: {params} and {len(fields)} fields.")
+        report_run = self._call_with_retry(
+            lambda: self.account.get_insights(fields=fields, params=params, is_async=True),
+            "start async insights report",
+        )
+        report_run = self._wait_for_report(report_run)
+
+        rows = report_run.get_result(params={'limit': settings.FACEBOOK_INSIGHTS_PAGE_SIZE})
+        yield from self._iter_cursor(rows, f"report {report_run.get_id()}")
+
+    def _iter_cursor(self, cursor, description):
+        """逐筆讀取 Cursor；讀取下一頁遇到暫時性錯誤時重試同一頁。"""
+        errors = 0
+        while True:
             try:
-                # --- 核心修改點 ---
-                # 1. 使用同步模式 (is_async=False 或不寫)
-                # 2. SDK 的 get_insights 在同步模式下會發起 GET 請求
-                # 3. SDK 會自動處理 fields 列表，將其轉換為 "field1,field2,..."
-                insights_iterator = self.account.get_insights(
-                    fields=fields,
-                    params=params,
-                )
-                
-                # 將回傳的迭代器轉換為列表
-                insights_data = list(insights_iterator)
-                
-                logger.info(f"Successfully fetched {len(insights_data)} insights records for account {self.ad_account_id}.")
-                return insights_data
+                # Cursor 在讀完目前這頁後才會請求下一頁；請求失敗時 after 游標不變，重試會重新讀取同一頁
+                row = next(cursor)
+            except StopIteration:
+                return
+            except FacebookRequestError as e:
+                errors += 1
+                self._log_request_error(e, f"{description} page fetch attempt {errors}")
+                if not (self._is_transient(e) or self._is_rate_limited(e)) or errors >= settings.FACEBOOK_API_MAX_RETRIES:
+                    raise
+                time.sleep(self._backoff(errors))
+                continue
+            except NETWORK_ERRORS as e:
+                errors += 1
+                logger.warning(f"Network error on {description} page fetch attempt {errors} for account {self.ad_account_id}: {e}")
+                if errors >= settings.FACEBOOK_API_MAX_RETRIES:
+                    raise
+                time.sleep(self._backoff(errors))
+                continue
+            errors = 0
+            yield row
 
+    def _iter_sliced_insights(self, fields, params, since, until, slice_days, async_mode):
+        """
+        將 [since, until] 切成 slice_days 天的區間並行抓取，每完成一段就 yield 該段的資料 (依完成順序)。
+        並行數上限為 FACEBOOK_INSIGHTS_SLICE_WORKERS，並依回傳的用量 header 動態調整 (FacebookUsageThrottle)。
+        """
+        slices = list(date_slices(since, until, slice_days))
+        throttle = FacebookUsageThrottle(min(settings.FACEBOOK_INSIGHTS_SLICE_WORKERS, len(slices)))
+        logger.info(
+            f"Fetching insights for account {self.ad_account_id} from {since} to {until} "
+            f"in {len(slices)} slices of {slice_days} days with up to {throttle.max_workers} workers."
+        )
+        fetched = 0
+        pending_slices = iter(slices)
+        with ThreadPoolExecutor(max_workers=throttle.max_workers, thread_name_prefix="fb-insights") as executor:
+            def submit_next():
+                slice_range = next(pending_slices, None)
+                if slice_range is None:
+                    return
+                slice_since, slice_until = slice_range
+                futures.add(executor.submit(
+                    self._fetch_slice,
+                    fields,
+                    {**params, 'time_range': {'since': slice_since.isoformat(), 'until': slice_until.isoformat()}},
+                    async_mode,
+                    throttle,
+                ))
+
+            # 最多只有 max_workers 段在抓取或等待交出：呼叫端每讀完一段才送出下一段，
+            # 寫入 BigQuery 較慢時不會讓已完成的 slice 在記憶體中堆積
+            futures = set()
+            for _ in range(throttle.max_workers):
+                submit_next()
+            try:
+                while futures:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        # 交出後就不再持有這段的資料
+                        futures.remove(future)
+                        rows = future.result()
+                        fetched += len(rows)
+                        yield from rows
+                        del rows
+                        submit_next()
+            except BaseException:
+                # 任一段失敗 (或呼叫端停止讀取) 時取消尚未開始的 slice
+                for future in futures:
+                    future.cancel()
+                raise
+
+        logger.info(
+            f"Fetched {fetched} insights records for account {self.ad_account_id} "
+            f"from {len(slices)} slices (last usage {throttle.usage:.0f}%)."
+        )
+
+    def _fetch_slice(self, fields, params, async_mode, throttle):
+        """抓取單一 slice；限流與暫時性錯誤時重試，限流時同時暫停其他 slice。"""
+        use_async = self.should_use_async_report(params) if async_mode is None else async_mode
+        time_range = params['time_range']
+        for attempt in range(1, settings.FACEBOOK_API_MAX_RETRIES + 1):
+            delay = None
+            throttle.acquire()
+            try:
+                if use_async:
+                    return list(self.iter_async_insights(fields, params))
+                cursor = self.account.get_insights(fields=fields, params=params)
+                throttle.update(cursor.headers())
+                rows, headers = [], cursor.headers()
+                for row in cursor:
+                    # Cursor 每讀取一頁就會更新 headers
+                    if cursor.headers() is not headers:
+                        headers = cursor.headers()
+                        throttle.update(headers)
+                    rows.append(row)
+                return rows
             except FacebookRequestError as e:
-                # 記錄詳細的錯誤日誌，包含 API 回傳的內容
-                logger.error(
-                    f"Facebook API request error on attempt {attempt + 1}/{max_retries} for account {self.ad_account_id}: \n"
-                    f"  Message: {e.api_error_message()}\n"
-                    f"  Method:  {e.request_context().get('method')}\n"
-                    f"  Path:    {e.request_context().get('path')}\n"
-                    f"  Params:  {e.request_context().get('params')}\n"
-                    f"\n"
-                    f"  Status:  {e.http_status()}\n"
-                    f"  Response:\n    {json.dumps(e.body(), indent=4)}\n"
+                throttle.update(e.http_headers())
+                self._log_request_error(e, f"slice {time_range['since']} ~ {time_range['until']} attempt {attempt}/{settings.FACEBOOK_API_MAX_RETRIES}")
+                rate_limited = self._is_rate_limited(e)
+                if not (rate_limited or self._is_transient(e)) or attempt == settings.FACEBOOK_API_MAX_RETRIES:
+                    raise
+                delay = self._backoff(attempt)
+                if rate_limited:
+                    throttle.backoff(delay)
+            finally:
+                throttle.release()
+            if delay:
+                time.sleep(delay)
+
+    def _wait_for_report(self, report_run):
+        """輪詢 AdReportRun 直到完成；失敗、被略過或超過 FACEBOOK_INSIGHTS_ASYNC_TIMEOUT 時拋出 FacebookReportError。"""
+        report_id = report_run.get_id()
+        interval = settings.FACEBOOK_INSIGHTS_ASYNC_POLL_INTERVAL
+        deadline = time.monotonic() + settings.FACEBOOK_INSIGHTS_ASYNC_TIMEOUT
+        while True:
+            time.sleep(interval)
+            report_run = self._call_with_retry(
+                lambda: report_run.api_get(fields=[
+                    AdReportRun.Field.async_status,
+                    AdReportRun.Field.async_percent_completion,
+                ]),
+                f"poll insights report {report_id}",
+            )
+            status = report_run.get(AdReportRun.Field.async_status)
+            percent = report_run.get(AdReportRun.Field.async_percent_completion)
+            logger.info(f"Insights report {report_id} for account {self.ad_account_id}: {status} ({percent}%)")
+
+            if status == REPORT_STATUS_COMPLETED:
+                return report_run
+            if status in REPORT_STATUS_FAILED:
+                raise FacebookReportError(f"Insights report {report_id} for account {self.ad_account_id} ended with status '{status}'.")
+            if time.monotonic() >= deadline:
+                raise FacebookReportError(
+                    f"Insights report {report_id} for account {self.ad_account_id} did not finish within "
+                    f"{settings.FACEBOOK_INSIGHTS_ASYNC_TIMEOUT} seconds (last status '{status}', {percent}%)."
                 )
+            interval = min(interval * 2, settings.FACEBOOK_INSIGHTS_ASYNC_POLL_MAX_INTERVAL)
 
-                # 如果是權杖錯誤，直接拋出異常，讓 view 層捕捉
+    def _call_with_retry(self, func, description):
+        """執行單一 API 呼叫，暫時性錯誤 (限流、5xx) 以指數退避重試。"""
+        for attempt in range(1, settings.FACEBOOK_API_MAX_RETRIES + 1):
+            try:
+                return func()
+            except FacebookRequestError as e:
+                self._log_request_error(e, f"{description} attempt {attempt}/{settings.FACEBOOK_API_MAX_RETRIES}")
                 if e.api_error_code() == 190:
+                    # 權杖錯誤，直接拋出異常，讓 view 層捕捉
                     logger.error("Access token is invalid or expired. Raising exception.")
-                    raise e # 向上拋出，讓 form_valid 知道授權失敗
+                    raise
+                if not (self._is_transient(e) or self._is_rate_limited(e)) or attempt == settings.FACEBOOK_API_MAX_RETRIES:
+                    raise
+                time.sleep(self._backoff(attempt))
+            except NETWORK_ERRORS as e:
+                logger.warning(f"Network error on {description} attempt {attempt}/{settings.FACEBOOK_API_MAX_RETRIES} for account {self.ad_account_id}: {e}")
+                if attempt == settings.FACEBOOK_API_MAX_RETRIES:
+                    raise
+                time.sleep(self._backoff(attempt))
 
-                # 如果不是暫時性錯誤，或已達最大重試次數，就拋出異常
-                is_transient = hasattr(e, 'api_transient_error') and e.api_transient_error()
-                if not is_transient or attempt == max_retries - 1:
-                    raise e
-                
-                # 如果是暫時性錯誤，則等待後重試
-                logger.info(f"Transient error, will retry in {5 * (attempt + 1)} seconds...")
-                time.sleep(5 * (attempt + 1))
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        # 加上隨機抖動，避免多個 worker 在同一時間重試
+        return min(5 * 2 ** (attempt - 1), settings.FACEBOOK_INSIGHTS_ASYNC_POLL_MAX_INTERVAL) * random.uniform(0.5, 1.5)
 
-            except Exception as e:
-                logger.error(f"Unexpected error on attempt {attempt + 1}/{max_retries} for insights: {e}", exc_info=True)
-                if attempt == max_retries - 1:
-                    raise e # 達到最大重試次數後，拋出異常
+    @staticmethod
+    def _is_transient(e: FacebookRequestError) -> bool:
+        return hasattr(e, 'api_transient_error') and bool(e.api_transient_error())
 
-        return [] # 如果所有重試都失敗，返回空列表
+    @staticmethod
+    def _is_rate_limited(e: FacebookRequestError) -> bool:
+        return e.api_error_code() in RATE_LIMIT_ERROR_CODES
+
+    def _log_request_error(self, e: FacebookRequestError, context: str):
+        # 記錄詳細的錯誤日誌，包含 API 回傳的內容
+        logger.error(
+            f"Facebook API request error on {context} for account {self.ad_account_id}: \n"
+            f"  Message: {e.api_error_message()}\n"
+            f"  Method:  {e.request_context().get('method')}\n"
+            f"  Path:    {e.request_context().get('path')}\n"
+            f"  Params:  {e.request_context().get('params')}\n"
+            f"\n"
+            f"  Status:  {e.http_status()}\n"
+            f"  Response:\n    {json.dumps(e.body(), indent=4)}\n"
+        )
 
     def _infer_bigquery_schema(self, data_row: dict) -> list:
         """
@@ -241,83 +681,340 @@ class FacebookAdsAPIClient:
         logger.info(f"Inferred schema with {len(schema)} fields.")
         return schema
     
-    def write_insights_to_bigquery(self, dataset_id: str, table_name: str, insights_data: list) -> int:
+    def write_insights_to_bigquery(self, dataset_id: str, table_name: str, insights_data: list, replace_range=None) -> int:
+        """將 Facebook Insights 列表寫入 BigQuery (見 write_insights_stream_to_bigquery)。"""
+        return self.write_insights_stream_to_bigquery(dataset_id, table_name, insights_data or [], replace_range)
+
+    def write_insights_stream_to_bigquery(self, dataset_id: str, table_name: str, rows, replace_range=None) -> int:
         """
-        將 Facebook Insights 資料寫入指定的 BigQuery 資料表。
+        將 Facebook Insights 資料 (任意 iterable，例如 iter_insights) 寫入指定的 BigQuery 資料表。
         這個方法會處理：
-        1. 檢查資料是否存在。
-        2. 將 Facebook SDK object 轉換為 dict。
-        3. 推斷 Schema。
-        4. 建立或取得資料表。
-        5. 載入資料。
+        1. 依第一筆資料推斷 Schema，建立或取得資料表。
+        2. 逐筆轉成 NDJSON 寫入暫存檔 (SpooledTemporaryFile，超過 FACEBOOK_LOAD_SPOOL_MEMORY_BYTES 才寫到磁碟)，
+           每累積 FACEBOOK_LOAD_CHUNK_BYTES 就送出一個 load job 到 staging 表；worker 只需要保留一個 chunk。
+        3. 全部載入後以 MERGE 原子地替換 date_start 在 replace_range 內的資料 (未指定時為這批資料涵蓋的日期)，
+           重複同步同一段日期不會產生重複的資料列。沒有 date_start 欄位時各 chunk 直接附加 (APPEND) 到資料表。
+
+        Args:
+            replace_range (tuple, optional): (since, until) 日期 (含)。增量同步時即使沒有資料，
+                                             也會清除這段日期的舊資料。
+        Returns:
+            int: 載入的列數。
         """
-        if not insights_data:
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None and replace_range is None:
             logger.info("No insights data to write to BigQuery.")
             return 0
 
-        # 將 Facebook AdsInsights 物件列表轉換為字典列表
-        # Facebook SDK 回傳的物件可以用 dict() 直接轉換
-        records_to_load = [dict(row) for row in insights_data]
-        
         # 取得 BigQuery 資料集和資料表的參照
         dataset_ref = self.bq_client.dataset(dataset_id)
         table_ref = dataset_ref.table(table_name)
-        
+        table = self._get_or_create_table(table_ref, [dict(first)] if first is not None else [])
+        if table is None:
+            logger.info(f"Table {dataset_id}.{table_name} does not exist and there is no data to write.")
+            return 0
+
+        schema_fields = {field.name: field for field in table.schema}
+        replace = 'date_start' in schema_fields
+        target = f"`{table.project}.{table.dataset_id}.{table.table_id}`"
+
+        if first is None:
+            since, until = (datetime.date.fromisoformat(str(value)) for value in replace_range)
+            deleted = self._run_query(
+                f"DELETE FROM {target} WHERE date_start BETWEEN @since AND @until",
+                self._date_range_parameters(schema_fields['date_start'], since, until),
+            ) if replace else 0
+            logger.info(f"No insights data for {since} ~ {until}; removed {deleted} stale rows from {dataset_id}.{table_name}.")
+            return 0
+
+        # 先載入一次性的 staging 表 (與目標表相同的 schema)，最後再以單一 MERGE 替換目標表的資料
+        staging_ref = dataset_ref.table(f"{table_name}__staging_{uuid.uuid4().hex[:12]}")
+        destination = staging_ref if replace else table_ref
+
+        fetched = loaded = 0
+        seen_fields = set()
+        min_date = max_date = None
+        all_dated = True
+        spool = None
+        try:
+            for row in itertools.chain([first], rows):
+                record = row if isinstance(row, dict) else dict(row)
+                seen_fields.update(record)
+                date_start = record.get('date_start')
+                if date_start:
+                    min_date = date_start if min_date is None else min(min_date, date_start)
+                    max_date = date_start if max_date is None else max(max_date, date_start)
+                else:
+                    all_dated = False
+
+                if spool is None:
+                    # load_table_from_file 只接受 rb / r+b 模式的檔案
+                    spool = tempfile.SpooledTemporaryFile(max_size=settings.FACEBOOK_LOAD_SPOOL_MEMORY_BYTES, mode='r+b')
+                spool.write(json.dumps(record, default=str).encode('utf-8'))
+                spool.write(b'\n')
+                fetched += 1
+                if spool.tell() >= settings.FACEBOOK_LOAD_CHUNK_BYTES:
+                    loaded += self._load_spool(spool, destination, table.schema)
+                    spool = None
+            if spool is not None:
+                loaded += self._load_spool(spool, destination, table.schema)
+                spool = None
+
+            unknown_fields = sorted(seen_fields - set(schema_fields))
+            if unknown_fields:
+                logger.warning(f"Fields {unknown_fields} are not in the schema of {dataset_id}.{table_name} and were ignored.")
+
+            if not replace:
+                logger.info(f"Appended {loaded} of {fetched} rows to {dataset_id}.{table_name}.")
+                return loaded
+
+            staging = f"`{table.project}.{staging_ref.dataset_id}.{staging_ref.table_id}`"
+            if replace_range is None and not all_dated:
+                # 有資料缺少 date_start，無法判斷要替換的範圍，退回附加
+                self._run_query(f"INSERT INTO {target} SELECT * FROM {staging}", [])
+                logger.info(f"Appended {loaded} of {fetched} rows to {dataset_id}.{table_name}.")
+                return loaded
+
+            since, until = (datetime.date.fromisoformat(str(value)) for value in (replace_range or (min_date, max_date)))
+            self._run_query(
+                f"""
+                MERGE {target} T
+                USING {staging} S
+                ON FALSE
+                WHEN NOT MATCHED BY SOURCE AND T.date_start BETWEEN @since AND @until THEN DELETE
+                WHEN NOT MATCHED THEN INSERT ROW
+                """,
+                self._date_range_parameters(schema_fields['date_start'], since, until),
+            )
+            logger.info(f"Replaced {since} ~ {until} in {dataset_id}.{table_name} with {loaded} of {fetched} rows.")
+            return loaded
+        finally:
+            if spool is not None:
+                spool.close()
+            if replace:
+                try:
+                    self.bq_client.delete_table(staging_ref, not_found_ok=True)
+                except GoogleAPICallError as e:
+                    logger.warning(f"Failed to delete staging table {staging_ref.table_id}: {e}")
+
+    @staticmethod
+    def _date_range_parameters(date_field, since: datetime.date, until: datetime.date) -> list:
+        # date_start 可能是舊版建立的 STRING 欄位
+        if date_field.field_type == 'DATE':
+            return [
+                bigquery.ScalarQueryParameter('since', 'DATE', since),
+                bigquery.ScalarQueryParameter('until', 'DATE', until),
+            ]
+        return [
+            bigquery.ScalarQueryParameter('since', 'STRING', since.isoformat()),
+            bigquery.ScalarQueryParameter('until', 'STRING', until.isoformat()),
+        ]
+
+    def _get_or_create_table(self, table_ref, records: list):
+        """取得資料表；不存在時依第一筆資料推斷 schema 並建立 (沒有資料時回傳 None)。"""
         try:
             # 檢查資料表是否存在，如果不存在，下一步會引發 NotFound 錯誤
-            self.bq_client.get_table(table_ref)
-            logger.info(f"Table {dataset_id}.{table_name} already exists. Appending data.")
+            table = self.bq_client.get_table(table_ref)
+            logger.info(f"Table {table_ref.dataset_id}.{table_ref.table_id} already exists.")
+            return table
         except NotFound:
-            # 資料表不存在，根據第一筆資料的結構來建立它
-            logger.info(f"Table {dataset_id}.{table_name} not found. Creating new table.")
-            # 從第一筆資料推斷 schema
-            schema = self._infer_bigquery_schema(records_to_load[0])
-            table = bigquery.Table(table_ref, schema=schema)
-            
-            # 將 date_start 設為每日分區欄位，這是 FB 廣告數據最常用的分區方式
-            if 'date_start' in [field.name for field in schema]:
-                table.time_partitioning = bigquery.TimePartitioning(
-                    type_=bigquery.TimePartitioningType.DAY,
-                    field="date_start"
-                )
-                logger.info("Setting time partitioning on 'date_start' field.")
-            
-            try:
-                self.bq_client.create_table(table)
-                logger.info(f"Successfully created table {dataset_id}.{table_name}")
-            except GoogleAPICallError as e:
-                logger.error(f"Failed to create BigQuery table: {e}", exc_info=True)
-                raise
+            if not records:
+                return None
 
-        # --- 載入資料 ---
+        # 資料表不存在，根據第一筆資料的結構來建立它
+        logger.info(f"Table {table_ref.dataset_id}.{table_ref.table_id} not found. Creating new table.")
+        # 從第一筆資料推斷 schema
+        schema = self._infer_bigquery_schema(records[0])
+        table = bigquery.Table(table_ref, schema=schema)
+
+        # 將 date_start 設為每日分區欄位，這是 FB 廣告數據最常用的分區方式
+        if 'date_start' in [field.name for field in schema]:
+            table.time_partitioning = bigquery.TimePartitioning(
+                type_=bigquery.TimePartitioningType.DAY,
+                field="date_start"
+            )
+            logger.info("Setting time partitioning on 'date_start' field.")
+
+        try:
+            table = self.bq_client.create_table(table)
+            logger.info(f"Successfully created table {table_ref.dataset_id}.{table_ref.table_id}")
+            return table
+        except GoogleAPICallError as e:
+            logger.error(f"Failed to create BigQuery table: {e}", exc_info=True)
+            raise
+
+    def _load_spool(self, spool, table_ref, schema) -> int:
+        """將一個 NDJSON chunk 以 load job 附加到資料表並等待完成，回傳載入的列數 (之後關閉暫存檔)。"""
         job_config = bigquery.LoadJobConfig(
-            # 如果目標資料表已有資料，APPEND 會將新資料附加在後面
+            source_format=bigquery.SourceFormat.NEWLINE_DELIMITED_JSON,
+            schema=schema,
             write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+            ignore_unknown_values=True,
         )
-
         try:
-            load_job = self.bq_client.load_table_from_json(
-                records_to_load,
-                table_ref,
-                job_config=job_config
-            )
-            logger.info(f"Starting BigQuery load job {load_job.job_id} for table {table_name}")
+            load_job = self.bq_client.load_table_from_file(spool, table_ref, rewind=True, job_config=job_config)
+            logger.info(f"Starting BigQuery load job {load_job.job_id} for table {table_ref.table_id} ({spool.tell()} bytes)")
 
             load_job.result()  # 等待工作完成
 
             if load_job.errors:
-                logger.error(f"BigQuery load job finished with errors for table {table_name}: {load_job.errors}")
+                logger.error(f"BigQuery load job finished with errors for table {table_ref.table_id}: {load_job.errors}")
                 # 拋出異常，讓 Celery task 捕捉到錯誤
                 raise Exception(f"BigQuery load errors: {load_job.errors}")
-            else:
-                logger.info(f"Successfully loaded {load_job.output_rows} rows into {dataset_id}.{table_name}.")
-                return load_job.output_rows
+            logger.info(f"Successfully loaded {load_job.output_rows} rows into {table_ref.dataset_id}.{table_ref.table_id}.")
+            return load_job.output_rows
 
         except Exception as e:
             logger.error(f"An error occurred during BigQuery data load: {e}", exc_info=True)
             raise
+        finally:
+            spool.close()
+
+    def _run_query(self, sql: str, query_parameters: list) -> int:
+        """執行 DML 並等待完成，回傳受影響的列數。"""
+        query_job = self.bq_client.query(
+            sql,
+            job_config=bigquery.QueryJobConfig(query_parameters=query_parameters),
+        )
+        query_job.result()
+        return query_job.num_dml_affected_rows or 0
 
     
+class FacebookBatchExtractor:
+    """
+    以 Graph API batch 請求 (每次最多 FACEBOOK_BATCH_SIZE 個子請求) 抓取同一個 access token 下
+    多個廣告帳戶 / 層級的 insights 與帳戶資訊，再依 key 分開回傳，減少 HTTP 往返。
+    每個 insights job 的下一頁在下一輪 batch 中請求，直到所有 job 都讀完。
+    只適合同步 GET 就能完成的小型報表 (見 batchable)；大型報表仍使用 FacebookAdsAPIClient.iter_insights。
+    """
+
+    ACCOUNT_FIELDS = ['name', 'account_status', 'currency', 'timezone_name']
+
+    def __init__(self, client: FacebookAdsAPIClient):
+        self.client = client
+        self._jobs = {}
+        self._limiters = {}
+
+    @staticmethod
+    def batchable(fields, date_preset, async_mode=None, time_range=None, slice_days=None, **options) -> bool:
+        """不需要非同步報表、也不需要切段的報表才適合合併成 batch。"""
+        if not fields or async_mode:
+            return False
+        params = FacebookAdsAPIClient.build_insights_params(date_preset, time_range=time_range, **options)
+        if FacebookAdsAPIClient.needs_slicing(params, time_range, FacebookAdsAPIClient.parse_slice_days(slice_days)):
+            return False
+        return async_mode is False or not FacebookAdsAPIClient.should_use_async_report(params)
+
+    def add_insights(self, key, ad_account_id, fields, date_preset, time_range=None, **options):
+        """加入一個 insights job (參數與 FacebookAdsAPIClient.iter_insights 相同，async_mode / slice_days 會被忽略)。"""
+        options.pop('async_mode', None)
+        options.pop('slice_days', None)
+        params = FacebookAdsAPIClient.build_insights_params(date_preset, time_range=time_range, **options)
+        params.update(fields=','.join(fields), limit=settings.FACEBOOK_INSIGHTS_PAGE_SIZE)
+        self._add_job(key, ad_account_id, f"{self._account_path(ad_account_id)}/insights", params, paged=True)
+
+    def add_account_metadata(self, key, ad_account_id, fields=None):
+        """加入一個帳戶資訊 job (名稱、狀態、幣別、時區)。"""
+        self._add_job(key, ad_account_id, self._account_path(ad_account_id),
+                      {'fields': ','.join(fields or self.ACCOUNT_FIELDS)}, paged=False)
+
+    def execute(self) -> dict:
+        """
+        執行所有 job，回傳 {key: {'rows': [...], 'data': {...}, 'error': FacebookRequestError 或 None}}：
+        insights job 的資料在 rows，帳戶資訊在 data。暫時性錯誤與限流的子請求會在下一輪重試。
+        """
+        rounds = 0
+        while True:
+            pending = [key for key, job in self._jobs.items() if not job['done']]
+            if not pending:
+                break
+            rounds += 1
+            retry_attempts = 0
+            for start in range(0, len(pending), settings.FACEBOOK_BATCH_SIZE):
+                chunk = pending[start:start + settings.FACEBOOK_BATCH_SIZE]
+                batch = self.client._api.new_batch()
+                answered = set()
+                for key in chunk:
+                    job = self._jobs[key]
+                    batch.add(
+                        'GET', job['path'], params=job['params'],
+                        success=lambda response, key=key: self._on_success(key, response, answered),
+                        failure=lambda response, key=key: self._on_failure(key, response, answered),
+                    )
+                # 每個子請求都向自己廣告帳戶的 bucket (以及 provider bucket) 預約一個 token
+                for account, count in Counter(self._jobs[key]['account'] for key in chunk).items():
+                    self._limiter(account).acquire(count)
+                self.client._call_with_retry(batch.execute, f"batch of {len(chunk)} requests")
+                # 沒有回應的子請求 (Facebook 回傳 null) 與可重試的錯誤留到下一輪
+                for key in chunk:
+                    job = self._jobs[key]
+                    if key not in answered:
+                        self._retry_or_fail(job, None)
+                    if not job['done']:
+                        retry_attempts = max(retry_attempts, job['attempts'])
+            if retry_attempts:
+                time.sleep(self.client._backoff(retry_attempts))
+
+        logger.info(f"Facebook batch extraction finished {len(self._jobs)} jobs in {rounds} rounds.")
+        return {
+            key: {'rows': job['rows'], 'data': job['data'], 'error': job['error']}
+            for key, job in self._jobs.items()
+        }
+
+    def _add_job(self, key, ad_account_id, path, params, paged):
+        self._jobs[key] = {
+            'account': self._account_path(ad_account_id), 'path': path, 'params': params, 'paged': paged,
+            'rows': [], 'data': None, 'error': None, 'attempts': 0, 'done': False,
+        }
+
+    def _limiter(self, account) -> RateLimiter:
+        if account not in self._limiters:
+            self._limiters[account] = RateLimiter("FACEBOOK_ADS", account=account)
+        return self._limiters[account]
+
+    @staticmethod
+    def _account_path(ad_account_id) -> str:
+        ad_account_id = str(ad_account_id)
+        return ad_account_id if ad_account_id.startswith('act_') else f'act_{ad_account_id}'
+
+    def _on_success(self, key, response, answered):
+        answered.add(key)
+        job = self._jobs[key]
+        body = response.json() or {}
+        job['attempts'] = 0
+        if not job['paged']:
+            job['data'] = body
+            job['done'] = True
+            return
+        job['rows'].extend(body.get('data', []))
+        paging = body.get('paging') or {}
+        after = (paging.get('cursors') or {}).get('after')
+        if after and 'next' in paging:
+            job['params'] = {**job['params'], 'after': after}
+        else:
+            job['done'] = True
+
+    def _on_failure(self, key, response, answered):
+        answered.add(key)
+        self._retry_or_fail(self._jobs[key], response.error())
+
+    def _retry_or_fail(self, job, error):
+        """可重試的錯誤 (或沒有回應) 留到下一輪；超過 FACEBOOK_API_MAX_RETRIES 或不可重試時記錄錯誤。"""
+        job['attempts'] += 1
+        retryable = error is None or FacebookAdsAPIClient._is_transient(error) or FacebookAdsAPIClient._is_rate_limited(error)
+        if error is not None:
+            self.client._log_request_error(error, f"batch request {job['path']} attempt {job['attempts']}")
+            if FacebookAdsAPIClient._is_rate_limited(error):
+                # 只暫停被限流的廣告帳戶；app 層級 (錯誤碼 4) 才暫停整個 provider
+                self._limiter(job['account']).penalize(
+                    settings.FACEBOOK_USAGE_PAUSE_SECONDS, provider_wide=error.api_error_code() == 4
+                )
+        if not retryable or job['attempts'] >= settings.FACEBOOK_API_MAX_RETRIES:
+            job['error'] = error or FacebookReportError(f"No response for batch request {job['path']}.")
+            job['done'] = True
+
+
 def get_facebook_ads_page_context(user_access_token=None): # Added user_access_token
     """
     準備用於 Facebook Ads 相關頁面的上下文數據。
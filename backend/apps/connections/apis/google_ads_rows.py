@@ -0,0 +1,178 @@
+# apps/connections/apis/google_ads_rows.py
+# Google Ads search_stream 資料列 → 欄位 (columnar) 資料
+# 依 GAQL 選取的欄位只編譯一次：每個欄位的路徑、型別與 BigQuery 欄位名稱在第一筆資料時由 proto descriptor 決定。
+# 之後每一列只以一個 operator.attrgetter 從原始 protobuf 訊息 (proto-plus 的 _pb) 一次取出所有欄位，
+# 分批轉置後存入型別化的 array；micros 換算與 enum 名稱在最後以 numpy 向量化處理，
+# 不再逐列經過 MessageToJson → json.loads → 攤平 → pandas 改名。
+import array
+import json
+import operator
+
+import numpy as np
+import pandas as pd
+from google.cloud import bigquery
+from google.protobuf import json_format
+from google.protobuf.descriptor import FieldDescriptor
+
+MICROS_SUFFIX = "_micros"
+# 每累積多少列轉置一次存入欄位 buffer
+CHUNK_ROWS = 50_000
+
+# protobuf cpp_type → (array typecode, BigQuery 型別)
+_SCALAR_TYPES = {
+    FieldDescriptor.CPPTYPE_INT32: ("q", "INTEGER"),
+    FieldDescriptor.CPPTYPE_INT64: ("q", "INTEGER"),
+    FieldDescriptor.CPPTYPE_UINT32: ("q", "INTEGER"),
+    FieldDescriptor.CPPTYPE_UINT64: ("Q", "INTEGER"),
+    FieldDescriptor.CPPTYPE_DOUBLE: ("d", "FLOAT"),
+    FieldDescriptor.CPPTYPE_FLOAT: ("d", "FLOAT"),
+    FieldDescriptor.CPPTYPE_BOOL: ("b", "BOOLEAN"),
+    FieldDescriptor.CPPTYPE_ENUM: ("i", "STRING"),
+}
+
+
+class _Column:
+    """單一 GAQL 欄位的 buffer 與轉換方式。"""
+
+    def __init__(self, path, field):
+        self.path = path
+        self.name = path.replace(".", "_")
+        self.repeated = field.label == FieldDescriptor.LABEL_REPEATED
+        self.enum_names = None
+        self.micros = False
+
+        if field.cpp_type == FieldDescriptor.CPPTYPE_MESSAGE:
+            # 選取的是整個訊息 (少見)，存成 JSON 字串
+            self.typecode, self.bq_type = None, "STRING"
+            self.convert = lambda value: json.dumps(json_format.MessageToDict(value))
+        elif field.cpp_type == FieldDescriptor.CPPTYPE_STRING:
+            self.typecode, self.bq_type = None, "STRING"
+            self.convert = None
+        else:
+            self.typecode, self.bq_type = _SCALAR_TYPES[field.cpp_type]
+            self.convert = None
+            if field.cpp_type == FieldDescriptor.CPPTYPE_ENUM:
+                self.enum_names = {value.number: value.name for value in field.enum_type.values}
+            elif self.name.endswith(MICROS_SUFFIX):
+                # cost_micros → cost (貨幣單位)
+                self.micros = True
+                self.name = self.name[: -len(MICROS_SUFFIX)]
+                self.bq_type = "FLOAT"
+
+        if self.repeated:
+            # repeated 欄位每列是一個 list，逐值轉換 (enum 轉成名稱)
+            item = self.convert
+            if self.enum_names is not None:
+                names = self.enum_names
+                item = lambda value: names.get(value, str(value))
+            self.convert = (lambda values: [item(value) for value in values]) if item else list
+            self.typecode = None
+            if self.micros:
+                self.convert = lambda values: [value / 1_000_000 for value in values]
+
+        self.buffer = array.array(self.typecode) if self.typecode else []
+
+    def extend(self, values):
+        if self.convert is not None:
+            values = map(self.convert, values)
+        self.buffer.extend(values)
+
+    def values(self):
+        if self.typecode is None:
+            return self.buffer
+        data = np.frombuffer(self.buffer, dtype=self.typecode) if len(self.buffer) else np.array([], dtype=self.typecode)
+        if self.micros:
+            return data / 1_000_000
+        if self.enum_names is not None:
+            lookup = np.array(
+                [self.enum_names.get(number, str(number)) for number in range(max(self.enum_names) + 1)],
+                dtype=object,
+            )
+            names = np.full(len(data), "UNKNOWN", dtype=object)
+            known = (data >= 0) & (data < len(lookup))
+            names[known] = lookup[data[known]]
+            return names
+        if self.typecode == "b":
+            return data.astype(bool)
+        return data
+
+    def schema_field(self):
+        return bigquery.SchemaField(self.name, self.bq_type, mode="REPEATED" if self.repeated else "NULLABLE")
+
+
+class GoogleAdsRowConverter:
+    """
+    將 search_stream 的回應轉成欄位資料，例如
+        converter = GoogleAdsRowConverter(["campaign.id", "metrics.cost_micros", "segments.date"], resource="campaign")
+        converter.consume(stream)
+        df = converter.to_dataframe()
+    欄位名稱為 GAQL 欄位以底線連接 (campaign_id)，*_micros 欄位除以 1,000,000 並去掉 _micros 後綴，
+    enum 存成名稱字串。resource 指定時加上 API 一定會回傳的 <resource>.resource_name。
+    """
+
+    def __init__(self, fields, resource=None):
+        fields = list(dict.fromkeys(fields))
+        if resource and f"{resource}.resource_name" not in fields:
+            fields.append(f"{resource}.resource_name")
+        if not fields:
+            raise ValueError("At least one Google Ads field is required.")
+        self.fields = fields
+        self.columns = None
+        self._getter = None
+        self.row_count = 0
+
+    def compile(self, descriptor):
+        """依 GoogleAdsRow 的 descriptor 決定每個欄位的型別並建立取值函式。"""
+        columns = []
+        attributes = []
+        for path in self.fields:
+            message, field, names = descriptor, None, []
+            for part in path.split("."):
+                # 與 Python 保留字同名的欄位 (例如 type) 在 proto-plus 產生的訊息中加上底線 (type_)
+                name = part if message is None or part in message.fields_by_name else f"{part}_"
+                if message is None or name not in message.fields_by_name:
+                    raise ValueError(f"Unknown Google Ads field '{path}'.")
+                field = message.fields_by_name[name]
+                message = field.message_type
+                names.append(name)
+            columns.append(_Column(path, field))
+            attributes.append(".".join(names))
+        self.columns = columns
+
+        getter = operator.attrgetter(*attributes)
+        self._getter = getter if len(attributes) > 1 else (lambda row: (getter(row),))
+
+    def consume(self, stream) -> int:
+        """讀取 SearchGoogleAdsStreamResponse 的 iterator (或 GoogleAdsRow 的 batch)；回傳累計列數。"""
+        pending = []
+        for response in stream:
+            results = getattr(response, "_pb", response).results
+            if not results:
+                continue
+            if self._getter is None:
+                self.compile(results[0].DESCRIPTOR)
+            pending.extend(map(self._getter, results))
+            if len(pending) >= CHUNK_ROWS:
+                self._flush(pending)
+                pending = []
+        self._flush(pending)
+        return self.row_count
+
+    def _flush(self, rows):
+        if not rows:
+            return
+        for column, values in zip(self.columns, zip(*rows)):
+            column.extend(values)
+        self.row_count += len(rows)
+
+    def to_dict(self) -> dict:
+        """{欄位名稱: numpy array 或 list}。"""
+        if self.columns is None:
+            return {}
+        return {column.name: column.values() for column in self.columns}
+
+    def to_dataframe(self) -> pd.DataFrame:
+        return pd.DataFrame(self.to_dict(), copy=False)
+
+    def bigquery_schema(self) -> list:
+        return [column.schema_field() for column in self.columns or []]
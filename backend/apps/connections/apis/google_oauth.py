@@ -18,10 +18,8 @@ from allauth.socialaccount.models import SocialToken, SocialAccount
 from google.oauth2.credentials import Credentials
 from google.ads.googleads.client import GoogleAdsClient
 from google.ads.googleads.errors import GoogleAdsException
-import json
 from django.utils.timezone import make_aware 
 from google.cloud import bigquery
-import pandas as pd
 from ..models import Connection
 from google.auth.transport.requests import Request
 # Relative import for models within the same app 'connections'
@@ -33,6 +31,10 @@ from ..models import (
 # For token refresh
 from requests_oauthlib import OAuth2Session
 from oauthlib.oauth2 import WebApplicationClient
+import grpc
+
+from .google_ads_rows import GoogleAdsRowConverter
+from .rate_limiter import RateLimiter
 
 logger = logging.getLogger(__name__)
 
@@ -248,20 +250,23 @@ def oauth_authorize(request, pk):
 #     except SocialAccount.DoesNotExist:
 #         return JsonResponse({"is_authorized": False, "email": ""})
 
-def build_custom_gaql(config, date_range_str="LAST_30_DAYS"):
-    """
-    Dynamically generates GAQL based on the new connection.config structure.
-    """
-    resource = config.get("resource_name")
-    
+def _ads_rate_limiter(customer_id):
+    return RateLimiter("GOOGLE_ADS", customer=customer_id)
+
+
+def _penalize_if_exhausted(ex, customer_id):
+    """配額用盡 (RESOURCE_EXHAUSTED) 時暫停同一個 customer 的所有請求。"""
+    if ex.error.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
+        _ads_rate_limiter(customer_id).penalize(settings.API_RATE_LIMIT_PENALTY_SECONDS)
+
+
+def selected_gaql_fields(config):
+    """config 中選取的 metrics、segments、attributes 欄位 (一定包含 segments.date)，去除重複並排序。"""
     # 從 config 讀取三種類型的欄位列表
     metrics = config.get("metrics", [])
     segments = config.get("segments", [])
     attributes = config.get("attributes", [])
 
-    if not resource:
-        raise ValueError("Resource name is required to build a GAQL query.")
-        
     # 合併所有欄位
     all_fields = metrics + segments + attributes
 
@@ -271,9 +276,21 @@ def build_custom_gaql(config, date_range_str="LAST_30_DAYS"):
     # 確保 segments.date 總是存在，以進行時間範圍過濾
     if 'segments.date' not in all_fields:
         all_fields.append('segments.date')
+
+    return sorted(set(all_fields))
+
+
+def build_custom_gaql(config, date_range_str="LAST_30_DAYS"):
+    """
+    Dynamically generates GAQL based on the new connection.config structure.
+    """
+    resource = config.get("resource_name")
+
+    if not resource:
+        raise ValueError("Resource name is required to build a GAQL query.")
         
     # 移除重複的欄位並排序，以生成一個乾淨的 SELECT 子句
-    select_clause = ", ".join(sorted(list(set(all_fields))))
+    select_clause = ", ".join(selected_gaql_fields(config))
 
     # 建立最終的查詢
     query = f"SELECT {select_clause} FROM {resource} WHERE segments.date DURING {date_range_str}"
@@ -281,70 +298,41 @@ def build_custom_gaql(config, date_range_str="LAST_30_DAYS"):
     logger.info(f"Built GAQL: {query}")
     return query
 
-def save_results_to_bigquery(results, project_id, dataset_id, table_name):
-    """Saves Google Ads API query results to BigQuery."""
-    if not results:
-        logger.info("No results to save to BigQuery.")
-        return True, "No data returned from Google Ads for the selected period."
 
+def row_converter_for_config(config):
+    """依 connection.config 選取的欄位建立 GoogleAdsRowConverter (與 build_custom_gaql 的 SELECT 相同)。"""
+    return GoogleAdsRowConverter(selected_gaql_fields(config), resource=config.get("resource_name"))
+
+
+def save_results_to_bigquery(results, project_id, dataset_id, table_name, converter):
+    """Saves Google Ads API query results to BigQuery."""
     try:
         client = bigquery.Client(project=project_id)
-        rows_list = []
         # The structure of results from search_stream is different.
         # It's an iterator of SearchGoogleAdsStreamResponse objects.
-        for batch in results:
-            for row in batch.results:
-                # Use json.loads and google.protobuf.json_format to handle conversion
-                row_dict = json.loads(
-                    google_ads_client.get_service("GoogleAdsService")._client.protobuf.json_format.MessageToJson(row._pb)
-                )
-                
-                # Flatten the dictionary
-                flat_row = {}
-                def flatten_dict(d, parent_key='', sep='_'):
-                    items = []
-                    for k, v in d.items():
-                        new_key = parent_key + sep + k if parent_key else k
-                        if isinstance(v, dict):
-                            items.extend(flatten_dict(v, new_key, sep=sep).items())
-                        else:
-                            items.append((new_key, v))
-                    return dict(items)
-
-                flat_row = flatten_dict(row_dict)
-                rows_list.append(flat_row)
-        
-        if not rows_list:
-            logger.info("Query returned results, but processed list is empty.")
-            return True, "Query returned no rows after processing."
+        # 直接從 proto 訊息取值存成欄位資料，micros 欄位換算成貨幣單位 (cost_micros → cost)
+        row_count = converter.consume(results)
 
-        df = pd.DataFrame(rows_list)
-        
-        # Data cleaning and transformation
-        for col in df.columns:
-            if 'costMicros' in col or 'cpcMicros' in col:
-                # The keys will be camelCase from the JSON conversion
-                new_col_name = col.replace('Micros', '')
-                df[new_col_name] = pd.to_numeric(df[col], errors='coerce') / 1_000_000
-                df = df.drop(columns=[col])
-
-        # Standardize column names (snake_case)
-        df.columns = [
-            ''.join(['_' + i.lower() if i.isupper() else i for i in col]).lstrip('_')
-            for col in df.columns
-        ]
+        if not row_count:
+            logger.info("No results to save to BigQuery.")
+            return True, "No data returned from Google Ads for the selected period."
+
+        df = converter.to_dataframe()
 
         table_id = f"{project_id}.{dataset_id}.{table_name}"
         job_config = bigquery.LoadJobConfig(
             write_disposition="WRITE_TRUNCATE",
-            autodetect=True, # Let BigQuery infer the schema
+            schema=converter.bigquery_schema(),  # 型別由 GAQL 欄位的 proto 定義決定
         )
         job = client.load_table_from_dataframe(df, table_id, job_config=job_config)
         job.result() # Wait for the job to complete
-        msg = f"Successfully loaded {len(df)} rows to {table_id}."
+        msg = f"Successfully loaded {row_count} rows to {table_id}."
         logger.info(msg)
         return True, msg
 
+    except GoogleAdsException:
+        # 讀取 stream 時的 API 錯誤交給呼叫端處理 (含配額用盡時的限流)
+        raise
     except Exception as e:
         logger.error(f"Failed to save to BigQuery: {e}", exc_info=True)
         return False, f"Failed to save to BigQuery: {e}"
@@ -363,9 +351,6 @@ def run_custom_gaql_and_save(connection_instance, request=None):
             if not _refresh_user_social_token(social_token, request):
                 return False, "Failed to refresh expired token."
         
-        # Use the global google_ads_client variable defined at the module level
-        global google_ads_client
-        
         google_ads_config = {
             "developer_token": settings.GOOGLE_ADS_DEVELOPER_TOKEN,
             "client_id": social_token.app.client_id,
@@ -375,7 +360,6 @@ def run_custom_gaql_and_save(connection_instance, request=None):
             "use_proto_plus": True
         }
         
-        # Initialize client here to be used in save_results_to_bigquery
         google_ads_client = GoogleAdsClient.load_from_dict(google_ads_config)
         google_ads_service = google_ads_client.get_service("GoogleAdsService")
 
@@ -386,6 +370,7 @@ def run_custom_gaql_and_save(connection_instance, request=None):
         search_request.customer_id = customer_id
         search_request.query = gaql_query
         
+        _ads_rate_limiter(customer_id).acquire()
         stream = google_ads_service.search_stream(request=search_request)
 
         table_name = f"ga_{connection_instance.config.get('resource_name')}_{connection_instance.id.hex[:8]}"
@@ -394,10 +379,12 @@ def run_custom_gaql_and_save(connection_instance, request=None):
             stream,
             settings.GOOGLE_CLOUD_PROJECT_ID,
             connection_instance.target_dataset_id,
-            table_name
+            table_name,
+            row_converter_for_config(connection_instance.config),
         )
 
     except GoogleAdsException as ex:
+        _penalize_if_exhausted(ex, connection_instance.config.get("customer_id"))
         errors = ". ".join([e.message for e in ex.failure.errors])
         logger.error(f"GAQL request failed: {errors}")
         return False, f"Google Ads API Error: {errors}"
@@ -533,6 +520,7 @@ class GoogleAdsAPIClient:
             search_request.customer_id = customer_id
             search_request.query = gaql_query
             
+            _ads_rate_limiter(customer_id).acquire()
             stream = google_ads_service.search_stream(request=search_request)
             table_name = f"ga_custom_{self.connection.id}"
             
@@ -540,9 +528,11 @@ class GoogleAdsAPIClient:
                 stream,
                 settings.GOOGLE_CLOUD_PROJECT_ID,
                 self.connection.target_dataset_id,
-                table_name
+                table_name,
+                row_converter_for_config(self.connection.config),
             )
         except GoogleAdsException as ex:
+            _penalize_if_exhausted(ex, self.connection.config.get("customer_id"))
             errors = ". ".join([e.message for e in ex.failure.errors])
             return False, f"Google Ads API Error: {errors}"
         except Exception as e:
@@ -3,12 +3,15 @@ import logging
 from google.oauth2 import service_account
 from google.api_core.exceptions import NotFound, Forbidden, GoogleAPICallError
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from google.cloud import bigquery
 from django.conf import settings
 import google.auth
 import io
 import csv
 
+from .rate_limiter import RateLimiter
+
 logger = logging.getLogger(__name__)
 
 # 將您的服務帳號金鑰路徑放在 settings.py 中
@@ -62,12 +65,10 @@ class GoogleSheetAPIClient:
                 f"Checking permissions for sheet '{sheet_id}' for service account '{self.service_account_email}'"
             )
             # 請求權限列表
-            permissions = (
-                self.drive_service.files()
-                .get(fileId=sheet_id, fields="permissions(emailAddress,role)")
-                .execute()
-                .get("permissions", [])
-            )
+            permissions = self._execute(
+                self.drive_service.files().get(fileId=sheet_id, fields="permissions(emailAddress,role)"),
+                sheet_id,
+            ).get("permissions", [])
             logger.info(f"Permissions fetched from Drive API for sheet '{sheet_id}': {permissions}")
 
             for p in permissions:
@@ -95,6 +96,17 @@ class GoogleSheetAPIClient:
             )
             return False
 
+    def _execute(self, request, sheet_id: str):
+        """經過跨 worker 的 RateLimiter 送出 Sheets / Drive 請求；429 時暫停同一個 Sheet 的所有請求。"""
+        rate_limiter = RateLimiter("GOOGLE_SHEET", sheet=sheet_id)
+        rate_limiter.acquire()
+        try:
+            return request.execute()
+        except HttpError as e:
+            if e.resp.status == 429:
+                rate_limiter.penalize(settings.API_RATE_LIMIT_PENALTY_SECONDS)
+            raise
+
     def _convert_schema(self, schema_dict):
         # 確保 schema_dict 是一個字典
         if not isinstance(schema_dict, dict):
@@ -178,11 +190,9 @@ class GoogleSheetAPIClient:
         """
         try:
             range_name = f"'{tab_name}'!A2:Z"  # 讀取到最後一欄 Z
-            result = (
-                self.sheets_service.spreadsheets()
-                .values()
-                .get(spreadsheetId=sheet_id, range=range_name)
-                .execute()
+            result = self._execute(
+                self.sheets_service.spreadsheets().values().get(spreadsheetId=sheet_id, range=range_name),
+                sheet_id,
             )
 
             values = result.get("values", [])
@@ -0,0 +1,168 @@
+# apps/connections/apis/rate_limiter.py
+# 跨 worker 的外部 API 限流 (Redis token bucket)
+# 每個外部服務 (Facebook、Google Ads、Google Sheets) 有一個 provider 層級的 bucket，
+# 另外依廣告帳戶 / customer ID / Sheet 各有一個 bucket，設定在 settings.API_RATE_LIMITS。
+# 呼叫 API 前先向所有相關的 bucket 預約 token：token 不足時預約仍然成立，呼叫端 sleep 到輪到自己為止，
+# 多個 worker 同時呼叫時會被平均排開，而不是一起送出後一起收到 429 再一起重試。
+import logging
+import time
+
+from django.conf import settings
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+METRICS_KEY = "ratelimit:metrics:{provider}"
+
+# KEYS: 各 bucket 的 key..., metrics key (最後一個)
+# ARGV: now, max_wait, ttl, tokens, 之後每個 bucket 兩個值 (每秒補充的 token 數, 容量)
+# 回傳 {是否預約成功, 需要等待的秒數 (字串，避免 Lua number 被截成整數)}
+_RESERVE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local max_wait = tonumber(ARGV[2])
+local ttl = tonumber(ARGV[3])
+local requested = tonumber(ARGV[4])
+local n = #KEYS - 1
+local metrics = KEYS[n + 1]
+local levels = {}
+local wait = 0
+for i = 1, n do
+    local rate = tonumber(ARGV[3 + i * 2])
+    local capacity = tonumber(ARGV[4 + i * 2])
+    local state = redis.call('HMGET', KEYS[i], 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or capacity
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate) - requested
+    levels[i] = tokens
+    if tokens < 0 then
+        wait = math.max(wait, -tokens / rate)
+    end
+end
+if wait > max_wait then
+    redis.call('HINCRBY', metrics, 'rejected', 1)
+    return {0, tostring(wait)}
+end
+for i = 1, n do
+    redis.call('HSET', KEYS[i], 'tokens', tostring(levels[i]), 'ts', tostring(now))
+    redis.call('EXPIRE', KEYS[i], ttl)
+end
+redis.call('HINCRBY', metrics, 'calls', 1)
+if wait > 0 then
+    redis.call('HINCRBY', metrics, 'throttled', 1)
+    redis.call('HINCRBYFLOAT', metrics, 'wait_seconds', tostring(wait))
+    local max_seen = tonumber(redis.call('HGET', metrics, 'max_wait_seconds') or '0')
+    if wait > max_seen then
+        redis.call('HSET', metrics, 'max_wait_seconds', tostring(wait))
+    end
+end
+return {1, tostring(wait)}
+"""
+
+
+class RateLimitExceeded(Exception):
+    """需要等待的時間超過 API_RATE_LIMIT_MAX_WAIT，呼叫端應該稍後再試。"""
+
+
+class RateLimiter:
+    """
+    一組 token bucket：provider 本身，加上 scopes 中有設定上限的範圍，例如
+    RateLimiter("FACEBOOK_ADS", account="act_123")、RateLimiter("GOOGLE_SHEET", sheet=sheet_id)。
+    Redis 無法使用時不阻擋呼叫 (與 main/concurrency.py 相同，降級為不限制)。
+    """
+
+    def __init__(self, provider: str, redis=None, **scopes):
+        self.provider = provider
+        self._redis = redis
+        self._script = None
+        limits = settings.API_RATE_LIMITS.get(provider, {})
+        # (key, 每秒補充的 token 數, 容量)；由大範圍到小範圍
+        self.buckets = []
+        if "provider" in limits:
+            self.buckets.append((f"ratelimit:{provider}", *limits["provider"]))
+        for scope, value in scopes.items():
+            if value and scope in limits:
+                self.buckets.append((f"ratelimit:{provider}:{scope}:{value}", *limits[scope]))
+        # 是否有比 provider 更小範圍的 bucket；沒有時 penalize() 預設的最小範圍就是整個 provider
+        self.scoped = len(self.buckets) > ("provider" in limits)
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = get_redis_connection("default")
+        return self._redis
+
+    def acquire(self, tokens: int = 1) -> float:
+        """預約 tokens，需要時 sleep 到可以呼叫為止；回傳等待的秒數。"""
+        if not settings.API_RATE_LIMIT_ENABLED or not self.buckets:
+            return 0.0
+        try:
+            if self._script is None:
+                self._script = self.redis.register_script(_RESERVE_SCRIPT)
+            args = [time.time(), settings.API_RATE_LIMIT_MAX_WAIT, self._ttl(), tokens]
+            for _, rate, capacity in self.buckets:
+                args.extend([rate, capacity])
+            allowed, wait = self._script(
+                keys=[key for key, _, _ in self.buckets] + [METRICS_KEY.format(provider=self.provider)],
+                args=args,
+            )
+            wait = float(wait)
+        except Exception as e:
+            logger.warning(f"Rate limiter for {self.provider} unavailable, calling without limits: {e}")
+            return 0.0
+
+        if not int(allowed):
+            raise RateLimitExceeded(
+                f"{self.provider} rate limit requires waiting {wait:.0f}s "
+                f"(more than API_RATE_LIMIT_MAX_WAIT={settings.API_RATE_LIMIT_MAX_WAIT}s)"
+            )
+        if wait > 0:
+            if wait >= 1:
+                logger.info(f"Rate limited {self.provider} call, waiting {wait:.1f}s ({self.buckets[-1][0]})")
+            time.sleep(wait)
+        return wait
+
+    def penalize(self, seconds: float, provider_wide: bool = False):
+        """
+        收到 429 / 限流錯誤時讓所有 worker 一起暫停：將 bucket 的 token 扣到 seconds 秒後才恢復。
+        預設只影響最小範圍的 bucket (例如單一廣告帳戶)，provider_wide 時影響所有 bucket。
+        """
+        if not settings.API_RATE_LIMIT_ENABLED or not self.buckets:
+            return
+        buckets = self.buckets if provider_wide else self.buckets[-1:]
+        try:
+            now = time.time()
+            pipe = self.redis.pipeline()
+            for key, rate, _ in buckets:
+                pipe.hset(key, mapping={"tokens": -rate * seconds, "ts": now})
+                pipe.expire(key, self._ttl() + int(seconds))
+            pipe.hincrby(METRICS_KEY.format(provider=self.provider), "penalties", 1)
+            pipe.execute()
+            logger.warning(f"{self.provider} rate limit hit, pausing {', '.join(key for key, _, _ in buckets)} for {seconds:.0f}s")
+        except Exception as e:
+            logger.warning(f"Failed to apply rate limit penalty for {self.provider}: {e}")
+
+    def _ttl(self) -> int:
+        # 閒置超過完全補滿所需的時間後，bucket 的狀態就不再需要
+        return int(max(capacity / rate for _, rate, capacity in self.buckets)) + 60
+
+
+def rate_limit_metrics(redis=None) -> dict:
+    """
+    各 provider 的限流統計：calls (預約次數)、throttled (需要等待的次數)、rejected (等待過久被拒絕)、
+    penalties (收到限流錯誤)、wait_seconds (累計等待秒數)、max_wait_seconds、avg_wait_seconds。
+    """
+    redis = redis or get_redis_connection("default")
+    metrics = {}
+    for provider in settings.API_RATE_LIMITS:
+        raw = redis.hgetall(METRICS_KEY.format(provider=provider))
+        values = {key.decode() if isinstance(key, bytes) else key: float(value) for key, value in raw.items()}
+        stats = {name: values.get(name, 0.0) for name in
+                 ("calls", "throttled", "rejected", "penalties", "wait_seconds", "max_wait_seconds")}
+        stats["avg_wait_seconds"] = stats["wait_seconds"] / stats["throttled"] if stats["throttled"] else 0.0
+        metrics[provider] = stats
+    return metrics
+
+
+def reset_rate_limit_metrics(redis=None):
+    redis = redis or get_redis_connection("default")
+    redis.delete(*[METRICS_KEY.format(provider=provider) for provider in settings.API_RATE_LIMITS])
@@ -0,0 +1,148 @@
+# apps/connections/management/commands/benchmark_google_ads_rows.py
+
+import importlib
+import json
+import random
+import resource
+import time
+
+import pandas as pd
+from django.core.management.base import BaseCommand
+from google.ads.googleads.client import _DEFAULT_VERSION
+from google.protobuf import json_format
+
+from apps.connections.apis.google_ads_rows import GoogleAdsRowConverter
+
+RESOURCE = "ad_group"
+FIELDS = [
+    "ad_group.id",
+    "ad_group.name",
+    "ad_group.status",
+    "campaign.id",
+    "campaign.name",
+    "metrics.average_cpc",
+    "metrics.clicks",
+    "metrics.conversions",
+    "metrics.cost_micros",
+    "metrics.impressions",
+    "segments.date",
+    "segments.device",
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmark converting a synthetic Google Ads search_stream (default 1M rows) into a DataFrame: "
+        "GoogleAdsRowConverter versus the previous MessageToJson / flatten / pandas rename path."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, default=1_000_000, help="Rows in the synthetic stream")
+        parser.add_argument("--batch-size", type=int, default=10_000, help="Rows per SearchGoogleAdsStreamResponse")
+        parser.add_argument(
+            "--legacy-rows", type=int, default=100_000,
+            help="Rows to run through the previous conversion (0 to skip); the 1M-row time is extrapolated",
+        )
+        parser.add_argument("--api-version", default=_DEFAULT_VERSION)
+
+    def handle(self, *args, **options):
+        service_types = importlib.import_module(
+            f"google.ads.googleads.{options['api_version']}.services.types.google_ads_service"
+        )
+        batches = self._build_batches(service_types, options["batch_size"])
+        rows = options["rows"]
+        self.stdout.write(
+            f"Synthetic stream: {rows} rows in batches of {options['batch_size']}, "
+            f"{len(FIELDS)} fields from {RESOURCE} ({options['api_version']})"
+        )
+
+        start = time.perf_counter()
+        converter = GoogleAdsRowConverter(FIELDS, resource=RESOURCE)
+        converter.consume(self._stream(batches, rows))
+        consumed = time.perf_counter()
+        df = converter.to_dataframe()
+        elapsed = time.perf_counter() - start
+        self.stdout.write(
+            f"converter: {len(df)} rows in {elapsed:.2f}s ({len(df) / elapsed:,.0f} rows/s; "
+            f"consume {consumed - start:.2f}s, columns {elapsed - (consumed - start):.2f}s), "
+            f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB"
+        )
+        self.stdout.write(str(df.dtypes.to_dict()))
+
+        legacy_rows = min(options["legacy_rows"], rows)
+        if legacy_rows:
+            start = time.perf_counter()
+            legacy_df = self._legacy_convert(self._stream(batches, legacy_rows))
+            legacy_elapsed = time.perf_counter() - start
+            rate = len(legacy_df) / legacy_elapsed
+            self.stdout.write(
+                f"legacy:    {len(legacy_df)} rows in {legacy_elapsed:.2f}s ({rate:,.0f} rows/s, "
+                f"~{rows / rate:.1f}s for {rows} rows)"
+            )
+            self.stdout.write(self.style.SUCCESS(f"speedup: {(len(df) / elapsed) / rate:.1f}x"))
+
+    @staticmethod
+    def _build_batches(service_types, batch_size, distinct=4):
+        """建立幾個不同內容的 batch，stream 輪流送出 (避免為 1M 列各自建立 proto 訊息)。"""
+        rng = random.Random(0)
+        batches = []
+        for _ in range(distinct):
+            response = service_types.SearchGoogleAdsStreamResponse.pb()()
+            for _ in range(batch_size):
+                row = response.results.add()
+                ad_group_id = rng.randrange(10**9, 10**10)
+                row.ad_group.resource_name = f"customers/1234567890/adGroups/{ad_group_id}"
+                row.ad_group.id = ad_group_id
+                row.ad_group.name = f"Ad group {ad_group_id % 1000}"
+                row.ad_group.status = rng.choice([2, 3])
+                row.campaign.id = rng.randrange(10**9, 10**10)
+                row.campaign.name = f"Campaign {row.campaign.id % 100}"
+                row.metrics.impressions = rng.randrange(0, 100_000)
+                row.metrics.clicks = rng.randrange(0, 1_000)
+                row.metrics.cost_micros = rng.randrange(0, 50_000_000_000)
+                row.metrics.conversions = rng.random() * 20
+                row.metrics.average_cpc = rng.random() * 5_000_000
+                row.segments.date = f"2024-{rng.randrange(1, 13):02d}-{rng.randrange(1, 29):02d}"
+                row.segments.device = rng.choice([2, 3, 4])
+            batches.append(service_types.SearchGoogleAdsStreamResponse.wrap(response))
+        return batches
+
+    @staticmethod
+    def _stream(batches, rows):
+        batch_size = len(batches[0].results)
+        for index in range(rows // batch_size):
+            yield batches[index % len(batches)]
+        remainder = rows % batch_size
+        if remainder:
+            response = type(batches[0]).pb()()
+            response.results.extend(list(batches[0]._pb.results)[:remainder])
+            yield type(batches[0]).wrap(response)
+
+    @staticmethod
+    def _legacy_convert(stream):
+        """先前 save_results_to_bigquery 的轉換方式 (逐列 MessageToJson → json.loads → 攤平 → pandas 改名)。"""
+        def flatten_dict(d, parent_key='', sep='_'):
+            items = []
+            for k, v in d.items():
+                new_key = parent_key + sep + k if parent_key else k
+                if isinstance(v, dict):
+                    items.extend(flatten_dict(v, new_key, sep=sep).items())
+                else:
+                    items.append((new_key, v))
+            return dict(items)
+
+        rows_list = []
+        for batch in stream:
+            for row in batch.results:
+                rows_list.append(flatten_dict(json.loads(json_format.MessageToJson(row._pb))))
+
+        df = pd.DataFrame(rows_list)
+        for col in df.columns:
+            if 'costMicros' in col or 'cpcMicros' in col:
+                df[col.replace('Micros', '')] = pd.to_numeric(df[col], errors='coerce') / 1_000_000
+                df = df.drop(columns=[col])
+        df.columns = [
+            ''.join(['_' + i.lower() if i.isupper() else i for i in col]).lstrip('_')
+            for col in df.columns
+        ]
+        return df
@@ -0,0 +1,36 @@
+# apps/connections/management/commands/rate_limit_stats.py
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.connections.apis.rate_limiter import rate_limit_metrics, reset_rate_limit_metrics
+
+
+class Command(BaseCommand):
+    help = (
+        "Show how long provider API calls waited on the cluster-wide rate limiter "
+        "(calls, throttled calls, rejected calls, rate-limit penalties and wait times)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true", help="Reset the counters after printing them")
+
+    def handle(self, *args, **options):
+        if not settings.API_RATE_LIMIT_ENABLED:
+            self.stdout.write(self.style.WARNING("API_RATE_LIMIT_ENABLED is off; calls are not being limited."))
+
+        metrics = rate_limit_metrics()
+        self.stdout.write(
+            f"{'provider':<14} {'calls':>9} {'throttled':>9} {'rejected':>8} {'penalties':>9} "
+            f"{'wait total':>11} {'wait avg':>9} {'wait max':>9}"
+        )
+        for provider, stats in metrics.items():
+            self.stdout.write(
+                f"{provider:<14} {stats['calls']:>9.0f} {stats['throttled']:>9.0f} {stats['rejected']:>8.0f} "
+                f"{stats['penalties']:>9.0f} {stats['wait_seconds']:>10.1f}s {stats['avg_wait_seconds']:>8.2f}s "
+                f"{stats['max_wait_seconds']:>8.2f}s"
+            )
+
+        if options["reset"]:
+            reset_rate_limit_metrics()
+            self.stdout.write("Counters reset.")
@@ -0,0 +1,129 @@
+# Generated by Django 5.2.1 on 2026-10-17 03:28
+
+import calendar
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+SYNC_FREQUENCIES = ("daily", "weekly", "monthly")
+SCHEDULE_FIELDS = ["sync_frequency", "sync_hour", "sync_minute", "sync_day_of_week", "sync_day_of_month", "next_sync_at"]
+
+
+def parse_schedule_config(config):
+    """config → 排程欄位 (此 migration 當時的規則；不引用目前的 Connection 模型)。"""
+    config = config or {}
+    schedule = {
+        "sync_frequency": "once",
+        "sync_hour": 0,
+        "sync_minute": 0,
+        "sync_day_of_week": None,
+        "sync_day_of_month": None,
+    }
+    frequency = str(config.get("sync_frequency") or "once").lower()
+    if frequency not in SYNC_FREQUENCIES:
+        return schedule
+    try:
+        hour = int(config.get("sync_hour", 0) or 0)
+        minute = int(config.get("sync_minute", 0) or 0)
+        day_of_week = int(config.get("weekly_day_of_week", 1)) if frequency == "weekly" else None
+        day_of_month = int(config.get("monthly_day_of_month", 1)) if frequency == "monthly" else None
+    except (ValueError, TypeError):
+        return schedule
+    if not (0 <= hour <= 23 and 0 <= minute <= 59) \
+            or (day_of_week is not None and not 0 <= day_of_week <= 6) \
+            or (day_of_month is not None and not 1 <= day_of_month <= 31):
+        return schedule
+    schedule.update(
+        sync_frequency=frequency,
+        sync_hour=hour,
+        sync_minute=minute,
+        sync_day_of_week=day_of_week,
+        sync_day_of_month=day_of_month,
+    )
+    return schedule
+
+
+def compute_next_sync_at(connection, after):
+    """after 之後 (不含) 的下一次同步時間；不排程或未啟用時回傳 None。"""
+    if not connection.is_enabled or connection.sync_frequency not in SYNC_FREQUENCIES:
+        return None
+    local_after = timezone.localtime(after)
+    day = local_after.date()
+    for _ in range(63):
+        if connection.sync_frequency == "weekly":
+            # date.weekday(): 週一=0；sync_day_of_week: 週日=0
+            matches = (day.weekday() + 1) % 7 == connection.sync_day_of_week
+        elif connection.sync_frequency == "monthly":
+            matches = day.day == min(connection.sync_day_of_month, calendar.monthrange(day.year, day.month)[1])
+        else:
+            matches = True
+        if matches:
+            candidate = datetime(
+                day.year, day.month, day.day, connection.sync_hour, connection.sync_minute, tzinfo=local_after.tzinfo
+            )
+            if candidate > local_after:
+                return candidate
+        day += timedelta(days=1)
+    return None
+
+
+def backfill_sync_schedule(apps, schema_editor):
+    """由既有的 config 填入排程欄位並計算 next_sync_at (只使用歷史模型)。"""
+    Connection = apps.get_model("connections", "Connection")
+    now = timezone.now()
+    for connection in Connection.objects.iterator():
+        for field, value in parse_schedule_config(connection.config).items():
+            setattr(connection, field, value)
+        connection.next_sync_at = compute_next_sync_at(connection, now)
+        connection.save(update_fields=SCHEDULE_FIELDS)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clients', '0005_client_bytes_budgets'),
+        ('connections', '0004_alter_connection_social_account'),
+        ('socialaccount', '0006_alter_socialaccount_extra_data'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='next_sync_at',
+            field=models.DateTimeField(blank=True, help_text='Next scheduled sync, maintained on save and by the scheduler', null=True),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='sync_day_of_month',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='1-31, clamped to the last day of shorter months (monthly)', null=True),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='sync_day_of_week',
+            field=models.PositiveSmallIntegerField(blank=True, help_text='0=Sunday ... 6=Saturday (weekly)', null=True),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='sync_frequency',
+            field=models.CharField(choices=[('once', 'Once'), ('daily', 'Daily'), ('weekly', 'Weekly'), ('monthly', 'Monthly')], default='once', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='sync_hour',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='sync_minute',
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(condition=models.Q(('is_enabled', True)), fields=['next_sync_at'], name='connection_next_sync_idx'),
+        ),
+        migrations.RunPython(backfill_sync_schedule, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 03:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connections', '0005_connection_sync_schedule'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='sync_window_minutes',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Spread the sync over this many minutes after the scheduled time'),
+        ),
+    ]
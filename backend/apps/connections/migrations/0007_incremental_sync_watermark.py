@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 03:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connections', '0006_sync_window'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='sync_watermark',
+            field=models.DateField(blank=True, help_text='Last fully synced day of an incremental sync', null=True),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 04:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connections', '0007_incremental_sync_watermark'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='connectionexecution',
+            name='status',
+            field=models.CharField(choices=[('RUNNING', 'Running'), ('RETRYING', 'Retrying'), ('SUCCESS', 'Success'), ('FAILED', 'Failed')], max_length=20),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 5.2.1 on 2026-10-17 04:11
+
+import calendar
+import hashlib
+from datetime import datetime, timedelta
+
+from django.db import migrations
+from django.utils import timezone
+
+SYNC_FREQUENCIES = ("daily", "weekly", "monthly")
+MAX_SCHEDULE_WINDOW_MINUTES = 24 * 60 - 1
+
+
+def parse_window_minutes(value):
+    try:
+        minutes = int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+    return max(0, min(minutes, MAX_SCHEDULE_WINDOW_MINUTES))
+
+
+def window_offset(pk, window_minutes):
+    """與 main.scheduling.window_offset 相同的偏移 (key = connection:<pk>)，在此固定下來。"""
+    if not window_minutes:
+        return timedelta(0)
+    digest = hashlib.sha1(f"connection:{pk}".encode("utf-8")).digest()
+    return timedelta(minutes=int.from_bytes(digest[:8], "big") % window_minutes)
+
+
+def compute_next_sync_at(connection, after):
+    """after 之後 (不含) 的下一次同步時間，含時間窗偏移；不排程或未啟用時回傳 None。"""
+    if not connection.is_enabled or connection.sync_frequency not in SYNC_FREQUENCIES:
+        return None
+    local_after = timezone.localtime(after)
+    offset = window_offset(connection.pk, connection.sync_window_minutes)
+    # 時間窗可能跨過午夜，從前一天開始找
+    day = local_after.date() - timedelta(days=1)
+    for _ in range(63):
+        if connection.sync_frequency == "weekly":
+            # date.weekday(): 週一=0；sync_day_of_week: 週日=0
+            matches = (day.weekday() + 1) % 7 == connection.sync_day_of_week
+        elif connection.sync_frequency == "monthly":
+            matches = day.day == min(connection.sync_day_of_month, calendar.monthrange(day.year, day.month)[1])
+        else:
+            matches = True
+        if matches:
+            candidate = datetime(
+                day.year, day.month, day.day, connection.sync_hour, connection.sync_minute, tzinfo=local_after.tzinfo
+            ) + offset
+            if candidate > local_after:
+                return candidate
+        day += timedelta(days=1)
+    return None
+
+
+def backfill_sync_window(apps, schema_editor):
+    """由既有的 config.sync_window_minutes 填入 sync_window_minutes，並以時間窗重新計算 next_sync_at。"""
+    Connection = apps.get_model("connections", "Connection")
+    now = timezone.now()
+    for connection in Connection.objects.filter(sync_frequency__in=SYNC_FREQUENCIES).iterator():
+        connection.sync_window_minutes = parse_window_minutes((connection.config or {}).get("sync_window_minutes"))
+        connection.next_sync_at = compute_next_sync_at(connection, now)
+        connection.save(update_fields=["sync_window_minutes", "next_sync_at"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('connections', '0008_execution_retrying_status'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_sync_window, migrations.RunPython.noop),
+    ]
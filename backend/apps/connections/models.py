@@ -1,3 +1,7 @@
+import calendar
+import logging
+from datetime import datetime, timedelta
+
 from django.db import models
 from django.conf import settings # To get the User model
 from django.contrib.auth.models import User
@@ -6,9 +10,14 @@ from apps.clients.models import Client
 import json
 import pytz
 from django.core.cache import cache
+from django.utils import timezone as dj_timezone
+
+from main.scheduling import parse_window_minutes, window_offset
 
 timezone = pytz.timezone('Asia/Taipei')
 
+logger = logging.getLogger(__name__)
+
 class DataSource(models.Model):
     """儲存支援的資料來源類型，方便管理"""
     SOURCE_CHOICES = [
@@ -63,6 +72,17 @@ class Connection(models.Model):
         ('SYNCING', 'Syncing'),   # 同步中
         ('ERROR', 'Error'),       # 發生錯誤
     ]
+    SYNC_FREQUENCY_CHOICES = [
+        ('once', 'Once'),         # 只在建立時同步一次，不排程
+        ('daily', 'Daily'),
+        ('weekly', 'Weekly'),
+        ('monthly', 'Monthly'),
+    ]
+    # 前端把排程存在 config 中；儲存時同步到下列欄位
+    SCHEDULE_FIELDS = [
+        'sync_frequency', 'sync_hour', 'sync_minute', 'sync_day_of_week', 'sync_day_of_month',
+        'sync_window_minutes', 'next_sync_at',
+    ]
     
     # --- Core Columns ---
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
@@ -92,6 +112,20 @@ class Connection(models.Model):
         help_text="控制此連線的排程是否啟用 (On/Off)"
     )
 
+    # --- Schedule (settings.TIME_ZONE 的當地時間) ---
+    sync_frequency = models.CharField(max_length=10, choices=SYNC_FREQUENCY_CHOICES, default='once')
+    sync_hour = models.PositiveSmallIntegerField(default=0)
+    sync_minute = models.PositiveSmallIntegerField(default=0)
+    sync_day_of_week = models.PositiveSmallIntegerField(null=True, blank=True, help_text="0=Sunday ... 6=Saturday (weekly)")
+    sync_day_of_month = models.PositiveSmallIntegerField(null=True, blank=True, help_text="1-31, clamped to the last day of shorter months (monthly)")
+    # 時間窗：實際同步時間為設定時間之後 [0, N) 分鐘內固定的某一分鐘，0 表示準時執行
+    sync_window_minutes = models.PositiveSmallIntegerField(default=0, help_text="Spread the sync over this many minutes after the scheduled time")
+    next_sync_at = models.DateTimeField(null=True, blank=True, help_text="Next scheduled sync, maintained on save and by the scheduler")
+
+    # --- Incremental sync ---
+    # 增量同步 (config.sync_mode = "incremental") 已完整同步的最後一天 (settings.TIME_ZONE 的日期)
+    sync_watermark = models.DateField(null=True, blank=True, help_text="Last fully synced day of an incremental sync")
+
     # --- Timestamp ---
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -106,10 +140,142 @@ class Connection(models.Model):
 
     class Meta:
         unique_together = ['user', 'data_source', 'display_name']
+        indexes = [
+            models.Index(
+                fields=['next_sync_at'],
+                name='connection_next_sync_idx',
+                condition=models.Q(is_enabled=True),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.display_name} ({self.data_source.get_name_display()})"
+
+    @staticmethod
+    def parse_schedule_config(config):
+        """
+        將 config 中的 sync_frequency / sync_hour / sync_minute / weekly_day_of_week / monthly_day_of_month
+        轉成排程欄位的值。格式錯誤時視為不排程 (once)。
+        """
+        config = config or {}
+        schedule = {
+            'sync_frequency': 'once',
+            'sync_hour': 0,
+            'sync_minute': 0,
+            'sync_day_of_week': None,
+            'sync_day_of_month': None,
+            'sync_window_minutes': 0,
+        }
+        # 前端送來的是 "Daily" / "Weekly"...，舊資料則是小寫
+        frequency = str(config.get('sync_frequency') or 'once').lower()
+        if frequency not in dict(Connection.SYNC_FREQUENCY_CHOICES) or frequency == 'once':
+            return schedule
+        try:
+            hour = int(config.get('sync_hour', 0) or 0)
+            minute = int(config.get('sync_minute', 0) or 0)
+            day_of_week = int(config.get('weekly_day_of_week', 1)) if frequency == 'weekly' else None
+            day_of_month = int(config.get('monthly_day_of_month', 1)) if frequency == 'monthly' else None
+        except (ValueError, TypeError):
+            logger.error(f"Could not parse schedule config: {config}")
+            return schedule
+        if not (0 <= hour <= 23 and 0 <= minute <= 59) \
+                or (day_of_week is not None and not 0 <= day_of_week <= 6) \
+                or (day_of_month is not None and not 1 <= day_of_month <= 31):
+            logger.error(f"Schedule config out of range: {config}")
+            return schedule
+        schedule.update(
+            sync_frequency=frequency,
+            sync_hour=hour,
+            sync_minute=minute,
+            sync_day_of_week=day_of_week,
+            sync_day_of_month=day_of_month,
+            sync_window_minutes=parse_window_minutes(config.get('sync_window_minutes')),
+        )
+        return schedule
+
+    def compute_next_sync_at(self, after=None):
+        """依排程欄位計算 after 之後 (不含) 的下一次同步時間；不排程或未啟用時回傳 None。"""
+        if not self.is_enabled or self.sync_frequency not in ('daily', 'weekly', 'monthly'):
+            return None
+        local_after = dj_timezone.localtime(after or dj_timezone.now())
+        tz = local_after.tzinfo
+        offset = self.schedule_offset()
+        # 時間窗可能跨過午夜，從前一天開始找；最多往後找兩個月即可涵蓋所有 monthly 的情況
+        day = local_after.date() - timedelta(days=1)
+        for _ in range(63):
+            if self.sync_frequency == 'weekly':
+                # date.weekday(): 週一=0；sync_day_of_week 與前端/cron 相同: 週日=0
+                matches = (day.weekday() + 1) % 7 == self.sync_day_of_week
+            elif self.sync_frequency == 'monthly':
+                last_day = calendar.monthrange(day.year, day.month)[1]
+                matches = day.day == min(self.sync_day_of_month, last_day)
+            else:
+                matches = True
+            if matches:
+                candidate = datetime(day.year, day.month, day.day, self.sync_hour, self.sync_minute, tzinfo=tz) + offset
+                if candidate > local_after:
+                    return candidate
+            day += timedelta(days=1)
+        return None
+
+    def schedule_offset(self):
+        """時間窗內固定的偏移；新建尚未有 pk 時為 0，save 後會重新計算。"""
+        if not self.pk:
+            return timedelta(0)
+        return window_offset(f"connection:{self.pk}", self.sync_window_minutes)
+
+    def schedule_next_sync(self, after=None):
+        """重新計算 next_sync_at (不會儲存)。"""
+        self.next_sync_at = self.compute_next_sync_at(after)
+        return self.next_sync_at
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or {'config', 'is_enabled'} & set(update_fields):
+            schedule = self.parse_schedule_config(self.config)
+            changed = any(getattr(self, field) != value for field, value in schedule.items())
+            for field, value in schedule.items():
+                setattr(self, field, value)
+            if not self.is_enabled:
+                self.next_sync_at = None
+            elif changed or self.next_sync_at is None:
+                self.schedule_next_sync()
+            if update_fields is not None:
+                kwargs['update_fields'] = set(update_fields) | set(self.SCHEDULE_FIELDS)
+        is_new = self.pk is None
+        super().save(*args, **kwargs)
+        if is_new and self.next_sync_at and self.schedule_offset():
+            # 有 pk 之後才能決定在時間窗內的位置
+            self.schedule_next_sync()
+            super().save(update_fields=['next_sync_at'])
     
+    def incremental_sync_range(self, today=None):
+        """
+        增量同步這次要抓取的日期範圍 (since, until)，非增量模式回傳 None。
+        - 已有 watermark：從 watermark 隔天開始，再往前回補 attribution_lookback_days 天
+          (轉換歸因會在事後回頭修改近幾天的數字)
+        - 首次同步 (或清除 watermark 後)：往前抓 initial_sync_days 天
+        - until 為今天；今天的資料尚未完整，watermark 只會推進到昨天，下次同步會重新抓取
+        """
+        config = self.config or {}
+        if str(config.get('sync_mode') or '').lower() != 'incremental':
+            return None
+        today = today or dj_timezone.localdate()
+
+        def _days(key, default):
+            try:
+                return max(0, int(config.get(key, default)))
+            except (TypeError, ValueError):
+                return default
+
+        if self.sync_watermark:
+            lookback = _days('attribution_lookback_days', settings.FACEBOOK_ATTRIBUTION_LOOKBACK_DAYS)
+            since = self.sync_watermark + timedelta(days=1) - timedelta(days=lookback)
+        else:
+            initial_days = _days('initial_sync_days', settings.INCREMENTAL_SYNC_INITIAL_DAYS)
+            since = today - timedelta(days=max(1, initial_days) - 1)
+        return min(since, today), today
+
     def get_last_execution_cached(self):
         """
         獲取最近一次執行紀錄並快取。
@@ -152,6 +318,7 @@ class Connection(models.Model):
 class ConnectionExecution(models.Model):
     STATUS_CHOICES = [
         ('RUNNING', 'Running'),
+        ('RETRYING', 'Retrying'),  # 失敗後等待重試，仍視為執行中
         ('SUCCESS', 'Success'),
         ('FAILED', 'Failed'),
     ]
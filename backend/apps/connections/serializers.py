@@ -94,8 +94,10 @@ class ConnectionSerializer(serializers.ModelSerializer):
             'last_execution_status',
             'last_execution_time',
             'social_account_id', # 加入到 fields 列表中
+            'next_sync_at',
+            'sync_watermark',
         ]
-        read_only_fields = ['status', 'created_at', 'updated_at']
+        read_only_fields = ['status', 'created_at', 'updated_at', 'next_sync_at', 'sync_watermark']
     
     def create(self, validated_data):
         """
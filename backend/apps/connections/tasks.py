@@ -1,16 +1,23 @@
 import logging
-from celery import shared_task
+import sys
+import time
+from datetime import timedelta
+
+from celery import group, shared_task
+from celery.exceptions import Retry
 from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
 from django.contrib.auth.models import User
 from google.cloud import bigquery
 from google.api_core.exceptions import NotFound
 
-from .apis.facebook_ads import FacebookAdsAPIClient
+from .apis.facebook_ads import FacebookAdsAPIClient, FacebookBatchExtractor
 from .apis.google_oauth import GoogleAdsAPIClient
 from .apis.google_sheet import GoogleSheetAPIClient
 
 from apps.clients.models import Client, ClientSocialAccount 
+from main.concurrency import ConcurrencyLimitReached, InflightLock, defer_task, task_slots
 from .models import Connection, ConnectionExecution
 from allauth.socialaccount.models import SocialToken, SocialAccount
 
@@ -19,44 +26,48 @@ logger = logging.getLogger(__name__)
 
 
 # --- API 客戶端工廠  ---
+def _facebook_token(connection):
+    """取得 Connection 所屬 Client 連結的 Facebook access token。"""
+    # 1. 確認 connection 有關聯到 client
+    if not connection.client:
+        raise Exception(
+            f"Connection {connection.id} is not linked to a Client."
+        )
+    
+    # 2. 嘗試從 ClientSocialAccount 中找到與該 client 和 Facebook 相關聯的 SocialAccount
+    try:
+        client_social_account_link = ClientSocialAccount.objects.get(
+            client=connection.client,
+            social_account__provider="facebook"
+        )
+        social_account = client_social_account_link.social_account
+        
+        # 3. 獲取該 SocialAccount 對應的 SocialToken
+        token_obj = SocialToken.objects.get(
+            account=social_account,
+            app__provider="facebook" # 再次確認提供者
+        )
+    except ClientSocialAccount.DoesNotExist:
+        raise Exception(
+            f"Client '{connection.client.name}' (ID: {connection.client.id}) is not linked to a Facebook social account via ClientSocialAccount."
+        )
+    except SocialToken.DoesNotExist:
+        raise Exception(
+            f"Facebook SocialToken not found for account {social_account.uid}. Please ensure the client has been properly authorized with Facebook."
+        )
+    except Exception as e:
+        logger.error(f"Error fetching Facebook social account/token for connection {connection.id}: {e}", exc_info=True)
+        raise Exception(f"Failed to retrieve Facebook authorization. Error: {e}")
+    return token_obj.token
+
+
 def get_api_client(connection):
     source_name = connection.data_source.name
     if source_name == "FACEBOOK_ADS":
-        # 1. 確認 connection 有關聯到 client
-        if not connection.client:
-            raise Exception(
-                f"Connection {connection.id} is not linked to a Client."
-            )
-        
-        # 2. 嘗試從 ClientSocialAccount 中找到與該 client 和 Facebook 相關聯的 SocialAccount
-        try:
-            client_social_account_link = ClientSocialAccount.objects.get(
-                client=connection.client,
-                social_account__provider="facebook"
-            )
-            social_account = client_social_account_link.social_account
-            
-            # 3. 獲取該 SocialAccount 對應的 SocialToken
-            token_obj = SocialToken.objects.get(
-                account=social_account,
-                app__provider="facebook" # 再次確認提供者
-            )
-        except ClientSocialAccount.DoesNotExist:
-            raise Exception(
-                f"Client '{connection.client.name}' (ID: {connection.client.id}) is not linked to a Facebook social account via ClientSocialAccount."
-            )
-        except SocialToken.DoesNotExist:
-            raise Exception(
-                f"Facebook SocialToken not found for account {social_account.uid}. Please ensure the client has been properly authorized with Facebook."
-            )
-        except Exception as e:
-            logger.error(f"Error fetching Facebook social account/token for connection {connection.id}: {e}", exc_info=True)
-            raise Exception(f"Failed to retrieve Facebook authorization. Error: {e}")
-
         return FacebookAdsAPIClient(
             app_id=settings.FACEBOOK_APP_ID,
             app_secret=settings.FACEBOOK_APP_SECRET,
-            access_token=token_obj.token,
+            access_token=_facebook_token(connection),
             ad_account_id=connection.config.get("facebook_ad_account_id"),
         )
     elif source_name == "GOOGLE_ADS":
@@ -69,27 +80,159 @@ def get_api_client(connection):
         )
 
 
+def facebook_insights_options(connection, sync_range=None):
+    """Connection config 對應的 insights 參數 (FacebookAdsAPIClient.iter_insights / FacebookBatchExtractor 共用)。"""
+    config = connection.config
+    return {
+        "fields": config.get("selected_fields", []),
+        "date_preset": config.get("date_preset"),
+        "extra_params": {"level": config.get("insights_level")},
+        "async_mode": FacebookAdsAPIClient.parse_async_mode(config.get("insights_async")),
+        "time_range": sync_range,
+        "slice_days": config.get("insights_slice_days"),
+    }
+
+
+def _renew_while_iterating(rows, renew):
+    """逐列交出 rows，每經過 lease 的三分之一就呼叫一次 renew。"""
+    interval = min(settings.INFLIGHT_LOCK_TTL, settings.TASK_CONCURRENCY_LEASE_SECONDS) / 3
+    renew_at = time.monotonic() + interval
+    for row in rows:
+        if time.monotonic() >= renew_at:
+            renew()
+            renew_at = time.monotonic() + interval
+        yield row
+
+
+def write_facebook_rows(api_client, connection, execution, rows, sync_range=None, slots=None):
+    """
+    將 insights 寫入 Connection 的 BigQuery 資料表，更新執行紀錄與增量同步的 watermark。
+    超過一小時的同步 (大量回補) 在寫入過程中會延長 in-flight lock 與並行 slot (slots) 的 lease。
+    """
+    lock = sync_lock(connection.pk)
+
+    def renew():
+        lock.set({"execution_id": execution.pk})
+        if slots is not None:
+            slots.renew()
+
+    loaded_row_count = api_client.write_insights_stream_to_bigquery(
+        dataset_id=connection.target_dataset_id,
+        table_name=connection.display_name,  # 使用 connection name 作為 table name
+        rows=_renew_while_iterating(rows, renew),
+        replace_range=sync_range,
+    )
+    if loaded_row_count:
+        execution.message = f"Successfully fetched and loaded {loaded_row_count} rows from Facebook into BigQuery."
+    else:
+        execution.message = "Successfully connected to Facebook, but no data was returned for the selected period."
+    execution.record_count = loaded_row_count
+
+    if sync_range:
+        # 今天的資料尚未完整，watermark 只推進到昨天
+        connection.sync_watermark = sync_range[1] - timedelta(days=1)
+        connection.save(update_fields=["sync_watermark"])
+        execution.message += f" (incremental {sync_range[0]} ~ {sync_range[1]})"
+
+
+# 排隊、執行中或等待重試的 ConnectionExecution 狀態；lock 指向這些執行時不可接手
+IN_FLIGHT_EXECUTION_STATES = ["RUNNING", "RETRYING"]
+
+
+def sync_lock(connection_id):
+    """同一個 Connection 同時只有一個同步在排隊或執行；value 為執行中的 ConnectionExecution id。"""
+    return InflightLock(f"inflight:connection:{connection_id}")
+
+
+def claim_sync(connection_id):
+    """
+    取得 Connection 的 in-flight lock。
+    回傳 (是否取得, 執行中的 ConnectionExecution id)；已有同步在排隊時 id 為 None。
+    """
+    lock = sync_lock(connection_id)
+    if lock.acquire({"execution_id": None}):
+        return True, None
+    current = lock.get() or {}
+    execution_id = current.get("execution_id")
+    if execution_id and not ConnectionExecution.objects.filter(
+        pk=execution_id, status__in=IN_FLIGHT_EXECUTION_STATES
+    ).exists():
+        # 記錄的執行已結束但 lock 沒有釋放 (worker 當機等)，直接接手；同時到達的觸發只有一個能接手
+        if lock.replace(current, {"execution_id": None}):
+            return True, None
+        return False, None
+    return False, execution_id
+
+
+def trigger_sync(connection_id, triggered_by_user_id=None, queue=None):
+    """
+    派發同步任務 (交易提交後送出)。已有同步在排隊或執行中時不重複派發，
+    回傳 (是否派發, 執行中的 ConnectionExecution id)。
+    """
+    claimed, execution_id = claim_sync(connection_id)
+    if not claimed:
+        logger.info(f"Sync for connection {connection_id} is already in flight (execution {execution_id}), not dispatching again.")
+        return False, execution_id
+    options = {"queue": queue} if queue else {}
+    transaction.on_commit(
+        lambda: sync_connection_data_task.apply_async(
+            (connection_id,), {"triggered_by_user_id": triggered_by_user_id}, **options
+        )
+    )
+    return True, None
+
+
 @shared_task(bind=True, max_retries=3, default_retry_delay=60)
-def sync_connection_data_task(self, connection_id, triggered_by_user_id=None):
+def sync_connection_data_task(self, connection_id, triggered_by_user_id=None, execution_id=None):
     """
     核心任務：同步單一 Connection 的資料到 BigQuery，並建立執行紀錄。
+    重試時 execution_id 為等待重試 (RETRYING) 的執行紀錄，沿用同一筆而不是建立新的。
     """
+    lock = sync_lock(connection_id)
+    retry_execution = (
+        ConnectionExecution.objects.filter(pk=execution_id, status="RETRYING").first() if execution_id else None
+    )
     connection = Connection.objects.filter(pk=connection_id).first()
-    if not connection:
-        logger.error(f"Connection with ID {connection_id} not found.")
+    if not connection or not connection.is_enabled:
+        if not connection:
+            logger.error(f"Connection with ID {connection_id} not found.")
+        else:
+            # 任務執行前，再次檢查開關。雖然排程器已檢查過，但手動觸發時也需要檢查。
+            logger.warning(
+                f"Sync task for connection {connection_id} was triggered, but the connection is disabled. Skipping."
+            )
+        if retry_execution:
+            retry_execution.status = "FAILED"
+            retry_execution.finished_at = timezone.now()
+            retry_execution.save(update_fields=["status", "finished_at"])
+        lock.release()
         return
 
-    # 任務執行前，再次檢查開關。雖然排程器已檢查過，但手動觸發時也需要檢查。
-    if not connection.is_enabled:
-        logger.warning(
-            f"Sync task for connection {connection_id} was triggered, but the connection is disabled. Skipping."
-        )
+    # 不經過 trigger_sync 派發的重複任務：已有另一個執行進行中 (或等待重試) 時直接結束
+    running_execution_id = (lock.get() or {}).get("execution_id")
+    if (
+        running_execution_id
+        and running_execution_id != getattr(retry_execution, "pk", None)
+        and ConnectionExecution.objects.filter(
+            pk=running_execution_id, status__in=IN_FLIGHT_EXECUTION_STATES
+        ).exists()
+    ):
+        logger.warning(f"Connection {connection_id} is already syncing (execution {running_execution_id}). Skipping duplicate task.")
         return
 
     logger.info(
         f"--- [DEBUG] Task running for Connection ID {connection_id}. Its data_source.name is: '{connection.data_source.name}' ---"
     )
 
+    # 每個 Client 與每個資料來源同時執行的同步數有上限，已滿時延後重新排入
+    slots = task_slots(client_id=connection.client_id, providers=[connection.data_source.name])
+    try:
+        slots.acquire()
+    except ConcurrencyLimitReached as e:
+        countdown = defer_task(self)
+        logger.info(f"Sync for connection {connection_id} deferred by {countdown:.0f}s: {e}")
+        return
+
     # --- 步驟 1: 建立執行紀錄 (Execution Record) ---
     trigger_method = "MANUAL" if triggered_by_user_id else "SYSTEM"
     triggered_by_user = (
@@ -98,15 +241,22 @@ def sync_connection_data_task(self, connection_id, triggered_by_user_id=None):
         else None
     )
 
-    execution = ConnectionExecution.objects.create(
-        connection=connection,
-        triggered_by=triggered_by_user,
-        trigger_method=trigger_method,
-        status="RUNNING",
-        config_snapshot=connection.config,
-        display_name_snapshot=connection.display_name,
-        target_dataset_id_snapshot=connection.target_dataset_id,
-    )
+    if retry_execution:
+        execution = retry_execution
+        execution.status = "RUNNING"
+        execution.save(update_fields=["status"])
+    else:
+        execution = ConnectionExecution.objects.create(
+            connection=connection,
+            triggered_by=triggered_by_user,
+            trigger_method=trigger_method,
+            status="RUNNING",
+            config_snapshot=connection.config,
+            display_name_snapshot=connection.display_name,
+            target_dataset_id_snapshot=connection.target_dataset_id,
+        )
+    # 之後重複的觸發會回傳這個 execution
+    lock.set({"execution_id": execution.pk})
 
     # 更新 Connection 的即時狀態為 "同步中"
     connection.status = "SYNCING"
@@ -114,31 +264,14 @@ def sync_connection_data_task(self, connection_id, triggered_by_user_id=None):
 
     try:
         api_client = get_api_client(connection)
-        data_to_load = []
 
         # === 獲取資料 ===
         if isinstance(api_client, FacebookAdsAPIClient):
-            config = connection.config
-            data_to_load = api_client.get_insights(
-                fields=config.get("selected_fields", []),
-                date_preset=config.get("date_preset"),
-                extra_params={"level": config.get("insights_level")},
-            )
-            logger.info(f"FacebookAdsAPIClient returned {len(data_to_load)} rows.")
-
-            # --- START: 新增的 BigQuery 寫入邏輯 ---
-            if data_to_load:
-                loaded_row_count = api_client.write_insights_to_bigquery(
-                    dataset_id=connection.target_dataset_id,
-                    table_name=connection.display_name,  # 使用 connection name 作為 table name
-                    insights_data=data_to_load,
-                )
-                execution.message = f"Successfully fetched {len(data_to_load)} rows from Facebook and loaded {loaded_row_count} rows into BigQuery."
-                execution.record_count = loaded_row_count
-            else:
-                execution.message = "Successfully connected to Facebook, but no data was returned for the selected period."
-                execution.record_count = 0
-            # --- END: 新增的 BigQuery 寫入邏輯 ---
+            # 增量模式只抓取 watermark 之後 (含歸因回補) 的日期，並替換 BigQuery 中相同日期的資料
+            sync_range = connection.incremental_sync_range()
+            # 逐頁讀取並串流寫入 BigQuery，不把整份報表留在 worker 記憶體中
+            insights_rows = api_client.iter_insights(**facebook_insights_options(connection, sync_range))
+            write_facebook_rows(api_client, connection, execution, insights_rows, sync_range, slots=slots)
 
         elif isinstance(api_client, GoogleAdsAPIClient):
             success, message = api_client.run_query_and_save()
@@ -192,22 +325,6 @@ def sync_connection_data_task(self, connection_id, triggered_by_user_id=None):
             execution.message = f"Successfully fetched and loaded {record_count} rows from Google Sheet."
             execution.record_count = record_count
 
-        # === 載入資料到 BigQuery (若有) ===
-        if data_to_load:
-            # ... (BigQuery loading logic remains the same) ...
-
-            # 更新執行紀錄
-            execution.message = (
-                f"Successfully fetched and loaded {len(data_to_load)} rows."
-            )
-            execution.record_count = len(data_to_load)
-
-        elif not isinstance(api_client, GoogleAdsAPIClient):
-            execution.message = (
-                "Successfully connected, but no data returned for the period."
-            )
-            execution.record_count = 0
-
         # ✨ 流程成功，更新執行紀錄的狀態
         execution.status = "SUCCESS"
 
@@ -217,16 +334,24 @@ def sync_connection_data_task(self, connection_id, triggered_by_user_id=None):
         connection.status = "ERROR"
         execution.status = "FAILED"
         execution.message = str(e)
-        self.retry(exc=e)
+        # 重試沿用同一筆執行紀錄
+        self.retry(exc=e, kwargs={"triggered_by_user_id": triggered_by_user_id, "execution_id": execution.pk})
 
     finally:
+        slots.release()
+        if isinstance(sys.exc_info()[1], Retry):
+            # 即將重試時保留 lock，執行紀錄維持未結束的 RETRYING，重試完成前不接受新的觸發
+            execution.status = "RETRYING"
+        else:
+            lock.release()
         # 無論成功或失敗，都將 Connection 狀態從 'SYNCING' 恢復為 'ACTIVE' 或 'ERROR'
         if connection.status == "SYNCING":
             connection.status = "ACTIVE"
         connection.save(update_fields=["status"])
 
         # 儲存最終的執行紀錄
-        execution.finished_at = timezone.now()
+        if execution.status != "RETRYING":
+            execution.finished_at = timezone.now()
         execution.save()
 
         logger.info(
@@ -234,64 +359,211 @@ def sync_connection_data_task(self, connection_id, triggered_by_user_id=None):
         )
 
 
-@shared_task
-def schedule_periodic_syncs_task():
+@shared_task(bind=True)
+def sync_facebook_batch_task(self, connection_ids):
     """
-    由 Celery Beat 每分鐘執行一次，精確檢查並派發到期的同步任務。
+    以 Graph API batch 請求一起同步同一個 Client 的多個 Facebook Connection (由 dispatch_syncs 分組)：
+    所有廣告帳戶的帳戶資訊與 insights 合併在同一組 batch 呼叫中抓取，再分別寫入各自的 BigQuery 資料表，
+    每個 Connection 各有自己的執行紀錄。整組抓取失敗時，執行紀錄改為 RETRYING，
+    並逐一派發沿用該紀錄的 sync_connection_data_task。
+    呼叫前各 Connection 的 in-flight lock 已由排程器取得。
     """
-    now = timezone.now()
-    logger.info(f"Running periodic sync scheduler at: {now.strftime('%Y-%m-%d %H:%M')}")
-
-    # 找出所有需要定期同步的、處於活動或錯誤狀態的連線
-    connections_to_check = Connection.objects.filter(
-        is_enabled=True,  # <-- 重要：只選擇已啟用的連線
-        status__in=["ACTIVE", "ERROR"],
-        config__sync_frequency__in=["daily", "weekly", "monthly"],
-        config__has_key="sync_hour",  # 確保 config 中有 sync_hour 才處理 (修正了 has_key)
-    )
+    connections = []
+    found = Connection.objects.select_related("client", "data_source").filter(pk__in=connection_ids)
+    for connection in found:
+        if connection.is_enabled:
+            connections.append(connection)
+        else:
+            logger.warning(f"Connection {connection.pk} is disabled. Skipping it in the Facebook batch sync.")
+            sync_lock(connection.pk).release()
+    for missing_id in set(connection_ids) - {connection.pk for connection in found}:
+        logger.error(f"Connection with ID {missing_id} not found.")
+        sync_lock(missing_id).release()
+    if not connections:
+        return
+
+    # 整組只佔用一個 Facebook 並行名額
+    slots = task_slots(client_id=connections[0].client_id, providers=["FACEBOOK_ADS"])
+    try:
+        slots.acquire()
+    except ConcurrencyLimitReached as e:
+        countdown = defer_task(self)
+        logger.info(f"Facebook batch sync for connections {connection_ids} deferred by {countdown:.0f}s: {e}")
+        return
 
-    for conn in connections_to_check:
+    executions = {}
+    sync_ranges = {}
+    handed_off = set()
+    for connection in connections:
+        execution = ConnectionExecution.objects.create(
+            connection=connection,
+            trigger_method="SYSTEM",
+            status="RUNNING",
+            config_snapshot=connection.config,
+            display_name_snapshot=connection.display_name,
+            target_dataset_id_snapshot=connection.target_dataset_id,
+        )
+        sync_lock(connection.pk).set({"execution_id": execution.pk})
+        executions[connection.pk] = execution
+        sync_ranges[connection.pk] = connection.incremental_sync_range()
+        connection.status = "SYNCING"
+        connection.save(update_fields=["status"])
+
+    try:
         try:
-            # 從 config 中讀取使用者設定的時間，並轉換為整數
-            sync_hour = int(conn.config.get("sync_hour", 0))
-            sync_minute = int(conn.config.get("sync_minute", 0))
-
-            # --- 核心判斷邏輯 ---
-
-            # 1.【時間精確匹配】檢查現在的「時」和「分」是否與設定的完全一致
-            if now.hour != sync_hour or now.minute != sync_minute:
-                continue  # 時間不對，直接跳過這個連線
-
-            # 2.【防止重複執行】檢查今天是否已經同步過
-            #    這很重要，因為此任務現在每分鐘都跑
-            if conn.last_sync_time and conn.last_sync_time.date() == now.date():
-                continue  # 今天已經同步過了，跳過
-
-            # 3.【頻率日期匹配】檢查今天的日期是否符合 daily/weekly/monthly 的規則
-            freq = conn.config.get("sync_frequency")
-            should_run = False
-            if freq == "daily":
-                should_run = True
-            elif freq == "weekly":
-                # weekday() 回傳：週一=0, 週二=1 ... 週日=6
-                # 假設您在 form 中儲存的也是這個格式
-                day_of_week = conn.config.get("weekly_day_of_week")
-                if str(now.weekday()) == day_of_week:
-                    should_run = True
-            elif freq == "monthly":
-                day_of_month = conn.config.get("monthly_day_of_month")
-                if str(now.day) == day_of_month:
-                    should_run = True
-
-            # --- 派發任務 ---
-            if should_run:
-                logger.info(
-                    f"Dispatching sync task for connection {conn.pk} as per its '{freq}' schedule at {sync_hour:02}:{sync_minute:02}."
+            api_client = FacebookAdsAPIClient(
+                app_id=settings.FACEBOOK_APP_ID,
+                app_secret=settings.FACEBOOK_APP_SECRET,
+                access_token=_facebook_token(connections[0]),
+            )
+            extractor = FacebookBatchExtractor(api_client)
+            for connection in connections:
+                ad_account_id = connection.config.get("facebook_ad_account_id")
+                extractor.add_account_metadata(("account", connection.pk), ad_account_id)
+                extractor.add_insights(
+                    ("insights", connection.pk), ad_account_id,
+                    **facebook_insights_options(connection, sync_ranges[connection.pk]),
                 )
-                sync_connection_data_task.delay(conn.pk)
+            results = extractor.execute()
+        except Exception as e:
+            logger.error(f"Facebook batch fetch for connections {connection_ids} failed, falling back to individual syncs: {e}", exc_info=True)
+            for connection in connections:
+                execution = executions[connection.pk]
+                execution.status = "RETRYING"
+                execution.message = f"Batched Facebook fetch failed, retrying as an individual sync: {e}"
+                # lock 與執行紀錄交給個別的同步任務 (在 finally 儲存狀態後才派發)
+                handed_off.add(connection.pk)
+            return
+
+        for connection in connections:
+            execution = executions[connection.pk]
+            account = results[("account", connection.pk)]
+            insights = results[("insights", connection.pk)]
+            try:
+                if account["error"]:
+                    raise account["error"]
+                if insights["error"]:
+                    raise insights["error"]
+                write_facebook_rows(
+                    api_client, connection, execution, insights["rows"], sync_ranges[connection.pk], slots=slots
+                )
+                account_info = account["data"] or {}
+                execution.message += f" Ad account: {account_info.get('name')} ({account_info.get('currency')})."
+                execution.status = "SUCCESS"
+            except Exception as e:
+                logger.error(f"Error syncing connection {connection.pk} in Facebook batch: {e}", exc_info=True)
+                connection.status = "ERROR"
+                execution.status = "FAILED"
+                execution.message = str(e)
+
+    finally:
+        slots.release()
+        for connection in connections:
+            execution = executions[connection.pk]
+            if connection.pk in handed_off:
+                # Connection 維持 SYNCING，由個別的同步任務更新；執行紀錄等待重試，不設定 finished_at
+                execution.save()
+                continue
+            sync_lock(connection.pk).release()
+            if connection.status == "SYNCING":
+                connection.status = "ACTIVE"
+            connection.save(update_fields=["status"])
+
+            if execution.status == "RUNNING":
+                execution.status = "FAILED"
+            execution.finished_at = timezone.now()
+            execution.save()
+            logger.info(
+                f"Execution {execution.pk} for connection {connection.pk} finished with status '{execution.status}' (Facebook batch)."
+            )
 
-        except (ValueError, TypeError) as e:
-            logger.error(
-                f"Could not parse schedule for connection {conn.pk}. Config: {conn.config}. Error: {e}"
+        if handed_off:
+            retries = [
+                sync_connection_data_task.s(pk, execution_id=executions[pk].pk) for pk in sorted(handed_off)
+            ]
+            transaction.on_commit(
+                lambda: group(retries).apply_async(queue=settings.CELERY_SCHEDULED_QUEUE)
             )
-            continue  # 如果某個連線的 config 格式錯誤，跳過它，不要影響其他任務
+
+
+def dispatch_syncs(connection_ids, queue=None):
+    """
+    派發已取得 in-flight lock 的同步任務。同一個 Client 下可以合併的 Facebook Connection
+    (報表夠小，不需要非同步報表或切段) 以 sync_facebook_batch_task 分組，其餘逐一派發 sync_connection_data_task。
+    """
+    batches = {}
+    singles = []
+    connections = Connection.objects.select_related("data_source").filter(pk__in=connection_ids)
+    for connection in connections:
+        if (
+            settings.FACEBOOK_BATCH_SYNC_ENABLED
+            and connection.data_source.name == "FACEBOOK_ADS"
+            and connection.client_id
+            and connection.config.get("facebook_ad_account_id")
+            and FacebookBatchExtractor.batchable(
+                **facebook_insights_options(connection, connection.incremental_sync_range())
+            )
+        ):
+            batches.setdefault(connection.client_id, []).append(connection.pk)
+        else:
+            singles.append(connection.pk)
+    # 找不到的 Connection 交給個別任務處理 (會釋放 lock)
+    singles.extend(set(connection_ids) - {connection.pk for connection in connections})
+
+    signatures = []
+    for ids in batches.values():
+        if len(ids) < settings.FACEBOOK_BATCH_MIN_CONNECTIONS:
+            singles.extend(ids)
+            continue
+        for start in range(0, len(ids), settings.FACEBOOK_BATCH_MAX_CONNECTIONS):
+            signatures.append(sync_facebook_batch_task.s(ids[start:start + settings.FACEBOOK_BATCH_MAX_CONNECTIONS]))
+    signatures.extend(sync_connection_data_task.s(pk) for pk in singles)
+
+    options = {"queue": queue} if queue else {}
+    group(signatures).apply_async(**options)
+    return len(signatures)
+
+
+@shared_task
+def schedule_periodic_syncs_task():
+    """
+    由 Celery Beat 每分鐘執行一次，派發 next_sync_at 已到期的同步任務。
+    到期的連線以 SELECT ... FOR UPDATE SKIP LOCKED 認領並在同一個交易中推進 next_sync_at，
+    多個 beat/worker 同時執行也不會重複派發；交易提交後以一個 group 一次送出。
+    """
+    now = timezone.now()
+    batch_size = settings.CONNECTION_SCHEDULER_BATCH_SIZE
+    dispatched = 0
+    while True:
+        with transaction.atomic():
+            due_connections = list(
+                Connection.objects.select_for_update(skip_locked=True)
+                .filter(is_enabled=True, next_sync_at__lte=now)
+                .order_by("next_sync_at")
+                .only(
+                    "id", "status", "is_enabled", "next_sync_at",
+                    "sync_frequency", "sync_hour", "sync_minute",
+                    "sync_day_of_week", "sync_day_of_month", "sync_window_minutes",
+                )[:batch_size]
+            )
+            if not due_connections:
+                break
+
+            connection_ids = []
+            for conn in due_connections:
+                # 同步中 (或仍有同步在排隊)、尚未完成首次同步的連線這一輪跳過，但排程照常往後推
+                if conn.status in ("ACTIVE", "ERROR") and claim_sync(conn.pk)[0]:
+                    connection_ids.append(conn.pk)
+                conn.schedule_next_sync(after=now)
+            Connection.objects.bulk_update(due_connections, ["next_sync_at"])
+
+            if connection_ids:
+                # 同一個 Client 的小型 Facebook 報表會合併成 Graph API batch 任務
+                transaction.on_commit(
+                    lambda ids=connection_ids: dispatch_syncs(ids, queue=settings.CELERY_SCHEDULED_QUEUE)
+                )
+        dispatched += len(connection_ids)
+        if len(due_connections) < batch_size:
+            break
+
+    logger.info(f"Periodic sync scheduler at {now.strftime('%Y-%m-%d %H:%M')} dispatched {dispatched} sync task(s).")
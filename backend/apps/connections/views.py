@@ -35,7 +35,7 @@ from .apis.facebook_ads import (
 )
 
 from .apis.google_sheet import GoogleSheetAPIClient
-from .tasks import sync_connection_data_task
+from .tasks import trigger_sync
 from itertools import chain
 from rest_framework import viewsets, status
 from rest_framework.decorators import (
@@ -186,9 +186,7 @@ class ConnectionViewSet(viewsets.ModelViewSet):
         )
 
         logger.info(f"Triggering sync task for new connection {connection.pk}")
-        sync_connection_data_task.delay(
-            connection.pk, triggered_by_user_id=self.request.user.id
-        )
+        trigger_sync(connection.pk, triggered_by_user_id=self.request.user.id)
 
     @action(detail=True, methods=["post"], url_path="clone")
     def clone(self, request, pk=None):
@@ -200,6 +198,8 @@ class ConnectionViewSet(viewsets.ModelViewSet):
         new_connection.id = None
         new_connection.display_name = f"{original_connection.display_name} (Copy)"
         new_connection.status = "PENDING"
+        # 複本寫入新的資料表，增量同步從頭開始
+        new_connection.sync_watermark = None
         new_connection.created_at = None
         new_connection.updated_at = None
         new_connection.save()
@@ -215,9 +215,7 @@ class ConnectionViewSet(viewsets.ModelViewSet):
         )
 
         # 也可以選擇性觸發一次同步
-        sync_connection_data_task.delay(
-            new_connection.pk, triggered_by_user_id=request.user.id
-        )
+        trigger_sync(new_connection.pk, triggered_by_user_id=request.user.id)
 
         serializer = self.get_serializer(new_connection)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -279,9 +277,18 @@ class ConnectionViewSet(viewsets.ModelViewSet):
                 {"error": "Connection is disabled."}, status=status.HTTP_400_BAD_REQUEST
             )
 
-        sync_connection_data_task.delay(
+        dispatched, execution_id = trigger_sync(
             connection.pk, triggered_by_user_id=request.user.id
         )
+        if not dispatched:
+            # 已有同步在排隊或執行中：回傳該執行，不重複同步
+            return Response(
+                {
+                    "status": f"Sync for '{connection.display_name}' is already in progress.",
+                    "execution_id": execution_id,
+                },
+                status=status.HTTP_200_OK,
+            )
 
         return Response(
             {
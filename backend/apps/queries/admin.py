@@ -4,6 +4,7 @@ from django.core.exceptions import PermissionDenied
 from django import forms
 
 from .models import QueryDefinition, QueryExecution
+from .services.bq_services import DESTINATION_DISPOSITIONS, validate_table_name
 from apps.clients.models import Client, ClientSetting
 
 import json # 需要導入 json 來處理 output_config
@@ -69,7 +70,7 @@ class QueryDefinitionForm(forms.ModelForm):
         fields = [
             'name', 'description', 'sql_query',
             'bigquery_project_id', 'bigquery_dataset_id',
-            'schedule_type', 'cron_schedule', # 新增的排程欄位
+            'schedule_type', 'cron_schedule', 'schedule_window_minutes', # 新增的排程欄位
             'output_target', 'output_config', # 新增的輸出欄位
             'owner', # owner 在創建時由 save_model 設定，但可以在 admin 顯示
         ]
@@ -153,7 +154,7 @@ class QueryDefinitionForm(forms.ModelForm):
         output_target = self.cleaned_data.get('output_target')
 
         if not output_config_str:
-            if output_target == 'GOOGLE_SHEET' or output_target == 'LOOKER_STUDIO': 
+            if output_target in ('GOOGLE_SHEET', 'LOOKER_STUDIO', 'BIGQUERY_TABLE'):
                 raise forms.ValidationError(
                     f"Output configuration is required for {output_target.replace('_', ' ').title()} output." 
                 )
@@ -176,6 +177,23 @@ class QueryDefinitionForm(forms.ModelForm):
                 raise forms.ValidationError(
                     {"email": "Email address is required for Google Looker Studio output."}
                 )
+            if config.get("incremental_refresh") and not config.get("partition_field"):
+                raise forms.ValidationError(
+                    {"partition_field": "Partition field is required for incremental refresh."}
+                )
+        elif output_target == 'BIGQUERY_TABLE':
+            try:
+                validate_table_name(config.get("table_name"))
+            except ValueError as e:
+                raise forms.ValidationError({"table_name": str(e)})
+            if config.get("write_disposition", "OVERWRITE") not in DESTINATION_DISPOSITIONS:
+                raise forms.ValidationError(
+                    {"write_disposition": f"Write disposition must be one of {', '.join(DESTINATION_DISPOSITIONS)}."}
+                )
+            if config.get("write_disposition") == "PARTITION_REPLACE" and not config.get("partition_field"):
+                raise forms.ValidationError(
+                    {"partition_field": "Partition field is required for PARTITION_REPLACE."}
+                )
 
         return json.dumps(config)
 
@@ -323,7 +341,7 @@ class QueryDefinitionAdmin(admin.ModelAdmin):
             {"fields": ("bigquery_project_id", "bigquery_dataset_id")},
         ),
         # 這裡將 'schedule_config' 替換為 'schedule_type' 和 'cron_schedule'
-        ("Scheduling", {"fields": ("schedule_type", "cron_schedule")}),
+        ("Scheduling", {"fields": ("schedule_type", "cron_schedule", "schedule_window_minutes", "next_run_at")}),
         ("Output", {"fields": ("output_target", "output_config")}),
         ("Ownership", {"fields": ("owner",)}),
     )
@@ -335,6 +353,8 @@ class QueryDefinitionAdmin(admin.ModelAdmin):
         "last_successful_run_result",
         "last_successful_test_hash", # 新增
         "last_tested_at", # 新增
+        "referenced_tables",
+        "next_run_at",
         "created_at", # 通常設為唯讀
         "updated_at", # 通常設為唯讀
     )
@@ -483,6 +503,8 @@ class QueryDefinitionAdmin(admin.ModelAdmin):
                 "Insufficient permissions for this BigQuery Dataset ID."
             )
 
+        obj.compile_sql()
+        obj.schedule_next_run()
         super().save_model(request, obj, form, change)
 
     def get_form(self, request, obj=None, **kwargs):
@@ -503,15 +525,20 @@ class QueryDefinitionAdmin(admin.ModelAdmin):
             if self.has_view_permission(
                 request, query_def
             ):
-                from .tasks import run_bigquery_query_task
+                from .tasks import trigger_query_run
 
-                execution = QueryExecution.objects.create(
-                    query_definition=query_def,
-                    triggered_by=f"ADMIN_ACTION_{request.user.username}",
-                    status="PENDING",
+                # run_bigquery_query_task 接收的是 QueryRunResult id；已有 run 在執行中時不重複觸發
+                _, created = trigger_query_run(
+                    query_def, triggered_by=f"ADMIN_ACTION_{request.user.username}"
                 )
-                run_bigquery_query_task.delay(execution.id)
-                triggered_count += 1
+                if created:
+                    triggered_count += 1
+                else:
+                    self.message_user(
+                        request,
+                        f"Query '{query_def.name}' is already running.",
+                        level="WARNING",
+                    )
             else:
                 self.message_user(
                     request,
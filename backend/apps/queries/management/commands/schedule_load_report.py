@@ -0,0 +1,135 @@
+# apps/queries/management/commands/schedule_load_report.py
+
+import math
+from collections import Counter
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Avg, DurationField, ExpressionWrapper, F
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from apps.connections.models import Connection, ConnectionExecution
+from ...models import QueryDefinition, QueryRunResult
+
+
+def _average_durations(queryset, key, start_field, end_field, since):
+    """{key: 平均執行秒數}，只計算 since 之後完成的執行紀錄。"""
+    duration = ExpressionWrapper(F(end_field) - F(start_field), output_field=DurationField())
+    rows = (
+        queryset.filter(**{f"{end_field}__isnull": False, f"{start_field}__gte": since})
+        .values(key)
+        .annotate(avg_duration=Avg(duration))
+    )
+    return {row[key]: row["avg_duration"].total_seconds() for row in rows if row["avg_duration"]}
+
+
+class Command(BaseCommand):
+    help = (
+        "Report the expected per-minute load of scheduled connection syncs and query runs: "
+        "runs starting in each minute and runs expected to be executing concurrently, "
+        "using each schedule's average duration from recent history."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start", help="Start of the simulated period (ISO datetime, default: now)")
+        parser.add_argument("--hours", type=int, default=24, help="Length of the simulated period in hours")
+        parser.add_argument("--default-duration", type=float, default=5.0,
+                            help="Minutes assumed for schedules without execution history")
+        parser.add_argument("--history-days", type=int, default=30,
+                            help="Days of execution history used to estimate run durations")
+        parser.add_argument("--top", type=int, default=20, help="Number of busiest minutes to list")
+        parser.add_argument("--all", action="store_true", help="List every minute with at least one running task")
+        parser.add_argument("--ignore-windows", action="store_true",
+                            help="Simulate without scheduling windows, to compare against the spread-out schedule")
+
+    def handle(self, *args, **options):
+        if options["start"]:
+            start = parse_datetime(options["start"])
+            if start is None:
+                raise CommandError(f"Invalid --start value: {options['start']}")
+            if timezone.is_naive(start):
+                start = timezone.make_aware(start)
+        else:
+            start = timezone.now()
+        start = start.replace(second=0, microsecond=0)
+        end = start + timedelta(hours=options["hours"])
+        since = timezone.now() - timedelta(days=options["history_days"])
+        default_duration = options["default_duration"] * 60
+
+        connection_durations = _average_durations(
+            ConnectionExecution.objects.filter(status="SUCCESS"), "connection_id", "started_at", "finished_at", since
+        )
+        query_durations = _average_durations(
+            QueryRunResult.objects.filter(status="SUCCESS"), "query_id", "executed_at", "completed_at", since
+        )
+
+        schedules = []  # (kind, pk, next_time 函式, 平均秒數)
+        connections = Connection.objects.filter(is_enabled=True).exclude(sync_frequency="once")
+        for conn in connections.iterator():
+            if options["ignore_windows"]:
+                conn.sync_window_minutes = 0
+            schedules.append(("connection", conn.pk, conn.compute_next_sync_at,
+                              connection_durations.get(conn.pk, default_duration)))
+        queries = QueryDefinition.objects.filter(schedule_type="PERIODIC").exclude(cron_schedule__isnull=True).exclude(cron_schedule="")
+        for query_def in queries.iterator():
+            if options["ignore_windows"]:
+                query_def.schedule_window_minutes = 0
+            schedules.append(("query", query_def.pk, query_def.compute_next_run_at,
+                              query_durations.get(query_def.pk, default_duration)))
+
+        starts = Counter()
+        running = Counter()
+        run_counts = Counter()
+        for kind, pk, next_time, duration in schedules:
+            cursor = start - timedelta(seconds=1)
+            while True:
+                try:
+                    run_at = next_time(after=cursor)
+                except (ValueError, KeyError) as e:
+                    self.stderr.write(f"Skipping {kind} {pk}: invalid schedule ({e})")
+                    break
+                if run_at is None or run_at >= end:
+                    break
+                minute = run_at.replace(second=0, microsecond=0)
+                starts[minute] += 1
+                run_counts[kind] += 1
+                for i in range(max(1, math.ceil(duration / 60))):
+                    running[minute + timedelta(minutes=i)] += 1
+                cursor = run_at
+
+        self.stdout.write(
+            f"Period: {timezone.localtime(start):%Y-%m-%d %H:%M} ~ {timezone.localtime(end):%Y-%m-%d %H:%M} "
+            f"({'without' if options['ignore_windows'] else 'with'} scheduling windows)"
+        )
+        self.stdout.write(
+            f"Schedules: {sum(1 for s in schedules if s[0] == 'connection')} connections, "
+            f"{sum(1 for s in schedules if s[0] == 'query')} queries; "
+            f"runs: {run_counts['connection']} syncs, {run_counts['query']} queries"
+        )
+        if not starts:
+            self.stdout.write("No scheduled runs in this period.")
+            return
+
+        peak_start_minute, peak_starts = max(starts.items(), key=lambda item: item[1])
+        peak_running_minute, peak_running = max(running.items(), key=lambda item: item[1])
+        minutes = int((end - start).total_seconds() // 60)
+        busy = sorted(running.values())
+        self.stdout.write(
+            f"Peak starts: {peak_starts} at {timezone.localtime(peak_start_minute):%m-%d %H:%M}; "
+            f"peak concurrency: {peak_running} at {timezone.localtime(peak_running_minute):%m-%d %H:%M}; "
+            f"p95 concurrency (busy minutes): {busy[min(len(busy) - 1, int(len(busy) * 0.95))]}; "
+            f"busy minutes: {len(running)}/{minutes}"
+        )
+
+        if options["all"]:
+            rows = sorted(running)
+        else:
+            rows = sorted(sorted(running, key=lambda minute: (-running[minute], minute))[:options["top"]])
+        scale = 50 / peak_running
+        self.stdout.write(f"\n{'minute':<12} {'starts':>6} {'running':>7}")
+        for minute in rows:
+            bar = "#" * max(1, round(running[minute] * scale))
+            self.stdout.write(
+                f"{timezone.localtime(minute):%m-%d %H:%M}  {starts.get(minute, 0):>6} {running[minute]:>7}  {bar}"
+            )
@@ -0,0 +1,34 @@
+# Generated by Django 5.2.1 on 2026-10-17 03:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0004_alter_querydefinition_output_target'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryrunresult',
+            name='bigquery_job_id',
+            field=models.CharField(blank=True, max_length=255, null=True),
+        ),
+        migrations.AddField(
+            model_name='queryrunresult',
+            name='reused_from',
+            field=models.ForeignKey(blank=True, help_text='Run whose result artifact was reused', null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='reused_by', to='queries.queryrunresult'),
+        ),
+        migrations.AddField(
+            model_name='queryrunresult',
+            name='source_table_versions',
+            field=models.JSONField(blank=True, help_text='{table_id: last_modified} of every referenced table at run time', null=True),
+        ),
+        migrations.AddField(
+            model_name='queryrunresult',
+            name='sql_fingerprint',
+            field=models.CharField(blank=True, db_index=True, max_length=64, null=True),
+        ),
+    ]
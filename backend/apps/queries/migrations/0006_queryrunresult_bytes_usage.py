@@ -0,0 +1,33 @@
+# Generated by Django 5.2.1 on 2026-10-17 03:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0005_queryrunresult_result_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryrunresult',
+            name='bytes_billed',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='queryrunresult',
+            name='bytes_processed',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='queryrunresult',
+            name='estimated_bytes_processed',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='querydefinition',
+            name='last_run_status',
+            field=models.CharField(choices=[('PENDING', 'Pending'), ('RUNNING', 'Running'), ('SUCCESS', 'Success'), ('FAILED', 'Failed'), ('SCHEDULED', 'Scheduled'), ('OUTPUT_ERROR', 'Output Error'), ('SAVED_ONLY', 'Saved Only'), ('BUDGET_EXCEEDED', 'Budget Exceeded')], default='PENDING', max_length=20, verbose_name='Last Run Status'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-17 03:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0006_queryrunresult_bytes_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querydefinition',
+            name='compiled_sql',
+            field=models.TextField(blank=True, help_text='sql_query with table names qualified, compiled at save time', null=True),
+        ),
+        migrations.AddField(
+            model_name='querydefinition',
+            name='referenced_tables',
+            field=models.JSONField(blank=True, default=list, help_text='Tables referenced by the query (project.dataset.table)'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.1 on 2026-10-17 03:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0007_querydefinition_compiled_sql'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryrunresult',
+            name='destination_table',
+            field=models.CharField(blank=True, max_length=1024, null=True),
+        ),
+        migrations.AlterField(
+            model_name='querydefinition',
+            name='output_target',
+            field=models.CharField(choices=[('NONE', 'None'), ('GOOGLE_SHEET', 'Google Sheets'), ('LOOKER_STUDIO', 'Google Looker Studio'), ('BIGQUERY_TABLE', 'BigQuery Table')], default='NONE', max_length=50),
+        ),
+    ]
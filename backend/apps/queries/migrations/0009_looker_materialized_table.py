@@ -0,0 +1,28 @@
+# Generated by Django 5.2.1 on 2026-10-17 03:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0008_destination_table_output'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querydefinition',
+            name='materialized_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='querydefinition',
+            name='materialized_sql_hash',
+            field=models.CharField(blank=True, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='querydefinition',
+            name='materialized_table',
+            field=models.CharField(blank=True, max_length=1024, null=True),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.1 on 2026-10-17 03:26
+
+from datetime import datetime
+
+from croniter import croniter
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def backfill_next_run_at(apps, schema_editor):
+    """為既有的定期查詢計算 next_run_at，並移除舊的每個查詢一筆的 PeriodicTask。"""
+    QueryDefinition = apps.get_model("queries", "QueryDefinition")
+    PeriodicTask = apps.get_model("django_celery_beat", "PeriodicTask")
+    now = timezone.localtime()
+    periodic = QueryDefinition.objects.filter(schedule_type="PERIODIC").exclude(cron_schedule__isnull=True).exclude(cron_schedule="")
+    for query_def in periodic.iterator():
+        try:
+            query_def.next_run_at = croniter(query_def.cron_schedule, now).get_next(datetime)
+        except (ValueError, KeyError):
+            continue
+        query_def.save(update_fields=["next_run_at"])
+    PeriodicTask.objects.filter(name__regex=r"^query_definition_[0-9]+_periodic_task$").delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0009_looker_materialized_table'),
+        ('django_celery_beat', '0019_alter_periodictasks_options'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querydefinition',
+            name='next_run_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='querydefinition',
+            index=models.Index(condition=models.Q(('schedule_type', 'PERIODIC')), fields=['next_run_at'], name='query_def_next_run_idx'),
+        ),
+        migrations.RunPython(backfill_next_run_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.1 on 2026-10-17 03:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0010_query_next_run_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='querydefinition',
+            name='schedule_window_minutes',
+            field=models.PositiveSmallIntegerField(default=0, help_text='Spread the run over this many minutes after the cron time (0 = run on time)'),
+        ),
+    ]
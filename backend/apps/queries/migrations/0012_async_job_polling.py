@@ -0,0 +1,27 @@
+# Generated by Django 5.2.1 on 2026-10-17 03:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0011_schedule_window'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queryrunresult',
+            name='bigquery_job_location',
+            field=models.CharField(blank=True, max_length=50, null=True),
+        ),
+        migrations.AddField(
+            model_name='queryrunresult',
+            name='bigquery_job_state',
+            field=models.CharField(blank=True, max_length=10, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='queryrunresult',
+            index=models.Index(condition=models.Q(('bigquery_job_state__in', ['PENDING', 'RUNNING'])), fields=['bigquery_job_state'], name='run_result_job_pending_idx'),
+        ),
+    ]
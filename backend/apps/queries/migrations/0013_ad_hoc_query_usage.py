@@ -0,0 +1,31 @@
+# Generated by Django 5.2.1 on 2026-10-17 04:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('queries', '0012_async_job_polling'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AdHocQueryUsage',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bigquery_dataset_id', models.CharField(db_index=True, max_length=255)),
+                ('executed_at', models.DateTimeField(auto_now_add=True)),
+                ('bigquery_job_id', models.CharField(blank=True, max_length=255, null=True)),
+                ('bytes_processed', models.BigIntegerField(blank=True, null=True)),
+                ('bytes_billed', models.BigIntegerField(blank=True, null=True)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['-executed_at'],
+            },
+        ),
+    ]
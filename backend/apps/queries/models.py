@@ -1,9 +1,14 @@
 from django.db import models
 from django.contrib.auth.models import User  # 如果需要追蹤是誰建立的
 from django.utils import timezone
-from datetime import timedelta
+from datetime import datetime, timedelta
 import hashlib
 from django.core.exceptions import ValidationError
+from django.conf import settings
+from croniter import croniter
+
+from main.scheduling import window_offset
+from .services.sql_compiler import compile_sql
 
 # from django_celery_beat.models import PeriodicTask # 如果使用 django-celery-beat 做排程
 
@@ -39,6 +44,7 @@ class QueryDefinition(models.Model):
         ("SCHEDULED", "Scheduled"),
         ("OUTPUT_ERROR", "Output Error"),
         ("SAVED_ONLY", "Saved Only"),  
+        ("BUDGET_EXCEEDED", "Budget Exceeded"),
     ]
 
     name = models.CharField(max_length=255, verbose_name="Query Name")
@@ -57,17 +63,34 @@ class QueryDefinition(models.Model):
     # 新增 schedule_hour 和 schedule_minute
     cron_schedule = models.CharField(max_length=255, null=True, blank=True,
                                      help_text="Cron schedule string (e.g., '0 9 * * *' for daily 9 AM)")
+    # 排程時間窗：實際執行時間為 cron 時間之後 [0, N) 分鐘內固定的某一分鐘，0 表示準時執行
+    schedule_window_minutes = models.PositiveSmallIntegerField(
+        default=0, help_text="Spread the run over this many minutes after the cron time (0 = run on time)")
+    # 下一次排程執行的時間 (由 cron_schedule 計算，每次排程執行後往後推算)；
+    # schedule_periodic_queries 只需以索引查詢 next_run_at <= now 的資料列
+    next_run_at = models.DateTimeField(null=True, blank=True)
     # Output settings
     output_target = models.CharField(max_length=50, default='NONE',
                                      choices=[
                                          ('NONE', 'None'),
                                          ('GOOGLE_SHEET', 'Google Sheets'),
-                                         ('LOOKER_STUDIO', 'Google Looker Studio')
+                                         ('LOOKER_STUDIO', 'Google Looker Studio'),
+                                         ('BIGQUERY_TABLE', 'BigQuery Table'),
                                      ])
     
     output_config = models.JSONField(null=True, blank=True,
                                      help_text="JSON configuration for output target (e.g., sheet_id, tab_name, append_mode)")
 
+    # 儲存時編譯：補上 dataset 後可直接執行的 SQL，以及引用的資料表 (project.dataset.table)
+    compiled_sql = models.TextField(null=True, blank=True, help_text="sql_query with table names qualified, compiled at save time")
+    referenced_tables = models.JSONField(default=list, blank=True,
+                                         help_text="Tables referenced by the query (project.dataset.table)")
+
+    # Looker Studio 輸出：查詢結果物化成的 BigQuery 資料表，以及最近一次刷新的時間與 SQL 指紋
+    materialized_table = models.CharField(max_length=1024, null=True, blank=True)
+    materialized_at = models.DateTimeField(null=True, blank=True)
+    materialized_sql_hash = models.CharField(max_length=64, null=True, blank=True)
+
     # Status tracking
     last_run_status = models.CharField(
         max_length=20,
@@ -97,13 +120,53 @@ class QueryDefinition(models.Model):
     def has_downloadable_result(self):
         return (
             self.last_successful_run_result is not None
-            and self.last_successful_run_result.result_data_csv is not None
+            and self.last_successful_run_result.has_result_data()
+        )
+
+    def compile_sql(self):
+        """編譯 sql_query，更新 compiled_sql 與 referenced_tables (不會儲存)。"""
+        compiled = compile_sql(
+            self.sql_query,
+            self.bigquery_dataset_id,
+            self.bigquery_project_id or settings.GOOGLE_CLOUD_PROJECT_ID,
         )
+        self.compiled_sql = compiled.sql
+        self.referenced_tables = compiled.referenced_tables
+        return compiled
+
+    def compute_next_run_at(self, after=None):
+        """依 cron_schedule (settings.TIME_ZONE 的當地時間) 計算 after 之後的下一次執行時間。"""
+        if self.schedule_type != "PERIODIC" or not self.cron_schedule:
+            return None
+        local_after = timezone.localtime(after or timezone.now())
+        offset = self.schedule_offset()
+        # 下一次 cron 時間 + offset 必須晚於 after，所以從 after - offset 開始找
+        return croniter(self.cron_schedule, local_after - offset).get_next(datetime) + offset
+
+    def schedule_offset(self):
+        """時間窗內固定的偏移；新建尚未有 pk 時為 0，save 後會重新計算。"""
+        if not self.pk:
+            return timedelta(0)
+        return window_offset(f"query:{self.pk}", self.schedule_window_minutes)
+
+    def schedule_next_run(self, after=None):
+        """排程設定變更後呼叫，重新計算 next_run_at (不會儲存)。"""
+        self.next_run_at = self.compute_next_run_at(after)
+        return self.next_run_at
 
     def save(self, *args, **kwargs):
         if not self.pk:  # New instance
             self.last_run_status = "PENDING"
+        if self.schedule_type != "PERIODIC":
+            self.next_run_at = None
+        elif self.next_run_at is None and self.cron_schedule:
+            self.schedule_next_run()
+        is_new = self.pk is None
         super().save(*args, **kwargs)
+        if is_new and self.next_run_at and self.schedule_offset():
+            # 有 pk 之後才能決定在時間窗內的位置
+            self.schedule_next_run()
+            super().save(update_fields=["next_run_at"])
 
     def clean(self):
         super().clean()
@@ -125,6 +188,13 @@ class QueryDefinition(models.Model):
     class Meta:
         verbose_name = "Query Definition"
         verbose_name_plural = "Query Definitions"
+        indexes = [
+            models.Index(
+                fields=["next_run_at"],
+                name="query_def_next_run_idx",
+                condition=models.Q(schedule_type="PERIODIC"),
+            ),
+        ]
 
 
 class QueryRunResult(models.Model):
@@ -139,14 +209,48 @@ class QueryRunResult(models.Model):
     result_output_link = models.URLField(max_length=500, null=True, blank=True)
     result_message = models.TextField(null=True, blank=True)
     result_storage_path = models.CharField(max_length=500, null=True, blank=True)
+    # Result cache: 正規化 SQL + dataset 的指紋，以及執行時各來源資料表的 last_modified
+    sql_fingerprint = models.CharField(max_length=64, null=True, blank=True, db_index=True)
+    source_table_versions = models.JSONField(null=True, blank=True,
+                                             help_text="{table_id: last_modified} of every referenced table at run time")
+    bigquery_job_id = models.CharField(max_length=255, null=True, blank=True)
+    # Submit-and-poll：job 送出後 worker 即釋放，poll_bigquery_jobs 追蹤 PENDING/RUNNING 的 job
+    bigquery_job_location = models.CharField(max_length=50, null=True, blank=True)
+    bigquery_job_state = models.CharField(max_length=10, null=True, blank=True)
+    # Dry run 預估與實際的 BigQuery 用量，client 的 bytes 預算以 bytes_billed 加總計算
+    estimated_bytes_processed = models.BigIntegerField(null=True, blank=True)
+    bytes_processed = models.BigIntegerField(null=True, blank=True)
+    bytes_billed = models.BigIntegerField(null=True, blank=True)
+    # output_target = BIGQUERY_TABLE 時寫入的資料表 (project.dataset.table)
+    destination_table = models.CharField(max_length=1024, null=True, blank=True)
+    reused_from = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, blank=True,
+                                    related_name='reused_by', help_text="Run whose result artifact was reused")
 
     def __str__(self):
         return f"{self.query.name} - {self.get_status_display()} at {self.executed_at}"
 
+    def has_result_data(self):
+        """結果存放在 result_storage_path 的檔案，或舊資料的 result_data_csv 欄位。"""
+        if self.result_storage_path:
+            return True
+        if "result_data_csv" in self.get_deferred_fields():
+            # 列表查詢會 defer result_data_csv (可能有數 MB)，只檢查是否有值而不載入內容
+            return QueryRunResult.objects.filter(
+                pk=self.pk, result_data_csv__isnull=False
+            ).exists()
+        return self.result_data_csv is not None
+
     class Meta:
         # verbose_name = "Query Run Result"
         # verbose_name_plural = "Query Run Results"
         ordering = ["-executed_at"]
+        indexes = [
+            models.Index(
+                fields=["bigquery_job_state"],
+                name="run_result_job_pending_idx",
+                condition=models.Q(bigquery_job_state__in=["PENDING", "RUNNING"]),
+            ),
+        ]
 
 
 class QueryExecution(models.Model):
@@ -199,3 +303,23 @@ class QueryExecution(models.Model):
         verbose_name = "Query Execution Record"
         verbose_name_plural = "Query Execution Records"
         ordering = ["-started_at"]
+
+
+class AdHocQueryUsage(models.Model):
+    """
+    不屬於任何 QueryDefinition 的 BigQuery 用量 (例如編輯器的 Test Query)。
+    client 的 bytes 預算同時加總這裡與 QueryRunResult 的 bytes_billed。
+    """
+
+    bigquery_dataset_id = models.CharField(max_length=255, db_index=True)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    executed_at = models.DateTimeField(auto_now_add=True)
+    bigquery_job_id = models.CharField(max_length=255, null=True, blank=True)
+    bytes_processed = models.BigIntegerField(null=True, blank=True)
+    bytes_billed = models.BigIntegerField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.bigquery_dataset_id} - {self.bytes_billed or 0} bytes at {self.executed_at}"
+
+    class Meta:
+        ordering = ["-executed_at"]
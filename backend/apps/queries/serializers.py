@@ -13,7 +13,8 @@ class QueryRunResultSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = QueryRunResult
-        fields = ['id', 'executed_at', 'status', 'error_message', 'result_message', 'result_output_link']
+        fields = ['id', 'executed_at', 'status', 'error_message', 'result_message', 'result_output_link', 'reused_from',
+                  'estimated_bytes_processed', 'bytes_billed', 'destination_table']
 
 
 class QueryDefinitionSerializer(serializers.ModelSerializer):
@@ -26,10 +27,11 @@ class QueryDefinitionSerializer(serializers.ModelSerializer):
         model = QueryDefinition
         fields = [
             'id', 'name', 'sql_query', 'bigquery_project_id', 'bigquery_dataset_id',
-            'schedule_type', 'cron_schedule',       
+            'schedule_type', 'cron_schedule', 'schedule_window_minutes', 'next_run_at',
             'output_target', 'output_config',       
             'last_run_status', 'last_run_initiated_at', 'last_successful_run_result',
-            'last_successful_test_hash', 'last_tested_at',
+            'last_successful_test_hash', 'last_tested_at', 'referenced_tables',
+            'materialized_table', 'materialized_at',
             'owner', 'created_at', 'updated_at', 'description', 
             'latest_status',
             'latest_execution_time',
@@ -38,15 +40,23 @@ class QueryDefinitionSerializer(serializers.ModelSerializer):
         read_only_fields = [
             'owner', 'last_run_status', 'last_run_initiated_at',
             'created_at', 'updated_at', 'last_successful_run_result',
-            'last_successful_test_hash', 'last_tested_at'
+            'last_successful_test_hash', 'last_tested_at', 'referenced_tables',
+            'materialized_table', 'materialized_at', 'next_run_at',
         ]
 
+    @staticmethod
+    def _latest_run_result(obj):
+        # 使用 get_queryset 預先載入的 run_results (Meta ordering 為 -executed_at)，
+        # order_by().first() 會另外查詢並繞過 defer("result_data_csv")
+        run_results = obj.run_results.all()
+        return run_results[0] if run_results else None
+
     def get_latest_status(self, obj):
-        latest_result = obj.run_results.order_by('-executed_at').first()
+        latest_result = self._latest_run_result(obj)
         return latest_result.status if latest_result else 'PENDING'
 
     def get_latest_execution_time(self, obj):
-        latest_result = obj.run_results.order_by('-executed_at').first()
+        latest_result = self._latest_run_result(obj)
         return latest_result.executed_at.strftime('%Y-%m-%d %H:%M') if latest_result and latest_result.executed_at else None
 
     def get_has_downloadable_result(self, obj):
@@ -54,7 +64,7 @@ class QueryDefinitionSerializer(serializers.ModelSerializer):
         if latest_result:
             return (
                 latest_result.status in ['SUCCESS', 'OUTPUT_ERROR'] and
-                latest_result.result_data_csv is not None and
+                latest_result.has_result_data() and
                 latest_result.executed_at and
                 latest_result.executed_at > timezone.now() - timedelta(days=30)
             )
@@ -1,19 +1,159 @@
 # services/bq_services.py
+import json
+import re
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from django.conf import settings
 from google.cloud import bigquery
 from google.api_core import exceptions
 
+try:
+    # 選用套件：有安裝時改走 BigQuery Storage Read API，否則使用 REST 分頁讀取
+    from google.cloud import bigquery_storage
+except ImportError:
+    bigquery_storage = None
+
+# BigQuery 欄位型態對應到 Arrow 型態；未列出的型態 (RECORD、JSON、GEOGRAPHY...) 以字串儲存
+_BQ_TO_ARROW_TYPES = {
+    "STRING": pa.string(),
+    "INTEGER": pa.int64(),
+    "INT64": pa.int64(),
+    "FLOAT": pa.float64(),
+    "FLOAT64": pa.float64(),
+    "NUMERIC": pa.decimal128(38, 9),
+    "BIGNUMERIC": pa.decimal256(76, 38),
+    "BOOLEAN": pa.bool_(),
+    "BOOL": pa.bool_(),
+    "DATE": pa.date32(),
+    "DATETIME": pa.timestamp("us"),
+    "TIMESTAMP": pa.timestamp("us", tz="UTC"),
+    "TIME": pa.time64("us"),
+    "BYTES": pa.binary(),
+}
+
+
+def bigquery_schema_to_arrow(schema_fields) -> pa.Schema:
+    """將 BigQuery 的 SchemaField 列表轉成 Arrow schema。"""
+    arrow_fields = []
+    for field in schema_fields:
+        arrow_type = _BQ_TO_ARROW_TYPES.get(field.field_type, pa.string())
+        if field.mode == "REPEATED":
+            arrow_type = pa.string()
+        arrow_fields.append(pa.field(field.name, arrow_type))
+    return pa.schema(arrow_fields)
+
+
+def _to_string_value(value):
+    if value is None or isinstance(value, str):
+        return value
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, default=str, ensure_ascii=False)
+    return str(value)
+
+
+def conform_record_batch(batch: pa.RecordBatch, arrow_schema: pa.Schema) -> pa.RecordBatch:
+    """
+    將 BigQuery 回傳的 RecordBatch 轉成 arrow_schema 的型態。
+    大部分欄位型態相同或可直接 cast (向量化)；只有 RECORD / REPEATED 這類巢狀欄位
+    需要逐筆轉成 JSON 字串。
+    """
+    arrays = []
+    for field in arrow_schema:
+        column = batch.column(batch.schema.get_field_index(field.name))
+        if column.type != field.type:
+            if pa.types.is_nested(column.type):
+                column = pa.array(
+                    [_to_string_value(value) for value in column.to_pylist()],
+                    type=field.type,
+                )
+            else:
+                column = pc.cast(column, field.type)
+        arrays.append(column)
+    return pa.RecordBatch.from_arrays(arrays, schema=arrow_schema)
+
+
+class BudgetExceededError(Exception):
+    """查詢超過 client 的 bytes billed 預算 (dry run 預估或 maximum_bytes_billed 上限)。"""
+
+
+# 結果直接寫入 BigQuery 資料表 (output_target = BIGQUERY_TABLE) 的寫入方式
+DESTINATION_DISPOSITIONS = ("OVERWRITE", "APPEND", "PARTITION_REPLACE")
+_TABLE_NAME_RE = re.compile(r"^[A-Za-z0-9_]{1,1024}$")
+
+
+def validate_table_name(table_name) -> str:
+    """目的資料表只能建立在 client 的 dataset 中，因此只接受單一段的資料表名稱。"""
+    table_name = str(table_name or "").strip()
+    if not _TABLE_NAME_RE.match(table_name):
+        raise ValueError(f"Invalid destination table name: '{table_name}'")
+    return table_name
+
+
+def _is_bytes_billed_limit_error(error) -> bool:
+    return any(
+        item.get("reason") == "bytesBilledLimitExceeded" for item in (error.errors or [])
+    )
+
+
+def _query_error(error) -> Exception:
+    """將查詢 job 的錯誤轉成 task 處理的例外類型。"""
+    if isinstance(error, exceptions.BadRequest):
+        if _is_bytes_billed_limit_error(error):
+            return BudgetExceededError(f"BigQuery bytes billed limit exceeded: {str(error)}")
+        return ValueError(f"BigQuery SQL Syntax Error: {str(error)}")
+    if isinstance(error, exceptions.Forbidden):
+        return PermissionError(f"BigQuery Permission Denied: {str(error)}")
+    return RuntimeError(f"BigQuery Query Execution Failed: {str(error)}")
+
+
+def job_error(query_job):
+    """已完成的 query job 失敗時回傳對應的例外 (與 execute_query 相同的類型)，成功時回傳 None。"""
+    if not query_job.error_result:
+        return None
+    error = query_job.exception()
+    if error is None:
+        return RuntimeError(f"BigQuery Query Execution Failed: {query_job.error_result.get('message')}")
+    return _query_error(error)
+
+
 class BigQueryService:
     def __init__(self, project_id=None):
         self.client = bigquery.Client(project=project_id)
 
-    def execute_query(self, sql: str):
+    def _get_bqstorage_client(self):
+        if bigquery_storage is None or not settings.QUERY_RESULT_USE_STORAGE_API:
+            return None
+        return bigquery_storage.BigQueryReadClient(credentials=self.client._credentials)
+
+    def execute_query(self, sql: str, page_size: int = None, maximum_bytes_billed: int = None):
         """
         執行 BigQuery 查詢。
         返回一個迭代器 (rows)、schema 資訊和 job 統計。
+        page_size 控制每次向 BigQuery 取回的資料列數 (每一頁)。
+        maximum_bytes_billed 為 job 的計費上限，超過時 BigQuery 會直接拒絕執行。
         """
+        query_job = self.submit_query(sql, maximum_bytes_billed=maximum_bytes_billed)
+        return self.get_query_results(query_job, page_size=page_size) # 等待查詢完成
+
+    def submit_query(self, sql: str, maximum_bytes_billed: int = None):
+        """送出查詢 job 後立即返回，不等待完成 (submit-and-poll 模式)。"""
         try:
-            query_job = self.client.query(sql)
-            results = query_job.result() # 等待查詢完成
+            job_config = bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed)
+            return self.client.query(sql, job_config=job_config)
+        except Exception as e:
+            raise _query_error(e)
+
+    def get_job(self, job_id: str, project_id: str = None, location: str = None):
+        return self.client.get_job(job_id, project=project_id, location=location)
+
+    def get_query_results(self, query_job, page_size: int = None):
+        """
+        取得 query job 的結果；job 尚未完成時會等待。
+        返回一個迭代器 (rows)、schema 資訊和 job 統計。
+        """
+        try:
+            results = query_job.result(page_size=page_size)
 
             # 獲取 schema 資訊
             schema_fields = results.schema
@@ -21,17 +161,296 @@ class BigQueryService:
             # 獲取 job 統計資訊 (例如處理的位元組數)
             job_stats = {
                 "total_bytes_processed": query_job.total_bytes_processed,
+                "total_bytes_billed": query_job.total_bytes_billed,
                 "total_rows": results.total_rows,
                 "job_id": query_job.job_id,
             }
             return results, schema_fields, job_stats # results 是一個迭代器
+        except Exception as e:
+            raise _query_error(e)
+
+    def dry_run(self, sql: str):
+        """
+        以 dry run 驗證查詢 (不收費、不執行)，回傳的 job 包含 referenced_tables
+        與預估的 total_bytes_processed。
+        """
+        try:
+            job_config = bigquery.QueryJobConfig(dry_run=True, use_query_cache=False)
+            return self.client.query(sql, job_config=job_config)
+        except exceptions.BadRequest as e:
+            raise ValueError(f"BigQuery SQL Syntax Error: {str(e)}")
+        except exceptions.Forbidden as e:
+            raise PermissionError(f"BigQuery Permission Denied: {str(e)}")
+        except Exception as e:
+            raise RuntimeError(f"BigQuery Dry Run Failed: {str(e)}")
+
+    def get_source_table_versions(self, table_refs):
+        """
+        回傳 {table_id: last_modified ISO 字串}。
+        若任一來源不是一般資料表 (VIEW、外部表等無法以 last_modified 判斷是否變動)，
+        或仍有 streaming buffer 尚未寫入，則回傳 None 表示結果不可快取。
+        """
+        versions = {}
+        for table_ref in table_refs:
+            table = self.client.get_table(table_ref)
+            if table.table_type != "TABLE" or table.streaming_buffer is not None:
+                return None
+            table_id = f"{table.project}.{table.dataset_id}.{table.table_id}"
+            versions[table_id] = table.modified.isoformat()
+        return versions
+
+    def get_modified_partitions(self, table_ids, since):
+        """
+        以 INFORMATION_SCHEMA.PARTITIONS 找出各資料表在 since 之後修改過的分區。
+        回傳 ({table_id: [partition_id, ...]}, bytes_billed)；
+        不在結果中的 table_id 表示沒有分區資訊 (VIEW、外部表、萬用字元資料表等)。
+        未分區的資料表以 None 作為 partition_id。
+        """
+        tables_by_dataset = {}
+        for table_id in table_ids:
+            parts = table_id.split(".")
+            if len(parts) == 3 and not parts[2].endswith("*"):
+                tables_by_dataset.setdefault((parts[0], parts[1]), []).append(parts[2])
+
+        modified, bytes_billed = {}, 0
+        for (project_id, dataset_id), table_names in tables_by_dataset.items():
+            sql = (
+                "SELECT table_name, ARRAY_AGG("
+                "IF(last_modified_time > @since, IFNULL(partition_id, ''), NULL) IGNORE NULLS"
+                ") AS modified_partitions "
+                f"FROM `{project_id}.{dataset_id}`.INFORMATION_SCHEMA.PARTITIONS "
+                "WHERE table_name IN UNNEST(@table_names) GROUP BY table_name"
+            )
+            job_config = bigquery.QueryJobConfig(
+                query_parameters=[
+                    bigquery.ScalarQueryParameter("since", "TIMESTAMP", since),
+                    bigquery.ArrayQueryParameter("table_names", "STRING", table_names),
+                ]
+            )
+            query_job = self.client.query(sql, job_config=job_config)
+            for row in query_job.result():
+                modified[f"{project_id}.{dataset_id}.{row['table_name']}"] = [
+                    partition_id or None for partition_id in (row["modified_partitions"] or [])
+                ]
+            bytes_billed += query_job.total_bytes_billed or 0
+        return modified, bytes_billed
+
+    def table_exists(self, table_id: str) -> bool:
+        try:
+            self.client.get_table(table_id)
+            return True
+        except exceptions.NotFound:
+            return False
+
+    def delete_table(self, table_id: str):
+        self.client.delete_table(table_id, not_found_ok=True)
+
+    def execute_query_to_table(self, sql: str, destination_table: str, disposition: str,
+                               partition_field: str = None, maximum_bytes_billed: int = None,
+                               partitions: list = None):
+        """
+        將查詢結果直接寫入 destination_table (project.dataset.table)，資料不經過 worker。
+        disposition:
+        - OVERWRITE: 覆蓋整個資料表 (WRITE_TRUNCATE)
+        - APPEND: 追加到資料表 (WRITE_APPEND)
+        - PARTITION_REPLACE: 只覆蓋查詢結果中出現的日期分區 (以 partition_field 依日分區)；
+          指定 partitions (date 列表) 時只計算並覆蓋這些分區，結果中沒有資料的分區會被清空
+        新建立的資料表在指定 partition_field 時依日分區。
+        回傳 job 統計 (job_id、bytes、寫入的列數)。
+        """
+        if disposition not in DESTINATION_DISPOSITIONS:
+            raise ValueError(f"Unsupported write disposition: {disposition}")
+        if disposition == "PARTITION_REPLACE" and not partition_field:
+            raise ValueError("Partition field is required for PARTITION_REPLACE.")
+
+        try:
+            existing_table = None
+            if disposition == "PARTITION_REPLACE":
+                try:
+                    existing_table = self.client.get_table(destination_table)
+                except exceptions.NotFound:
+                    existing_table = None
+            if partitions is not None and existing_table is None:
+                raise ValueError(f"Destination table {destination_table} does not exist.")
+
+            if existing_table is not None:
+                # 資料表已存在：以單一 MERGE 陳述式刪除結果中出現的分區並插入新資料 (原子性)
+                query_job = self.client.query(
+                    self._partition_replace_script(sql, existing_table, partition_field, partitions),
+                    job_config=bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed),
+                )
+                rows = list(query_job.result())
+                rows_written = rows[0]["row_count"] if rows else 0
+            else:
+                job_config = bigquery.QueryJobConfig(
+                    destination=destination_table,
+                    create_disposition=bigquery.CreateDisposition.CREATE_IF_NEEDED,
+                    write_disposition=(
+                        bigquery.WriteDisposition.WRITE_APPEND
+                        if disposition == "APPEND"
+                        else bigquery.WriteDisposition.WRITE_TRUNCATE
+                    ),
+                    maximum_bytes_billed=maximum_bytes_billed,
+                )
+                if partition_field:
+                    # 資料表不存在時依日分區建立 (已存在的資料表沿用原本的分區設定)
+                    job_config.time_partitioning = bigquery.TimePartitioning(
+                        type_=bigquery.TimePartitioningType.DAY, field=partition_field
+                    )
+                query_job = self.client.query(sql, job_config=job_config)
+                # 只等待 job 完成並取得列數，不讀取任何資料列
+                rows_written = query_job.result().total_rows
+
+            return {
+                "total_bytes_processed": query_job.total_bytes_processed,
+                "total_bytes_billed": query_job.total_bytes_billed,
+                "total_rows": rows_written,
+                "job_id": query_job.job_id,
+            }
         except exceptions.BadRequest as e:
+            if _is_bytes_billed_limit_error(e):
+                raise BudgetExceededError(f"BigQuery bytes billed limit exceeded: {str(e)}")
             raise ValueError(f"BigQuery SQL Syntax Error: {str(e)}")
         except exceptions.Forbidden as e:
             raise PermissionError(f"BigQuery Permission Denied: {str(e)}")
+        except ValueError:
+            raise
         except Exception as e:
             raise RuntimeError(f"BigQuery Query Execution Failed: {str(e)}")
 
+    def replace_table_with_query(self, sql: str, table_id: str, partition_field: str = None,
+                                 maximum_bytes_billed: int = None):
+        """
+        以 CREATE OR REPLACE TABLE ... AS 重建 table_id (project.dataset.table)：新資料表在查詢成功後才原子地取代舊表，
+        查詢失敗或超過預算時舊表維持不變，schema 與分區設定 (partition_field 依日分區) 也一併更新。
+        回傳 job 統計 (job_id、bytes、資料表的列數)。
+        """
+        try:
+            partition_clause = ""
+            if partition_field:
+                # 先以 dry run 取得結果 schema：DATE 欄位直接分區，TIMESTAMP / DATETIME 取日期
+                field_types = {field.name: field.field_type for field in self.dry_run(sql).schema or []}
+                if partition_field not in field_types:
+                    raise ValueError(f"Partition field '{partition_field}' is not in the query result.")
+                if field_types[partition_field] == "DATE":
+                    partition_clause = f"PARTITION BY `{partition_field}`\n"
+                else:
+                    partition_clause = f"PARTITION BY DATE(`{partition_field}`)\n"
+            source_sql = sql.strip().rstrip(";")
+            query_job = self.client.query(
+                f"CREATE OR REPLACE TABLE `{table_id}`\n{partition_clause}AS (\n{source_sql}\n)",
+                job_config=bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed),
+            )
+            query_job.result()
+            return {
+                "total_bytes_processed": query_job.total_bytes_processed,
+                "total_bytes_billed": query_job.total_bytes_billed,
+                "total_rows": self.client.get_table(table_id).num_rows,
+                "job_id": query_job.job_id,
+            }
+        except exceptions.BadRequest as e:
+            if _is_bytes_billed_limit_error(e):
+                raise BudgetExceededError(f"BigQuery bytes billed limit exceeded: {str(e)}")
+            raise ValueError(f"BigQuery SQL Syntax Error: {str(e)}")
+        except exceptions.Forbidden as e:
+            raise PermissionError(f"BigQuery Permission Denied: {str(e)}")
+        except (ValueError, PermissionError):
+            raise
+        except Exception as e:
+            raise RuntimeError(f"BigQuery Query Execution Failed: {str(e)}")
+
+    @staticmethod
+    def _partition_replace_script(sql: str, table, partition_field: str, partitions: list = None) -> str:
+        partitioning = table.time_partitioning
+        if (
+            partitioning is None
+            or partitioning.field != partition_field
+            or partitioning.type_ != bigquery.TimePartitioningType.DAY
+        ):
+            raise ValueError(
+                f"Destination table {table.table_id} is not partitioned by day on '{partition_field}'."
+            )
+        field_types = {field.name: field.field_type for field in table.schema}
+        # DATE 欄位直接比較；TIMESTAMP / DATETIME 取日期
+        if field_types.get(partition_field) == "DATE":
+            day_template = "{alias}.`{field}`"
+        else:
+            day_template = "DATE({alias}.`{field}`)"
+
+        def day(alias):
+            return day_template.format(alias=alias, field=partition_field)
+
+        destination = f"`{table.project}.{table.dataset_id}.{table.table_id}`"
+        source_sql = sql.strip().rstrip(";")
+        if partitions is None:
+            statements = [
+                f"CREATE TEMP TABLE _lalae_source AS (\n{source_sql}\n);",
+                f"SET _lalae_partitions = (SELECT ARRAY_AGG(DISTINCT {day('s')} IGNORE NULLS) "
+                "FROM _lalae_source AS s);",
+            ]
+        else:
+            # 只計算指定的分區；以常值列出日期，外層條件才能下推成來源資料表的分區篩選
+            dates = "[" + ", ".join(f"DATE '{partition.isoformat()}'" for partition in sorted(partitions)) + "]"
+            statements = [
+                f"SET _lalae_partitions = {dates};",
+                f"CREATE TEMP TABLE _lalae_source AS (\nSELECT * FROM (\n{source_sql}\n) AS q "
+                f"WHERE {day('q')} IN UNNEST({dates})\n);",
+            ]
+        return "\n".join(
+            ["DECLARE _lalae_partitions ARRAY<DATE>;"]
+            + statements
+            + [
+                f"MERGE {destination} AS t USING _lalae_source AS s ON FALSE\n"
+                f"WHEN NOT MATCHED BY SOURCE AND {day('t')} IN UNNEST(_lalae_partitions) THEN DELETE\n"
+                "WHEN NOT MATCHED THEN INSERT ROW;",
+                "SELECT COUNT(*) AS row_count FROM _lalae_source;",
+            ]
+        )
+
+    def iter_row_chunks(self, results, chunk_size: int):
+        """
+        逐頁讀取 RowIterator，並以最多 chunk_size 列的 list 產出資料。
+        任何時間點只會保留一個 chunk 在記憶體中。
+        """
+        chunk = []
+        for page in results.pages:
+            for row in page:
+                chunk.append(row.values())
+                if len(chunk) >= chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def iter_record_batches(self, results, chunk_size: int, arrow_schema: pa.Schema):
+        """
+        與 iter_row_chunks 相同，但每個 chunk 會轉成符合 arrow_schema 的 RecordBatch。
+        """
+        for rows in self.iter_row_chunks(results, chunk_size):
+            columns = list(zip(*rows))
+            arrays = []
+            for index, field in enumerate(arrow_schema):
+                values = columns[index]
+                if pa.types.is_string(field.type):
+                    values = [_to_string_value(value) for value in values]
+                arrays.append(pa.array(values, type=field.type))
+            yield pa.RecordBatch.from_arrays(arrays, schema=arrow_schema)
+
+    def iter_arrow_batches(self, results, arrow_schema: pa.Schema):
+        """
+        以 Arrow 格式逐頁讀取查詢結果 (REST 分頁或 Storage Read API 的 stream)，
+        每個 RecordBatch 以向量化方式轉成 arrow_schema 後產出，不需逐格處理。
+        """
+        bqstorage_client = self._get_bqstorage_client()
+        batches = results.to_arrow_iterable(
+            bqstorage_client=bqstorage_client,
+            max_queue_size=2,
+            max_stream_count=settings.QUERY_RESULT_STORAGE_API_MAX_STREAMS,
+        )
+        for batch in batches:
+            if batch.num_rows:
+                yield conform_record_batch(batch, arrow_schema)
+
     def save_results_to_gcs(self, csv_data: str, gcs_path: str):
         """
         將 CSV 資料儲存到 Google Cloud Storage。
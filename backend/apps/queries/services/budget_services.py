@@ -0,0 +1,112 @@
+# services/budget_services.py
+# 每個 Client 的 BigQuery bytes billed 預算。
+# 用量 = 該 client dataset 底下所有 QueryRunResult 與 AdHocQueryUsage (Test Query) 的 bytes_billed 加總，
+# 剩餘量另外扣除尚未完成的 run 的 dry run 預估量 (同時派發的多個查詢不會各自拿到全部的剩餘預算)，
+# 日/月以 settings.TIME_ZONE 的當地時間計算。
+from django.db.models import Sum
+from django.utils import timezone
+
+from apps.clients.models import Client
+from ..models import AdHocQueryUsage, QueryRunResult
+from .bq_services import BudgetExceededError
+
+# 與 tasks.IN_FLIGHT_RUN_STATES 相同 (tasks 會匯入此模組，這裡不能反向匯入)
+IN_FLIGHT_RUN_STATES = ["PENDING", "RUNNING", "RETRYING"]
+
+
+def get_client_for_dataset(dataset_id: str):
+    return Client.objects.filter(bigquery_dataset_id=dataset_id).first()
+
+
+def _period_starts(now=None):
+    local_now = timezone.localtime(now or timezone.now())
+    day_start = local_now.replace(hour=0, minute=0, second=0, microsecond=0)
+    month_start = day_start.replace(day=1)
+    return day_start, month_start
+
+
+def _bytes_billed_since(client: Client, since) -> int:
+    run_total = QueryRunResult.objects.filter(
+        query__bigquery_dataset_id=client.bigquery_dataset_id,
+        executed_at__gte=since,
+    ).aggregate(total=Sum("bytes_billed"))["total"]
+    ad_hoc_total = AdHocQueryUsage.objects.filter(
+        bigquery_dataset_id=client.bigquery_dataset_id,
+        executed_at__gte=since,
+    ).aggregate(total=Sum("bytes_billed"))["total"]
+    return (run_total or 0) + (ad_hoc_total or 0)
+
+
+def record_ad_hoc_usage(query_job, dataset_id: str, user=None):
+    """記錄不屬於 QueryDefinition 的查詢 job 用量，讓它計入 client 的預算。"""
+    return AdHocQueryUsage.objects.create(
+        bigquery_dataset_id=dataset_id,
+        user=user if user is not None and user.is_authenticated else None,
+        bigquery_job_id=query_job.job_id,
+        bytes_processed=query_job.total_bytes_processed,
+        bytes_billed=query_job.total_bytes_billed,
+    )
+
+
+def _bytes_reserved_since(client: Client, since, exclude_run_id=None) -> int:
+    """排隊、執行中或等待重試且尚未記錄 bytes_billed 的 run 的預估量 (包含等待 poll_bigquery_jobs 的 job)。"""
+    runs = QueryRunResult.objects.filter(
+        query__bigquery_dataset_id=client.bigquery_dataset_id,
+        executed_at__gte=since,
+        status__in=IN_FLIGHT_RUN_STATES,
+        bytes_billed__isnull=True,
+    )
+    if exclude_run_id is not None:
+        runs = runs.exclude(pk=exclude_run_id)
+    return runs.aggregate(total=Sum("estimated_bytes_processed"))["total"] or 0
+
+
+def get_budget_usage(client: Client, exclude_run_id=None) -> dict:
+    """
+    回傳 client 今日與本月的 bytes billed 用量、進行中 run 的預估量 (reserved)、預算與剩餘量
+    (預算為 None 表示不限制)。exclude_run_id 為正在檢查預算的 run，不計入 reserved。
+    """
+    day_start, month_start = _period_starts()
+    usage = {}
+    for period, since, budget in (
+        ("daily", day_start, client.daily_bytes_budget),
+        ("monthly", month_start, client.monthly_bytes_budget),
+    ):
+        used = _bytes_billed_since(client, since)
+        reserved = _bytes_reserved_since(client, since, exclude_run_id)
+        usage[period] = {
+            "period_start": since.isoformat(),
+            "bytes_billed": used,
+            "reserved": reserved,
+            "budget": budget,
+            "remaining": max(budget - used - reserved, 0) if budget is not None else None,
+        }
+    return usage
+
+
+def get_remaining_bytes(client: Client, exclude_run_id=None):
+    """回傳今日/本月預算中較小的剩餘量；client 沒有設定任何預算時回傳 None。"""
+    if client is None:
+        return None
+    remaining = [
+        period["remaining"]
+        for period in get_budget_usage(client, exclude_run_id).values()
+        if period["remaining"] is not None
+    ]
+    return min(remaining) if remaining else None
+
+
+def check_budget(client: Client, estimated_bytes: int, exclude_run_id=None):
+    """
+    以 dry run 的預估量檢查預算，超過時拋出 BudgetExceededError。
+    回傳剩餘 bytes (作為 job 的 maximum_bytes_billed)，沒有預算時回傳 None。
+    """
+    remaining = get_remaining_bytes(client, exclude_run_id)
+    if remaining is None:
+        return None
+    if remaining <= 0 or (estimated_bytes or 0) > remaining:
+        raise BudgetExceededError(
+            f"Estimated {estimated_bytes or 0} bytes exceeds the remaining BigQuery budget "
+            f"of client '{client.name}' ({remaining} bytes left)."
+        )
+    return remaining
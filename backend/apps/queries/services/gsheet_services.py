@@ -1,8 +1,20 @@
 # services/gsheet_services.py
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from django.conf import settings
 import os
 import json
+import random
+import re
+import threading
+import time
+
+# 可重試的 HTTP 狀態：配額 (429) 與暫時性的伺服器錯誤
+_RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+_RANGE_LAST_ROW_RE = re.compile(r"[A-Z]+(\d+)$")
 
 class GSheetService:
     def __init__(self):
@@ -24,6 +36,98 @@ class GSheetService:
             self.service = build('sheets', 'v4')
         except Exception as e:    
             raise RuntimeError(f"Failed to initialize Google Sheets Service: {str(e)}")
+        # googleapiclient 的 http 物件不是 thread-safe，平行寫入時每個 thread 各自建立 service
+        self._local = threading.local()
+
+    def thread_service(self):
+        if not hasattr(self._local, "service"):
+            self._local.service = build('sheets', 'v4')
+        return self._local.service
+
+    def get_last_row(self, sheet_id: str, tab_name: str) -> int:
+        """回傳工作表最後一列有資料的列號 (空白工作表回傳 0)。"""
+        try:
+            result = self.service.spreadsheets().values().get(
+                spreadsheetId=sheet_id,
+                range=f"'{tab_name}'",
+                fields="range",
+            ).execute()
+        except Exception as e:
+            raise RuntimeError(f"Failed to read Google Sheet: {str(e)}")
+        # 有資料時回傳的 range 會縮到實際有資料的範圍，例如 'Sheet1'!A1:F120；
+        # 空白工作表則回傳整個 grid，因此再確認最後一列是否真的有資料
+        match = _RANGE_LAST_ROW_RE.search(result.get("range", ""))
+        if not match:
+            return 0
+        last_row = int(match.group(1))
+        try:
+            last_row_values = self.service.spreadsheets().values().get(
+                spreadsheetId=sheet_id,
+                range=f"'{tab_name}'!{last_row}:{last_row}",
+                fields="values",
+            ).execute()
+        except Exception as e:
+            raise RuntimeError(f"Failed to read Google Sheet: {str(e)}")
+        return last_row if last_row_values.get("values") else 0
+
+    def read_rows(self, sheet_id: str, tab_name: str, start_row: int, end_row: int) -> list:
+        """讀取 start_row 到 end_row (含) 的資料列，每列為 list (尾端空白儲存格會被省略)。"""
+        try:
+            result = self.service.spreadsheets().values().get(
+                spreadsheetId=sheet_id,
+                range=f"'{tab_name}'!{start_row}:{end_row}",
+                valueRenderOption="UNFORMATTED_VALUE",
+            ).execute()
+        except Exception as e:
+            raise RuntimeError(f"Failed to read Google Sheet: {str(e)}")
+        rows = result.get("values", [])
+        return rows + [[] for _ in range(end_row - start_row + 1 - len(rows))]
+
+    def write_rows_at(self, sheet_id: str, tab_name: str, start_row: int, rows: list):
+        """將 rows 寫到 start_row 開始的位置。"""
+        return self.write_blocks(sheet_id, tab_name, [(start_row, rows)])
+
+    def write_blocks(self, sheet_id: str, tab_name: str, blocks: list):
+        """
+        以一個 values.batchUpdate 請求寫入多個區塊，blocks 為 [(start_row, rows), ...]。
+        遇到 429 / 5xx 時以指數退避 (加上隨機 jitter) 重試整個請求。
+        """
+        body = {
+            "valueInputOption": "RAW",
+            "data": [
+                {"range": f"'{tab_name}'!A{start_row}", "values": rows}
+                for start_row, rows in blocks
+            ],
+        }
+        max_attempts = settings.GSHEET_WRITE_MAX_RETRIES + 1
+        for attempt in range(max_attempts):
+            try:
+                return self.thread_service().spreadsheets().values().batchUpdate(
+                    spreadsheetId=sheet_id, body=body
+                ).execute()
+            except HttpError as e:
+                if e.resp.status not in _RETRYABLE_STATUSES or attempt == max_attempts - 1:
+                    raise RuntimeError(f"Failed to write to Google Sheet: {str(e)}")
+            except (ConnectionError, TimeoutError) as e:
+                if attempt == max_attempts - 1:
+                    raise RuntimeError(f"Failed to write to Google Sheet: {str(e)}")
+            delay = min(settings.GSHEET_WRITE_BACKOFF_BASE * (2 ** attempt), 64)
+            delay += random.uniform(0, 1)
+            print(f"[GSHEET] Write from row {blocks[0][0]} ({len(blocks)} blocks) retry in {delay:.1f}s (attempt {attempt + 1}).")
+            time.sleep(delay)
+
+    def clear_sheet(self, sheet_id: str, tab_name: str):
+        """
+        清除工作表內既有的資料 (覆蓋模式在分批寫入前使用，避免殘留舊資料列)。
+        """
+        try:
+            self.service.spreadsheets().values().clear(
+                spreadsheetId=sheet_id,
+                range=f"'{tab_name}'",
+                body={}
+            ).execute()
+        except Exception as e:
+            raise RuntimeError(f"Failed to clear Google Sheet: {str(e)}")
 
     def write_to_sheet(self, sheet_id: str, tab_name: str, column_names: list, data: list, append_mode: bool):
         """
@@ -67,4 +171,100 @@ class GSheetService:
                 ).execute()
                 print(f"Updated {result.get('updatedCells')} cells in Google Sheet.")
         except Exception as e:
-            raise RuntimeError(f"Failed to write to Google Sheet: {str(e)}")
\ No newline at end of file
+            raise RuntimeError(f"Failed to write to Google Sheet: {str(e)}")
+
+
+class SheetBatchWriter:
+    """
+    將資料列切成大小有上限的批次 (列數與估計的 payload 位元組數)，
+    每一批寫到預先計算好的列位置，因此可以平行送出而不會互相影響順序。
+    同時進行的請求數受 GSHEET_WRITE_CONCURRENCY 限制 (Sheets API 的每分鐘寫入配額以 sheet 計算)。
+    """
+
+    def __init__(self, gsheet_service: GSheetService, sheet_id: str, tab_name: str, start_row: int):
+        self.gsheet_service = gsheet_service
+        self.sheet_id = sheet_id
+        self.tab_name = tab_name
+        self.next_row = start_row
+        self.concurrency = max(settings.GSHEET_WRITE_CONCURRENCY, 1)
+        self.max_chunk_rows = settings.GSHEET_WRITE_MAX_CHUNK_ROWS
+        self.max_chunk_bytes = settings.GSHEET_WRITE_MAX_CHUNK_BYTES
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self._pending = deque()
+
+    @staticmethod
+    def _row_bytes(row) -> int:
+        # 以 JSON 大小粗估 payload，加上分隔字元的額外負擔
+        return sum(len(str(value)) + 3 for value in row) + 2
+
+    def _requests(self, updates):
+        """
+        將 (row, values) 依序合併成連續的區塊，再切成列數與位元組數都有上限的請求，
+        每個請求為 [(start_row, rows), ...]。
+        """
+        request, request_rows, request_bytes = [], 0, 0
+        block_start, block_rows = None, []
+        for row_number, values in updates:
+            row_bytes = self._row_bytes(values)
+            if request_rows and (
+                request_rows >= self.max_chunk_rows
+                or request_bytes + row_bytes > self.max_chunk_bytes
+            ):
+                if block_rows:
+                    request.append((block_start, block_rows))
+                yield request
+                request, request_rows, request_bytes = [], 0, 0
+                block_start, block_rows = None, []
+            if block_rows and row_number != block_start + len(block_rows):
+                request.append((block_start, block_rows))
+                block_start, block_rows = None, []
+            if not block_rows:
+                block_start = row_number
+            block_rows.append(values)
+            request_rows += 1
+            request_bytes += row_bytes
+        if block_rows:
+            request.append((block_start, block_rows))
+        if request:
+            yield request
+
+    def _submit(self, blocks: list):
+        # 限制尚未完成的批次數，避免資料在記憶體中堆積；失敗的批次會在這裡拋出例外
+        while len(self._pending) >= self.concurrency * 2:
+            self._pending.popleft().result()
+        self._pending.append(
+            self._executor.submit(
+                self.gsheet_service.write_blocks, self.sheet_id, self.tab_name, blocks
+            )
+        )
+
+    def write_rows(self, rows: list):
+        """從目前的 next_row 開始依序寫入 rows。"""
+        start_row = self.next_row
+        self.next_row += len(rows)
+        for blocks in self._requests(
+            (start_row + offset, row) for offset, row in enumerate(rows)
+        ):
+            self._submit(blocks)
+
+    def write_at(self, updates: list):
+        """將 [(row_number, values), ...] 寫到指定的列 (相鄰的列會合併成同一個區塊)。"""
+        for blocks in self._requests(sorted(updates, key=lambda update: update[0])):
+            self._submit(blocks)
+
+    def flush(self):
+        """等待目前所有批次完成，任一批次失敗時拋出例外。"""
+        while self._pending:
+            self._pending.popleft().result()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def abort(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown(wait=True)
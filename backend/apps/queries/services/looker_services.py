@@ -5,6 +5,85 @@
 # 如果你需要觸發 Looker Studio 的數據源刷新，你需要使用 Looker API。
 # 但這通常只在數據源緩存非常激進或你需要立即更新報告時才需要。
 # 大多數情況下，只要 BigQuery 表格數據更新，Looker Studio 會在下次查看時自動顯示新數據。
+#
+# 因此 LOOKER_STUDIO 輸出會把每個 QueryDefinition 的結果物化成 client dataset 中的資料表，
+# 報表讀取預先計算好的結果，而不是每次載入都重新執行原始 SQL。
+# output_config：
+# - table_name：物化資料表名稱 (預設 looker_query_<id>)
+# - partition_field：結果表依這個 DATE / TIMESTAMP / DATETIME 欄位依日分區
+# - incremental_refresh：設為 true (且有 partition_field) 時，只重新計算來源資料表有變動的日期分區。
+#   前提是結果中 partition_field 為 D 的資料只來自來源資料表日期分區 D；
+#   使用滾動視窗 (例如近 7 日累計)、或報表日期與來源日期有位移的查詢不可開啟，否則未重算的分區會保留舊資料。
+#   未開啟時，來源有任何變動就完整重建 (來源都沒有變動時仍會略過刷新)。
+import hashlib
+from datetime import date, timedelta
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.utils import timezone
+
+from .bq_services import validate_table_name
+from .result_cache import is_cacheable_sql
+
+# INFORMATION_SCHEMA 的 last_modified_time 與 worker 的時鐘可能有誤差，往前多檢查一段時間
+_MODIFIED_SINCE_OVERLAP = timedelta(minutes=10)
+
+
+def materialized_table_id(query_def, output_config: dict) -> str:
+    table_name = output_config.get("table_name") or f"looker_query_{query_def.id}"
+    return ".".join(
+        [
+            query_def.bigquery_project_id or settings.GOOGLE_CLOUD_PROJECT_ID,
+            query_def.bigquery_dataset_id,
+            validate_table_name(table_name),
+        ]
+    )
+
+
+def looker_studio_report_url(table_id: str) -> str:
+    """以 Looker Studio Linking API 開啟一份以該 BigQuery 資料表為資料來源的報表。"""
+    project_id, dataset_id, table_name = table_id.split(".")
+    params = {
+        "ds.ds0.connector": "bigQuery",
+        "ds.ds0.type": "TABLE",
+        "ds.ds0.projectId": project_id,
+        "ds.ds0.datasetId": dataset_id,
+        "ds.ds0.tableId": table_name,
+        "ds.ds0.datasourceName": table_name,
+    }
+    return f"https://lookerstudio.google.com/reporting/create?{urlencode(params)}"
+
+
+def _partition_day(partition_id):
+    """將 INFORMATION_SCHEMA 的 partition_id 轉成日期；無法對應到單一日期時回傳 None。"""
+    # 日分區為 YYYYMMDD，時分區為 YYYYMMDDHH；月/年分區、__NULL__、__UNPARTITIONED__ 等無法對應
+    if partition_id is None or not partition_id.isdigit() or len(partition_id) not in (8, 10):
+        return None
+    try:
+        return date(int(partition_id[:4]), int(partition_id[4:6]), int(partition_id[6:8]))
+    except ValueError:
+        return None
+
+
+def changed_days(table_ids, modified_partitions: dict, incremental: bool):
+    """
+    依來源資料表修改過的分區決定刷新方式：
+    - 回傳空的 set：來源都沒有變動，不需要刷新
+    - 回傳日期的 set：只需要重新計算這些日期分區 (incremental 時)
+    - 回傳 None：需要完整刷新
+    """
+    days = set()
+    for table_id in table_ids:
+        if table_id not in modified_partitions:
+            # VIEW、外部表等無法得知是否變動
+            return None
+        for partition_id in modified_partitions[table_id]:
+            day = _partition_day(partition_id)
+            if day is None or not incremental:
+                return None
+            days.add(day)
+    return days
+
 
 class LookerService:
     def __init__(self):
@@ -12,6 +91,77 @@ class LookerService:
         # 這通常涉及 API 金鑰或 OAuth2 認證
         pass
 
+    def refresh_materialized_table(self, bq_service, query_def, output_config: dict,
+                                   maximum_bytes_billed: int = None) -> dict:
+        """
+        刷新 query_def 的物化資料表，並更新 query_def 的 materialized_* 欄位 (不會儲存)。
+        SQL、分區欄位或資料表名稱與上次不同、或資料表不存在時完整重建；
+        否則依 INFORMATION_SCHEMA.PARTITIONS 檢查來源是否變動，沒有變動時不執行查詢，
+        開啟 incremental_refresh 時只重新計算有變動的日期分區。
+        完整重建以 CREATE OR REPLACE TABLE 在查詢成功後才取代舊表，失敗時報表仍讀得到上一版資料。
+        """
+        table_id = materialized_table_id(query_def, output_config)
+        partition_field = output_config.get("partition_field") or None
+        incremental = bool(partition_field and output_config.get("incremental_refresh"))
+        sql = query_def.compiled_sql
+        sql_hash = hashlib.sha256(f"{table_id}\n{partition_field}\n{sql}".encode("utf-8")).hexdigest()
+        started_at = timezone.now()
+        stats = {
+            "table": table_id,
+            "mode": "FULL",
+            "partitions": [],
+            "total_rows": None,
+            "total_bytes_processed": 0,
+            "total_bytes_billed": 0,
+            "job_id": None,
+        }
+
+        reusable = (
+            query_def.materialized_table == table_id
+            and query_def.materialized_sql_hash == sql_hash
+            and query_def.materialized_at is not None
+            and bq_service.table_exists(table_id)
+        )
+        # days 為 None 表示完整刷新；使用 CURRENT_DATE 等函式的查詢每次結果都可能不同，一律完整刷新
+        days = None
+        if reusable and is_cacheable_sql(sql):
+            modified_partitions, metadata_bytes_billed = bq_service.get_modified_partitions(
+                query_def.referenced_tables, query_def.materialized_at - _MODIFIED_SINCE_OVERLAP
+            )
+            stats["total_bytes_billed"] += metadata_bytes_billed
+            days = changed_days(query_def.referenced_tables, modified_partitions, incremental)
+
+        if days is not None and not days:
+            stats["mode"] = "SKIPPED"
+            print(f"[LOOKER] {table_id}: source tables unchanged, refresh skipped.")
+        else:
+            if days is None:
+                # 定義改變時也會換成新的 schema 與分區設定
+                job_stats = bq_service.replace_table_with_query(
+                    sql, table_id,
+                    partition_field=partition_field,
+                    maximum_bytes_billed=maximum_bytes_billed,
+                )
+            else:
+                stats["mode"] = "INCREMENTAL"
+                stats["partitions"] = [day.isoformat() for day in sorted(days)]
+                job_stats = bq_service.execute_query_to_table(
+                    sql, table_id, "PARTITION_REPLACE",
+                    partition_field=partition_field,
+                    maximum_bytes_billed=maximum_bytes_billed,
+                    partitions=sorted(days),
+                )
+            stats["job_id"] = job_stats["job_id"]
+            stats["total_rows"] = job_stats["total_rows"]
+            stats["total_bytes_processed"] += job_stats["total_bytes_processed"] or 0
+            stats["total_bytes_billed"] += job_stats["total_bytes_billed"] or 0
+            print(f"[LOOKER] {table_id}: {stats['mode']} refresh, {stats['total_rows']} rows, partitions {stats['partitions']}.")
+
+        query_def.materialized_table = table_id
+        query_def.materialized_sql_hash = sql_hash
+        query_def.materialized_at = started_at
+        return stats
+
     def refresh_datasource(self, datasource_id: str):
         """
         模擬觸發 Looker Studio 數據源刷新。
@@ -26,4 +176,4 @@ class LookerService:
         # 例如: https://developers.google.com/looker/api/reference/Looker/sdk/SDK/looker_api_v4.py
         # 這是一個複雜的主題，可能需要根據你的 Looker Studio 數據源類型來決定如何操作
         # 如果是基於 BigQuery 的，通常不需要主動刷新，數據會自行更新。
-        return True
\ No newline at end of file
+        return True
@@ -0,0 +1,67 @@
+# services/result_cache.py
+# 查詢結果快取。
+# 快取鍵 = 正規化 SQL + project/dataset 的指紋，加上每個來源資料表的 last_modified。
+# 上游資料表沒有變動時，新的 QueryRunResult 直接沿用上一次成功執行的結果檔案，
+# 不再送出新的 BigQuery job。
+import hashlib
+import re
+
+from ..models import QueryRunResult
+
+# 字串常值與 `識別字` 原樣保留，只移除其外的註解並壓縮空白
+_SQL_PART_RE = re.compile(
+    r"(?P<literal>'''.*?'''|\"\"\".*?\"\"\"|'(?:\\.|[^'\\])*'|\"(?:\\.|[^\"\\])*\"|`[^`]*`)"
+    r"|(?P<gap>(?:\s+|--[^\n]*|#[^\n]*|/\*.*?\*/)+)",
+    re.DOTALL,
+)
+
+# 每次執行結果都可能不同的函式，使用到的查詢不做快取
+_NON_DETERMINISTIC_RE = re.compile(
+    r"\b(CURRENT_DATE|CURRENT_DATETIME|CURRENT_TIME|CURRENT_TIMESTAMP|"
+    r"RAND|GENERATE_UUID|SESSION_USER|NOW)\b",
+    re.IGNORECASE,
+)
+
+
+def normalize_sql(sql: str) -> str:
+    """移除註解、多餘空白與結尾分號。字串常值的大小寫會影響結果，因此不轉換大小寫。"""
+
+    def _replace(match):
+        return match.group("literal") or " "
+
+    sql = _SQL_PART_RE.sub(_replace, sql).strip()
+    return sql.rstrip(";").strip()
+
+
+def sql_fingerprint(sql: str, project_id: str, dataset_id: str) -> str:
+    key = f"{project_id}\n{dataset_id}\n{normalize_sql(sql)}"
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+def is_cacheable_sql(sql: str) -> bool:
+    return not _NON_DETERMINISTIC_RE.search(normalize_sql(sql))
+
+
+def find_cached_result(fingerprint: str, source_table_versions: dict, result_storage, exclude_id=None):
+    """
+    找出相同指紋且來源資料表版本完全相同的最近一次成功執行，且其結果檔案仍然存在。
+    找不到時回傳 None。
+    """
+    candidates = (
+        QueryRunResult.objects.filter(
+            sql_fingerprint=fingerprint,
+            source_table_versions=source_table_versions,
+            status="SUCCESS",
+        )
+        .exclude(result_storage_path__isnull=True)
+        .exclude(result_storage_path="")
+        .defer("result_data_csv")
+        .order_by("-completed_at")
+    )
+    if exclude_id is not None:
+        candidates = candidates.exclude(pk=exclude_id)
+
+    for candidate in candidates[:3]:
+        if result_storage.exists(candidate.result_storage_path):
+            return candidate
+    return None
@@ -0,0 +1,124 @@
+# services/result_download.py
+# 結果下載 (CSV) 的串流、gzip 壓縮與 HTTP Range 支援。
+# CSV 內容被切成數個 segment (標題列 + 每個 Parquet row group)，
+# 寫入結果檔案時已把每個 segment 的 CSV 位元組數記錄在 Parquet metadata 中，
+# 因此不需要先產生整份 CSV 就能知道 Content-Length，並只產生 Range 涵蓋的 segment。
+import json
+import re
+import zlib
+
+from .result_sinks import CSV_INDEX_METADATA_KEY, csv_bytes
+
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+_TEXT_CHUNK_SIZE = 64 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class CsvDownload:
+    """
+    以 segment 表示的 CSV 內容。每個 segment 為 (size, produce)，produce() 回傳該段的位元組；
+    size 為 None 表示大小未知 (舊的結果檔案沒有 CSV index)，此時不支援 Range。
+    """
+
+    def __init__(self, segments: list):
+        self.segments = segments
+
+    @classmethod
+    def from_result_file(cls, result_storage, uri: str) -> "CsvDownload":
+        parquet_file = result_storage.open_result(uri)
+        # {"header": int, "row_groups": [int, ...]}，舊的結果檔案沒有這個 metadata
+        key_value_metadata = parquet_file.metadata.metadata or {}
+        csv_index = None
+        if CSV_INDEX_METADATA_KEY.encode() in key_value_metadata:
+            csv_index = json.loads(key_value_metadata[CSV_INDEX_METADATA_KEY.encode()])
+            if len(csv_index["row_groups"]) != parquet_file.num_row_groups:
+                csv_index = None
+
+        empty_table = parquet_file.schema_arrow.empty_table()
+        segments = [
+            (
+                csv_index["header"] if csv_index else None,
+                lambda: csv_bytes(empty_table, include_header=True),
+            )
+        ]
+        for index in range(parquet_file.num_row_groups):
+            segments.append(
+                (
+                    csv_index["row_groups"][index] if csv_index else None,
+                    lambda index=index: csv_bytes(
+                        parquet_file.read_row_group(index), include_header=False
+                    ),
+                )
+            )
+        return cls(segments)
+
+    @classmethod
+    def from_text(cls, text: str) -> "CsvDownload":
+        """舊資料 (result_data_csv) 已經整份在記憶體中，切成固定大小的 segment 串流回傳。"""
+        data = text.encode("utf-8")
+        segments = []
+        for start in range(0, len(data), _TEXT_CHUNK_SIZE):
+            chunk = data[start:start + _TEXT_CHUNK_SIZE]
+            segments.append((len(chunk), lambda chunk=chunk: chunk))
+        return cls(segments)
+
+    @property
+    def total_size(self):
+        if any(size is None for size, _ in self.segments):
+            return None
+        return sum(size for size, _ in self.segments)
+
+    def iter_all(self):
+        for _, produce in self.segments:
+            data = produce()
+            if data:
+                yield data
+
+    def iter_range(self, start: int, end: int):
+        """產出第 start 到 end (含) 個位元組，只產生與範圍重疊的 segment。"""
+        offset = 0
+        for size, produce in self.segments:
+            segment_end = offset + size
+            if segment_end > start and offset <= end:
+                data = produce()
+                yield data[max(start - offset, 0):end - offset + 1]
+            offset = segment_end
+            if offset > end:
+                break
+
+
+def parse_range_header(range_header: str, total_size: int):
+    """
+    解析單一範圍的 Range header，回傳 (start, end)。
+    不支援的格式 (例如多重範圍) 回傳 None，呼叫端應回傳完整內容；
+    超出範圍時拋出 RangeNotSatisfiable。
+    """
+    match = _RANGE_RE.match(range_header.strip())
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # bytes=-N：最後 N 個位元組
+        length = int(last)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        start, end = max(total_size - length, 0), total_size - 1
+    else:
+        start = int(first)
+        end = min(int(last), total_size - 1) if last else total_size - 1
+    if start >= total_size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def gzip_chunks(chunks, level: int = 6):
+    """將位元組串流即時壓縮成 gzip 格式。"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
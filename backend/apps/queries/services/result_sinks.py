@@ -0,0 +1,383 @@
+# services/result_sinks.py
+# 查詢結果的串流輸出 (sink)。
+# run_bigquery_query_task 會把 BigQuery 的資料頁切成固定大小的 RecordBatch，
+# 再依序交給每個 sink 處理，因此任何時間點只有一個 chunk 留在記憶體中。
+import hashlib
+import io
+import json
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+
+from .gsheet_services import SheetBatchWriter
+
+
+# 結果檔案的 Parquet key-value metadata：每個 row group 轉成 CSV 後的位元組數，
+# 下載時用來計算 Content-Length 與處理 Range (見 result_download.py)
+CSV_INDEX_METADATA_KEY = "lalae.csv_index"
+
+
+def _iso_strings(column):
+    """
+    以向量化方式將日期/時間欄位轉成 ISO 8601 字串 (null 保持 null)，
+    與 Python 的 isoformat() 相同：秒的小數為 0 時省略，時區偏移為 +HH:MM。
+    """
+    if pa.types.is_timestamp(column.type):
+        unit = "us" if column.type.unit in ("s", "ms") else column.type.unit
+        column = pc.cast(column, pa.timestamp(unit, tz=column.type.tz))
+        if column.type.tz:
+            strings = pc.strftime(column, format="%Y-%m-%dT%H:%M:%S%z")
+            strings = pc.replace_substring_regex(strings, r"\.0+([+-]\d{4})$", r"\1")
+            return pc.replace_substring_regex(strings, r"([+-]\d{2})(\d{2})$", r"\1:\2")
+        strings = pc.strftime(column, format="%Y-%m-%dT%H:%M:%S")
+        return pc.replace_substring_regex(strings, r"\.0+$", "")
+    if pa.types.is_time(column.type):
+        column = pc.cast(column, pa.time64("us" if column.type.unit in ("s", "ms") else column.type.unit))
+        return pc.replace_substring_regex(pc.cast(column, pa.string()), r"\.0+$", "")
+    return pc.cast(column, pa.string())
+
+
+def _output_column(column, decimal_type):
+    if pa.types.is_temporal(column.type):
+        return _iso_strings(column)
+    if pa.types.is_decimal(column.type):
+        return pc.cast(column, decimal_type)
+    if pa.types.is_binary(column.type):
+        return pa.array(
+            [None if value is None else value.hex() for value in column.to_pylist()],
+            type=pa.string(),
+        )
+    return column
+
+
+def output_table(table, decimal_type=pa.string()) -> pa.Table:
+    """
+    將 RecordBatch / Table 轉成輸出用的型態：日期/時間轉 ISO 字串，
+    NUMERIC 依 decimal_type 轉換 (CSV 保留精度用字串，Google Sheets 用 float64)。
+    """
+    columns = [_output_column(column, decimal_type) for column in table.columns]
+    return pa.Table.from_arrays(columns, names=table.schema.names)
+
+
+def table_rows(table):
+    """將 RecordBatch 或 Table 轉成以 tuple 表示的資料列。"""
+    return zip(*[column.to_pylist() for column in table.columns])
+
+
+def sheet_values(table) -> list:
+    """轉成 Google Sheets API 使用的 values (list of list)。"""
+    converted = output_table(table, decimal_type=pa.float64())
+    return [list(row) for row in table_rows(converted)]
+
+
+def csv_bytes(table, include_header: bool) -> bytes:
+    """以 pyarrow.csv 將整個 row group 一次轉成 CSV (null 輸出為空字串)。"""
+    buffer = io.BytesIO()
+    pa_csv.write_csv(
+        output_table(table),
+        buffer,
+        write_options=pa_csv.WriteOptions(include_header=include_header, quoting_style="needed"),
+    )
+    return buffer.getvalue()
+
+
+class ResultSink:
+    """所有 sink 的共同介面。"""
+
+    def open(self, schema):
+        pass
+
+    def write_batch(self, batch):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def abort(self):
+        """串流過程失敗時呼叫，預設行為與 close 相同。"""
+        self.close()
+
+
+class RowCountSink(ResultSink):
+    def __init__(self):
+        self.row_count = 0
+
+    def write_batch(self, batch):
+        self.row_count += batch.num_rows
+
+
+class ParquetResultSink(ResultSink):
+    """
+    將結果逐 chunk 寫入 ResultStorage 的 Parquet 檔案 (每個 chunk 一個 row group)，
+    取代原本存放在 QueryRunResult.result_data_csv 的整份字串。
+    """
+
+    def __init__(self, storage, uri: str):
+        self.storage = storage
+        self.uri = uri
+        self._writer = None
+        self._csv_index = {"header": 0, "row_groups": []}
+
+    def open(self, schema):
+        self._writer = self.storage.open_writer(self.uri, schema)
+        self._csv_index["header"] = len(csv_bytes(schema.empty_table(), include_header=True))
+
+    def write_batch(self, batch):
+        self._writer.write_batch(batch)
+        self._csv_index["row_groups"].append(len(csv_bytes(batch, include_header=False)))
+
+    def close(self):
+        if self._writer:
+            self._writer.add_metadata({CSV_INDEX_METADATA_KEY: json.dumps(self._csv_index)})
+            self._writer.close()
+
+    def abort(self):
+        if self._writer:
+            self._writer.abort()
+
+
+class GSheetSink(ResultSink):
+    """
+    將結果分批寫入 Google Sheet。
+    覆蓋模式會先清空工作表並寫入標題列；追加模式從目前最後一列的下一列開始。
+    每個 chunk 由 SheetBatchWriter 切成大小有上限的批次，寫到固定的列位置並平行送出。
+    """
+
+    def __init__(self, gsheet_service, sheet_id: str, tab_name: str, append_mode: bool):
+        self.gsheet_service = gsheet_service
+        self.sheet_id = sheet_id
+        self.tab_name = tab_name
+        self.append_mode = append_mode
+        self._writer = None
+
+    def open(self, schema):
+        if self.append_mode:
+            start_row = self.gsheet_service.get_last_row(self.sheet_id, self.tab_name) + 1
+        else:
+            self.gsheet_service.clear_sheet(self.sheet_id, self.tab_name)
+            self.gsheet_service.write_rows_at(self.sheet_id, self.tab_name, 1, [list(schema.names)])
+            start_row = 2
+        self._writer = SheetBatchWriter(
+            self.gsheet_service, self.sheet_id, self.tab_name, start_row
+        )
+
+    def write_batch(self, batch):
+        self._writer.write_rows(sheet_values(batch))
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+
+    def abort(self):
+        if self._writer:
+            self._writer.abort()
+
+
+class GSheetDiffSink(ResultSink):
+    """
+    Keyed diff 模式：依使用者指定的 key 欄位比對這次結果與上次寫入工作表的內容，
+    只寫入有變動的列、新增的列，並移除已消失的列。
+
+    上次寫入的狀態 (每個 key 所在的列號與整列內容的 hash) 存在 ResultStorage 的狀態檔，
+    不需要把整份工作表讀回來比對。第一次執行、欄位變更或狀態檔遺失時改為完整重寫。
+    工作表被視為由這個查詢管理：手動修改資料列不會被偵測，列的順序也不保證與查詢結果相同。
+    """
+
+    def __init__(self, gsheet_service, result_storage, state_uri: str,
+                 sheet_id: str, tab_name: str, key_columns: list):
+        self.gsheet_service = gsheet_service
+        self.result_storage = result_storage
+        self.state_uri = state_uri
+        self.sheet_id = sheet_id
+        self.tab_name = tab_name
+        self.key_columns = list(key_columns)
+        self.stats = {"mode": None, "updated": 0, "inserted": 0, "deleted": 0, "unchanged": 0}
+        self._writer = None
+        self._columns = []
+        self._key_indexes = []
+        self._previous = {}   # key -> (row, hash)，上次執行的狀態
+        self._current = {}    # key -> (row, hash)，這次執行的狀態
+        self._inserts = []    # [(key, hash, values)]，在 close() 時才決定列號
+        self._insert_keys = set()
+        self._rebuild = False
+
+    @staticmethod
+    def _row_hash(values) -> str:
+        payload = json.dumps(values, default=str, ensure_ascii=False)
+        return hashlib.blake2b(payload.encode("utf-8"), digest_size=12).hexdigest()
+
+    def _load_state(self):
+        """讀取上次的狀態，欄位或 key 不同時回傳 None (需要完整重寫)。"""
+        if not self.result_storage.exists(self.state_uri):
+            return None
+        table = self.result_storage.read_table(self.state_uri)
+        metadata = json.loads((table.schema.metadata or {}).get(b"lalae.gsheet_state", b"{}"))
+        if metadata.get("columns") != self._columns or metadata.get("key_columns") != self.key_columns:
+            return None
+        return {
+            key: (row, row_hash)
+            for key, row, row_hash in zip(
+                table.column("key").to_pylist(),
+                table.column("row").to_pylist(),
+                table.column("row_hash").to_pylist(),
+            )
+        }
+
+    def _save_state(self):
+        keys = list(self._current)
+        table = pa.table(
+            {
+                "key": pa.array(keys, type=pa.string()),
+                "row": pa.array([self._current[key][0] for key in keys], type=pa.int64()),
+                "row_hash": pa.array([self._current[key][1] for key in keys], type=pa.string()),
+            }
+        )
+        table = table.replace_schema_metadata(
+            {"lalae.gsheet_state": json.dumps({"columns": self._columns, "key_columns": self.key_columns})}
+        )
+        self.result_storage.write_table(self.state_uri, table)
+
+    def open(self, schema):
+        self._columns = list(schema.names)
+        missing = [column for column in self.key_columns if column not in self._columns]
+        if not self.key_columns or missing:
+            raise ValueError(f"Diff key columns not found in query result: {', '.join(missing) or '(none)'}")
+        self._key_indexes = [self._columns.index(column) for column in self.key_columns]
+
+        previous = self._load_state()
+        if previous is not None:
+            # 工作表的最後一列與狀態不一致 (例如被手動清空) 時，狀態已不可信
+            expected_last_row = max((row for row, _ in previous.values()), default=1)
+            if self.gsheet_service.get_last_row(self.sheet_id, self.tab_name) != expected_last_row:
+                previous = None
+        # 先刪除狀態檔：這次執行中途失敗時，工作表內容與狀態不一致，下次會完整重寫
+        if self.result_storage.exists(self.state_uri):
+            self.result_storage.delete(self.state_uri)
+
+        self._rebuild = previous is None
+        self.stats["mode"] = "rebuild" if self._rebuild else "diff"
+        if self._rebuild:
+            self.gsheet_service.clear_sheet(self.sheet_id, self.tab_name)
+            self.gsheet_service.write_rows_at(self.sheet_id, self.tab_name, 1, [self._columns])
+            self._previous = {}
+        else:
+            self._previous = previous
+        self._writer = SheetBatchWriter(self.gsheet_service, self.sheet_id, self.tab_name, 2)
+
+    def write_batch(self, batch):
+        rows = sheet_values(batch)
+        updates = []
+        for values in rows:
+            key = json.dumps([values[index] for index in self._key_indexes], default=str, ensure_ascii=False)
+            if key in self._current or key in self._insert_keys:
+                raise ValueError(f"Duplicate diff key in query result: {key}")
+            # Sheets API 會略過 null 而不清除儲存格；diff 模式會覆寫既有的列，NULL 必須寫成空字串
+            values = ["" if value is None else value for value in values]
+            row_hash = self._row_hash(values)
+            if self._rebuild:
+                self._current[key] = (self._writer.next_row + len(updates), row_hash)
+                updates.append(values)
+            elif key in self._previous:
+                row, previous_hash = self._previous[key]
+                self._current[key] = (row, row_hash)
+                if row_hash != previous_hash:
+                    updates.append((row, values))
+                    self.stats["updated"] += 1
+                else:
+                    self.stats["unchanged"] += 1
+            else:
+                self._inserts.append((key, row_hash, values))
+                self._insert_keys.add(key)
+
+        if self._rebuild:
+            self.stats["inserted"] += len(updates)
+            self._writer.write_rows(updates)
+        elif updates:
+            self._writer.write_at(updates)
+
+    def _apply_inserts_and_deletes(self):
+        """新增的列先填入被刪除的列，剩下的接在最後；仍有空洞時把最後面的列搬進空洞。"""
+        holes = sorted(row for key, (row, _) in self._previous.items() if key not in self._current)
+        last_row = max((row for row, _ in self._previous.values()), default=1)
+        self.stats["deleted"] = len(holes)
+        self.stats["inserted"] = len(self._inserts)
+
+        updates = []
+        for key, row_hash, values in self._inserts:
+            if holes:
+                row = holes.pop(0)
+            else:
+                last_row += 1
+                row = last_row
+            self._current[key] = (row, row_hash)
+            updates.append((row, values))
+        self._inserts = []
+        if not holes:
+            self._writer.write_at(updates)
+            return
+
+        # 壓縮：最後面的列依序搬到最前面的空洞，直到沒有空洞位於資料範圍內
+        new_last_row = last_row - len(holes)
+        key_by_row = {row: key for key, (row, _) in self._current.items()}
+        hole_rows = [row for row in holes if row <= new_last_row]
+        source_rows = sorted((row for row in key_by_row if row > new_last_row), reverse=True)
+        moves = list(zip(source_rows, hole_rows))
+        values_by_row = {row: values for row, values in updates}
+        if moves:
+            # 先等待已送出的更新完成，讀回的內容才會是最新的
+            self._writer.flush()
+            read_start = min(source for source, _ in moves)
+            sheet_rows = self.gsheet_service.read_rows(self.sheet_id, self.tab_name, read_start, last_row)
+            for source, target in moves:
+                values = values_by_row.pop(source, None)
+                if values is None:
+                    values = sheet_rows[source - read_start]
+                    values = values + [""] * (len(self._columns) - len(values))
+                key = key_by_row[source]
+                self._current[key] = (target, self._current[key][1])
+                values_by_row[target] = values
+
+        blank = [""] * len(self._columns)
+        for row in range(new_last_row + 1, last_row + 1):
+            values_by_row[row] = blank
+        self._writer.write_at(list(values_by_row.items()))
+
+    def close(self):
+        if not self._writer:
+            return
+        if not self._rebuild:
+            self._apply_inserts_and_deletes()
+        self._writer.close()
+        self._save_state()
+        print(
+            f"[TASK] Google Sheet diff ({self.stats['mode']}): {self.stats['updated']} updated, "
+            f"{self.stats['inserted']} inserted, {self.stats['deleted']} deleted, "
+            f"{self.stats['unchanged']} unchanged."
+        )
+
+    def abort(self):
+        if self._writer:
+            self._writer.abort()
+
+
+def stream_batches_to_sinks(batches, schema, sinks: list):
+    """
+    將 batches (RecordBatch 的迭代器) 依序送進所有 sink。
+    任一 sink 發生錯誤時，會呼叫所有 sink 的 abort() 後重新拋出例外。
+    """
+    try:
+        for sink in sinks:
+            sink.open(schema)
+        for batch in batches:
+            for sink in sinks:
+                sink.write_batch(batch)
+    except Exception:
+        for sink in sinks:
+            try:
+                sink.abort()
+            except Exception:
+                pass
+        raise
+    for sink in sinks:
+        sink.close()
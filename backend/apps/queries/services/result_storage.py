@@ -0,0 +1,122 @@
+# services/result_storage.py
+# 查詢結果的欄式 (Parquet) 儲存後端。
+# 每次執行的結果會寫成一個壓縮的 Parquet 檔案，QueryRunResult.result_storage_path
+# 存放完整的 URI (本機路徑或 gs://bucket/...)，讀取時依 URI 自動選擇對應的檔案系統。
+# 每個 chunk 寫成一個 row group，下載與預覽只需讀取需要的 row group。
+import hashlib
+import posixpath
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pyarrow import fs as pafs
+from django.conf import settings
+
+
+class ResultStorage:
+    def __init__(self, base_uri: str = None):
+        self.base_uri = (base_uri or settings.QUERY_RESULT_STORAGE_URI).rstrip("/")
+        self.filesystem, self.base_path = pafs.FileSystem.from_uri(self.base_uri)
+
+    def uri_for_run(self, query_id, run_result_id) -> str:
+        """回傳某次執行結果檔案的 URI (會存進 result_storage_path)。"""
+        return f"{self.base_uri}/{query_id}/run_{run_result_id}.parquet"
+
+    def uri_for_sheet_state(self, query_id, sheet_id: str, tab_name: str) -> str:
+        """Google Sheets keyed diff 模式的工作表狀態檔 (每個 key 所在的列與內容 hash)。"""
+        digest = hashlib.sha1(f"{sheet_id}/{tab_name}".encode("utf-8")).hexdigest()[:16]
+        return f"{self.base_uri}/{query_id}/gsheet_state_{digest}.parquet"
+
+    @staticmethod
+    def _resolve(uri: str):
+        return pafs.FileSystem.from_uri(uri)
+
+    def open_writer(self, uri: str, schema: pa.Schema) -> "ResultWriter":
+        filesystem, path = self._resolve(uri)
+        filesystem.create_dir(posixpath.dirname(path), recursive=True)
+        return ResultWriter(filesystem, path, schema)
+
+    def exists(self, uri: str) -> bool:
+        filesystem, path = self._resolve(uri)
+        return filesystem.get_file_info(path).type == pafs.FileType.File
+
+    def delete(self, uri: str):
+        filesystem, path = self._resolve(uri)
+        if filesystem.get_file_info(path).type == pafs.FileType.File:
+            filesystem.delete_file(path)
+
+    def open_result(self, uri: str) -> pq.ParquetFile:
+        filesystem, path = self._resolve(uri)
+        return pq.ParquetFile(filesystem.open_input_file(path))
+
+    def write_table(self, uri: str, table: pa.Table):
+        """一次寫入整個 (小型) Table，例如工作表狀態檔。"""
+        filesystem, path = self._resolve(uri)
+        filesystem.create_dir(posixpath.dirname(path), recursive=True)
+        pq.write_table(table, path, filesystem=filesystem)
+
+    def read_table(self, uri: str) -> pa.Table:
+        filesystem, path = self._resolve(uri)
+        return pq.read_table(path, filesystem=filesystem)
+
+    def iter_batches(self, uri: str, columns: list = None):
+        """依序讀取每個 row group，一次只保留一個 row group 在記憶體中。"""
+        parquet_file = self.open_result(uri)
+        for index in range(parquet_file.num_row_groups):
+            yield parquet_file.read_row_group(index, columns=columns)
+
+    def read_range(self, uri: str, offset: int, limit: int) -> pa.Table:
+        """
+        讀取第 offset 列開始的 limit 列，依 Parquet metadata 只讀取涵蓋該範圍的 row group。
+        """
+        parquet_file = self.open_result(uri)
+        metadata = parquet_file.metadata
+        end = offset + limit
+
+        row_groups = []
+        first_row_of_selection = None
+        row_start = 0
+        for index in range(metadata.num_row_groups):
+            row_end = row_start + metadata.row_group(index).num_rows
+            if row_end > offset and row_start < end:
+                row_groups.append(index)
+                if first_row_of_selection is None:
+                    first_row_of_selection = row_start
+            row_start = row_end
+
+        if not row_groups:
+            return parquet_file.schema_arrow.empty_table()
+
+        table = parquet_file.read_row_groups(row_groups)
+        return table.slice(offset - first_row_of_selection, limit)
+
+
+class ResultWriter:
+    """以 row group 為單位寫入 Parquet，每次 write_batch 產生一個 row group。"""
+
+    def __init__(self, filesystem, path: str, schema: pa.Schema):
+        self.filesystem = filesystem
+        self.path = path
+        self._writer = pq.ParquetWriter(
+            path,
+            schema,
+            filesystem=filesystem,
+            compression=settings.QUERY_RESULT_PARQUET_COMPRESSION,
+        )
+
+    def write_batch(self, batch: pa.RecordBatch):
+        table = pa.Table.from_batches([batch])
+        self._writer.write_table(table, row_group_size=max(batch.num_rows, 1))
+
+    def add_metadata(self, metadata: dict):
+        """寫入檔案 footer 的 key-value metadata (須在 close 之前呼叫)。"""
+        self._writer.add_key_value_metadata(metadata)
+
+    def close(self):
+        if self._writer:
+            self._writer.close()
+            self._writer = None
+
+    def abort(self):
+        self.close()
+        if self.filesystem.get_file_info(self.path).type == pafs.FileType.File:
+            self.filesystem.delete_file(self.path)
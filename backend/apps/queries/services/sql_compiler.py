@@ -0,0 +1,266 @@
+# services/sql_compiler.py
+# 將使用者撰寫的 SQL 編譯成可直接送到 BigQuery 的 SQL。
+# 以 tokenizer 找出 FROM / JOIN 後面的資料表名稱，只在儲存查詢時執行一次：
+# - 未指定 dataset 的資料表 (例如 FROM campaigns) 會補上 client 的 dataset
+# - 字串、註解、CTE 名稱、子查詢、UNNEST(...)、EXTRACT(... FROM ...) 不會被改寫
+# 同時回傳查詢引用的資料表清單 (project.dataset.table)，供快取、排程等功能使用。
+import re
+from dataclasses import dataclass, field
+
+_TOKEN_RE = re.compile(
+    r"(?P<ws>\s+)"
+    r"|(?P<comment>--[^\n]*|#[^\n]*|/\*.*?\*/)"
+    r"|(?P<string>[rRbB]{0,2}(?:'''.*?'''|\"\"\".*?\"\"\"|'(?:\\.|[^'\\])*'|\"(?:\\.|[^\"\\])*\"))"
+    r"|(?P<quoted>`[^`]*`)"
+    r"|(?P<word>[A-Za-z_][A-Za-z0-9_]*(?:-[A-Za-z0-9_]+)*)"
+    r"|(?P<number>\d+(?:\.\d*)?(?:[eE][+-]?\d+)?)"
+    r"|(?P<punct>.)",
+    re.DOTALL,
+)
+
+# 出現在資料表名稱後面時，代表不是別名
+_NON_ALIAS_KEYWORDS = {
+    "WHERE", "JOIN", "LEFT", "RIGHT", "INNER", "FULL", "CROSS", "OUTER", "NATURAL",
+    "ON", "USING", "GROUP", "ORDER", "LIMIT", "UNION", "INTERSECT", "EXCEPT",
+    "HAVING", "QUALIFY", "WINDOW", "FOR", "TABLESAMPLE", "WITH", "PIVOT", "UNPIVOT",
+    "SELECT", "FROM", "AS",
+}
+# 出現後即離開 FROM 子句 (之後的逗號不再代表下一個資料表)。
+# ON / USING 不在其中：JOIN 條件內的逗號都在括號裡，同一層的逗號仍是下一個資料表
+_CLAUSE_KEYWORDS = {
+    "SELECT", "WHERE", "GROUP", "HAVING", "QUALIFY", "WINDOW", "ORDER", "LIMIT",
+    "UNION", "INTERSECT", "EXCEPT",
+}
+
+
+@dataclass
+class Token:
+    kind: str
+    text: str
+
+    @property
+    def upper(self):
+        return self.text.upper() if self.kind == "word" else None
+
+
+@dataclass
+class CompiledSQL:
+    sql: str
+    referenced_tables: list = field(default_factory=list)
+
+
+def tokenize(sql: str) -> list:
+    return [Token(match.lastgroup, match.group()) for match in _TOKEN_RE.finditer(sql)]
+
+
+def _identifier_parts(token: Token) -> list:
+    if token.kind == "quoted":
+        return token.text[1:-1].split(".")
+    return [token.text]
+
+
+def _is_name(token) -> bool:
+    return token is not None and token.kind in ("word", "quoted")
+
+
+class _Compiler:
+    def __init__(self, sql: str, dataset_id: str, project_id: str):
+        self.tokens = tokenize(sql)
+        self.dataset_id = dataset_id
+        self.project_id = project_id
+        # 只看有意義的 token (略過空白與註解)，保留其在 self.tokens 中的位置以便改寫
+        self.positions = [
+            index for index, token in enumerate(self.tokens) if token.kind not in ("ws", "comment")
+        ]
+        self.replacements = {}
+        self.referenced_tables = []
+        self.known_names = set()
+        self.cte_names = self._find_cte_names()
+
+    def _sig(self, k):
+        if 0 <= k < len(self.positions):
+            return self.tokens[self.positions[k]]
+        return None
+
+    def _find_cte_names(self) -> set:
+        """WITH name AS (...), name2 AS (...) 中的 CTE 名稱。"""
+        names = set()
+        for k in range(len(self.positions)):
+            token, previous = self._sig(k), self._sig(k - 1)
+            next_token, after = self._sig(k + 1), self._sig(k + 2)
+            if (
+                _is_name(token)
+                and previous is not None
+                and (previous.upper in ("WITH", "RECURSIVE") or previous.text == ",")
+                and next_token is not None
+                and next_token.upper == "AS"
+                and after is not None
+                and after.text == "("
+            ):
+                names.add(_identifier_parts(token)[-1].lower())
+        return names
+
+    def _read_table(self, k: int) -> int:
+        """從第 k 個 token 讀取資料表名稱，回傳名稱之後的位置。"""
+        token = self._sig(k)
+        if not _is_name(token) or token.upper in _CLAUSE_KEYWORDS:
+            return k
+
+        parts = _identifier_parts(token)
+        end = k + 1
+        while (
+            self._sig(end) is not None
+            and self._sig(end).text == "."
+            and _is_name(self._sig(end + 1))
+        ):
+            parts.extend(_identifier_parts(self._sig(end + 1)))
+            end += 2
+        wildcard = self._sig(end) is not None and self._sig(end).text == "*"
+        if wildcard:
+            parts[-1] += "*"
+            end += 1
+
+        # UNNEST(...)、資料表函式
+        if self._sig(end) is not None and self._sig(end).text == "(":
+            return end
+
+        first = parts[0].lower()
+        is_cte = len(parts) == 1 and first in self.cte_names
+        # FROM t, t.array_column 這種相關聯的 UNNEST
+        is_correlated_path = len(parts) > 1 and first in self.known_names
+        if not is_cte and not is_correlated_path:
+            if len(parts) == 1:
+                self.replacements[self.positions[k]] = f"`{self.dataset_id}`.{token.text}"
+                table_id = f"{self.project_id}.{self.dataset_id}.{parts[0]}"
+            elif len(parts) == 2:
+                table_id = f"{self.project_id}.{parts[0]}.{parts[1]}"
+            else:
+                table_id = ".".join(parts)
+            if table_id not in self.referenced_tables:
+                self.referenced_tables.append(table_id)
+        self.known_names.add(parts[-1].lower())
+
+        # 別名：[AS] alias
+        alias = self._sig(end)
+        if alias is not None and alias.upper == "AS":
+            alias = self._sig(end + 1)
+        if _is_name(alias) and alias.upper not in _NON_ALIAS_KEYWORDS:
+            self.known_names.add(_identifier_parts(alias)[-1].lower())
+        return end
+
+    def compile(self) -> CompiledSQL:
+        # 每一層括號各自記錄：開啟括號的函式名稱，以及是否位於 FROM 子句中
+        frames = [{"function": None, "in_from": False}]
+        k = 0
+        while k < len(self.positions):
+            token = self._sig(k)
+            previous = self._sig(k - 1)
+            frame = frames[-1]
+
+            if token.text == "(":
+                frames.append({"function": previous.upper if previous else None, "in_from": False})
+            elif token.text == ")":
+                if len(frames) > 1:
+                    frames.pop()
+            elif token.upper == "FROM":
+                before_previous = self._sig(k - 2)
+                is_distinct_from = (
+                    previous is not None
+                    and previous.upper == "DISTINCT"
+                    and before_previous is not None
+                    and before_previous.upper in ("IS", "NOT")
+                )
+                if frame["function"] != "EXTRACT" and not is_distinct_from:
+                    frame["in_from"] = True
+                    k = self._read_table(k + 1)
+                    continue
+            elif token.upper == "JOIN":
+                frame["in_from"] = True
+                k = self._read_table(k + 1)
+                continue
+            elif token.text == "," and frame["in_from"]:
+                k = self._read_table(k + 1)
+                continue
+            elif token.upper in _CLAUSE_KEYWORDS:
+                frame["in_from"] = False
+            k += 1
+
+        sql = "".join(
+            self.replacements.get(index, token.text) for index, token in enumerate(self.tokens)
+        )
+        return CompiledSQL(sql=sql, referenced_tables=self.referenced_tables)
+
+
+def compile_sql(sql: str, dataset_id: str, project_id: str) -> CompiledSQL:
+    """
+    將 SQL 中未指定 dataset 的資料表補上 `dataset_id`，並回傳引用的資料表清單。
+    已寫明 dataset (dataset.table) 或 project (project.dataset.table) 的名稱維持不變。
+    """
+    return _Compiler(sql, dataset_id, project_id).compile()
+
+
+@dataclass
+class TrivialProjection:
+    table_id: str
+    columns: list = None  # None 表示 SELECT *
+    limit: int = None
+
+
+def parse_trivial_projection(sql: str, dataset_id: str, project_id: str):
+    """
+    判斷 SQL 是否只是單一資料表的欄位投影：
+        SELECT * | col1, col2 FROM table [LIMIT n] [;]
+    沒有 WHERE / JOIN / 函式 / 別名等其他語法。符合時回傳 TrivialProjection，
+    可改用免費的 tabledata.list (list_rows) 讀取；否則回傳 None。
+    """
+    tokens = [token for token in tokenize(sql) if token.kind not in ("ws", "comment")]
+    while tokens and tokens[-1].text == ";":
+        tokens.pop()
+    if len(tokens) < 4 or tokens[0].upper != "SELECT":
+        return None
+
+    k = 1
+    columns = []
+    if tokens[k].text == "*":
+        columns = None
+        k += 1
+    else:
+        while True:
+            if k >= len(tokens) or not _is_name(tokens[k]) or tokens[k].upper in _NON_ALIAS_KEYWORDS:
+                return None
+            columns.append(_identifier_parts(tokens[k])[-1] if tokens[k].kind == "quoted" else tokens[k].text)
+            k += 1
+            if k < len(tokens) and tokens[k].text == ",":
+                k += 1
+                continue
+            break
+
+    if k >= len(tokens) or tokens[k].upper != "FROM":
+        return None
+    k += 1
+
+    parts = []
+    while k < len(tokens) and _is_name(tokens[k]):
+        parts.extend(_identifier_parts(tokens[k]))
+        k += 1
+        if k < len(tokens) and tokens[k].text == "." and k + 1 < len(tokens) and _is_name(tokens[k + 1]):
+            k += 1
+            continue
+        break
+    if not parts or len(parts) > 3:
+        return None
+
+    limit = None
+    if k < len(tokens) and tokens[k].upper == "LIMIT":
+        if k + 1 >= len(tokens) or tokens[k + 1].kind != "number" or not tokens[k + 1].text.isdigit():
+            return None
+        limit = int(tokens[k + 1].text)
+        k += 2
+    if k != len(tokens):
+        return None
+
+    if len(parts) == 1:
+        parts = [project_id, dataset_id] + parts
+    elif len(parts) == 2:
+        parts = [project_id] + parts
+    return TrivialProjection(table_id=".".join(parts), columns=columns, limit=limit)
@@ -1,19 +1,106 @@
+import asyncio
+import sys
+
 from celery import shared_task
+from celery.exceptions import Retry
+from django.conf import settings
+from django.db import transaction
 from django.utils import timezone
+from main.concurrency import ConcurrencyLimitReached, InflightLock, defer_task, task_slots
 from .models import QueryRunResult, QueryDefinition
-from datetime import date, datetime
-from .services.bq_services import BigQueryService  # 修正類別名稱
+from .services.bq_services import (  # 修正類別名稱
+    BigQueryService,
+    BudgetExceededError,
+    bigquery_schema_to_arrow,
+    job_error,
+    validate_table_name,
+)
+from .services.budget_services import check_budget, get_client_for_dataset
+from .services.result_sinks import (
+    GSheetDiffSink,
+    GSheetSink,
+    ParquetResultSink,
+    RowCountSink,
+    stream_batches_to_sinks,
+)
+from .services.result_storage import ResultStorage
+from .services.result_cache import find_cached_result, is_cacheable_sql, sql_fingerprint
 
 from .services.gsheet_services import GSheetService # 你需要建立這個服務來封裝 GSheet 操作
-from .services.looker_services import LookerService # 你需要建立這個服務來封裝 Looker 操作
+from .services.looker_services import LookerService, looker_studio_report_url # 你需要建立這個服務來封裝 Looker 操作
 from google.cloud import bigquery
 import json
-import csv
-from io import StringIO
 from google.api_core import exceptions as google_exceptions
 
+# 執行結束時只更新執行狀態相關的欄位，避免覆蓋排程器同時推算的 next_run_at
+_RUN_STATUS_FIELDS = [
+    "last_successful_run_result",
+    "last_run_status",
+    "materialized_table",
+    "materialized_at",
+    "materialized_sql_hash",
+    "updated_at",
+]
+
+# 排隊、執行中或等待重試的 QueryRunResult 狀態；lock 指向這些 run 時不可接手
+IN_FLIGHT_RUN_STATES = ["PENDING", "RUNNING", "RETRYING"]
+
+
+def query_lock(query_id):
+    """同一個 QueryDefinition 同時只有一個 run 在排隊或執行；value 為該 QueryRunResult id。"""
+    return InflightLock(f"inflight:query:{query_id}")
+
+
+def claim_query_run(query_id):
+    """
+    取得 QueryDefinition 的 in-flight lock。
+    回傳 (是否取得, 排隊或執行中的 QueryRunResult)。
+    """
+    lock = query_lock(query_id)
+    if lock.acquire({"run_result_id": None}):
+        return True, None
+    current = lock.get() or {}
+    run_result_id = current.get("run_result_id")
+    if run_result_id is None:
+        # 另一個請求剛取得 lock，正在建立 QueryRunResult
+        return False, None
+    run_result = QueryRunResult.objects.filter(pk=run_result_id, status__in=IN_FLIGHT_RUN_STATES).first()
+    if run_result:
+        return False, run_result
+    # 記錄的 run 已結束或交易已回滾，但 lock 沒有釋放，直接接手；同時到達的觸發只有一個能接手
+    if lock.replace(current, {"run_result_id": None}):
+        return True, None
+    return False, None
+
+
+def trigger_query_run(query_def, triggered_by="MANUAL", queue=None):
+    """
+    建立 QueryRunResult 並在交易提交後派發 run_bigquery_query_task。
+    已有 run 在排隊或執行中時不建立新的，回傳 (該 QueryRunResult, False)。
+    """
+    claimed, run_result = claim_query_run(query_def.pk)
+    if not claimed:
+        print(f"[TASK] Query {query_def.pk} already has run {run_result.id if run_result else '(pending)'} in flight.")
+        return run_result, False
+    run_result = QueryRunResult.objects.create(
+        query=query_def,
+        triggered_by=triggered_by,
+        status="PENDING",
+        executed_at=timezone.now(),
+    )
+    query_lock(query_def.pk).set({"run_result_id": run_result.id})
+    options = {"queue": queue} if queue else {}
+    transaction.on_commit(lambda: run_bigquery_query_task.apply_async((run_result.id,), **options))
+    return run_result, True
+
+
 @shared_task(bind=True, max_retries=3)  # bind=True 可以讓你存取 self (task instance)
-def run_bigquery_query_task(self, run_result_id):
+def run_bigquery_query_task(self, run_result_id, use_cache=True, resume_job=False):
+    """
+    執行查詢並將結果寫到輸出目標。
+    QUERY_ASYNC_JOBS 時一般查詢只送出 BigQuery job 就結束，poll_bigquery_jobs 在 job 完成後
+    以 resume_job=True 再次派發此任務，直接讀取 job 的結果並處理輸出。
+    """
     print(f"[TASK START] run_bigquery_query_task for run_result_id: {run_result_id}")
     try:
         run_result = QueryRunResult.objects.get(pk=run_result_id) # 獲取 QueryRunResult
@@ -23,8 +110,41 @@ def run_bigquery_query_task(self, run_result_id):
         print(f"[TASK ERROR] QueryRunResult ID {run_result_id} not found. Aborting task.")
         return # 任務失敗，但不是通過 return 字串
 
+    lock = query_lock(query_def.pk)
+    # 不經過 trigger_query_run 派發的重複任務：lock 指向另一個排隊、執行中或等待重試的 run 時直接結束，
+    # 不可覆寫 lock (否則這個任務結束時會釋放另一個 run 的 lock)
+    running_run_id = (lock.get() or {}).get("run_result_id")
+    if (
+        running_run_id
+        and running_run_id != run_result.id
+        and QueryRunResult.objects.filter(pk=running_run_id, status__in=IN_FLIGHT_RUN_STATES).exists()
+    ):
+        print(f"[TASK] Query {query_def.pk} already has run {running_run_id} in flight. Skipping duplicate run {run_result_id}.")
+        if run_result.status == "PENDING":
+            run_result.status = "FAILED"
+            run_result.error_message = f"Skipped: run {running_run_id} of this query was already in flight."
+            run_result.completed_at = timezone.now()
+            run_result.save(update_fields=["status", "error_message", "completed_at"])
+        return
+    # 不經過 trigger_query_run 派發的任務也登記在 lock 上，之後的重複觸發會回傳這個 run
+    lock.set({"run_result_id": run_result.id})
+
+    # 每個 Client 與 BigQuery (以及 Google Sheets 輸出) 同時執行的查詢數有上限，已滿時延後重新排入
+    client = get_client_for_dataset(query_def.bigquery_dataset_id)
+    providers = ["BIGQUERY"]
+    if query_def.output_target == "GOOGLE_SHEET":
+        providers.append("GOOGLE_SHEET")
+    slots = task_slots(client_id=client.id if client else None, providers=providers)
+    try:
+        slots.acquire()
+    except ConcurrencyLimitReached as e:
+        countdown = defer_task(self)
+        print(f"[TASK] RunResult {run_result_id} deferred by {countdown:.0f}s: {e}")
+        return
+
     run_result.status = "RUNNING"
-    run_result.executed_at = timezone.now()
+    if not resume_job:
+        run_result.executed_at = timezone.now()
     run_result.save()
     print(f"[TASK] RunResult {run_result_id} status set to RUNNING.")
 
@@ -32,83 +152,256 @@ def run_bigquery_query_task(self, run_result_id):
     bq_service = BigQueryService(project_id=query_def.bigquery_project_id) 
     gsheet_service = GSheetService() 
     looker_service = LookerService() 
+    awaiting_job = False
 
     try:
         dataset_id = query_def.bigquery_dataset_id
-        sql_query_raw = query_def.sql_query
-
-        modified_sql_query = sql_query_raw.replace("FROM ", f"FROM `{dataset_id}`.")
-        modified_sql_query = modified_sql_query.replace("JOIN ", f"JOIN `{dataset_id}`.")
-        modified_sql_query = modified_sql_query.replace("INNER JOIN ", f"INNER JOIN `{dataset_id}`.")
-        modified_sql_query = modified_sql_query.replace("LEFT JOIN ", f"LEFT JOIN `{dataset_id}`.")
-        modified_sql_query = modified_sql_query.replace("RIGHT JOIN ", f"RIGHT JOIN `{dataset_id}`.")
-        modified_sql_query = modified_sql_query.replace("FULL JOIN ", f"FULL JOIN `{dataset_id}`.")
-
-        print(f"[TASK] Executing BigQuery query: {modified_sql_query}") 
-        query_results_iterator, schema_fields, job_stats = bq_service.execute_query(sql=modified_sql_query) 
-        print(f"[TASK] BigQuery query job completed successfully. Rows: {job_stats['total_rows']}, Processed Bytes: {job_stats['total_bytes_processed']}") 
-
-        csv_buffer = StringIO()
-        csv_writer = csv.writer(csv_buffer)
-
-        column_names = [field.name for field in schema_fields]
-        csv_writer.writerow(column_names)
-
-        row_count = 0
-        all_rows_for_output = []
-        for row in query_results_iterator:
-            processed_row_data_for_gsheet = [] 
-            row_data_for_csv = [] 
-
-            for value in row.values():
-                if isinstance(value, (date, datetime)):
-                    processed_row_data_for_gsheet.append(value.isoformat())
-                    row_data_for_csv.append(value.isoformat())
-                else:
-                    processed_row_data_for_gsheet.append(value)
-                    row_data_for_csv.append(str(value)) 
-
-            csv_writer.writerow(row_data_for_csv) 
-            all_rows_for_output.append(processed_row_data_for_gsheet) 
 
-            row_count += 1
+        # SQL 在儲存時已編譯；舊資料沒有 compiled_sql 時補編譯一次並存回
+        if not query_def.compiled_sql:
+            query_def.compile_sql()
+            query_def.save(update_fields=["compiled_sql", "referenced_tables"])
+        modified_sql_query = query_def.compiled_sql
 
-        run_result.result_rows_count = row_count
-        run_result.result_data_csv = csv_buffer.getvalue()
-        print(f"[TASK] Data processing complete. Rows fetched: {row_count}")
-
-        # 2. 處理輸出目標
+        # 1. 先解析輸出目標，讓 Google Sheets 可以和結果檔案一起接收串流資料
         output_type = query_def.output_target
         output_config = json.loads(query_def.output_config) if query_def.output_config else {} 
         print(f"[TASK] Output target: {output_type}, Config: {output_config}")
 
+        row_counter = RowCountSink()
+        result_storage = ResultStorage()
+        result_uri = result_storage.uri_for_run(query_def.id, run_result.id)
+        output_sinks = []
+
         if output_type == "GOOGLE_SHEET":
             sheet_id = output_config.get("sheet_id")
             tab_name = output_config.get("tab_name", "Sheet1")
-            append_mode = output_config.get("append_mode", False) 
+            append_mode = output_config.get("append_mode", False)
+            diff_key_columns = output_config.get("diff_key_columns") or []
 
             if not sheet_id:
                 raise ValueError("Google Sheet ID is not configured.")
 
-            gsheet_service.write_to_sheet(sheet_id, tab_name, column_names, all_rows_for_output, append_mode)
+            if diff_key_columns:
+                # Keyed diff 模式：只寫入變動的列 (忽略 append_mode)
+                state_uri = result_storage.uri_for_sheet_state(query_def.id, sheet_id, tab_name)
+                output_sinks.append(
+                    GSheetDiffSink(
+                        gsheet_service, result_storage, state_uri, sheet_id, tab_name, diff_key_columns
+                    )
+                )
+            else:
+                output_sinks.append(GSheetSink(gsheet_service, sheet_id, tab_name, append_mode))
+
+        elif output_type == "BIGQUERY_TABLE":
+            # 結果直接在 BigQuery 內寫入 client dataset 的資料表，不經過 worker 也不產生結果檔案
+            destination_table = ".".join(
+                [
+                    query_def.bigquery_project_id or settings.GOOGLE_CLOUD_PROJECT_ID,
+                    dataset_id,
+                    validate_table_name(output_config.get("table_name")),
+                ]
+            )
+            write_disposition = output_config.get("write_disposition") or "OVERWRITE"
+
+        # job 完成後繼續處理 (resume_job) 時，dry run 與快取查找在送出 job 前已經做過
+        cached_result = None
+        if not resume_job:
+            # 2. Dry run (不收費)：取得預估的 bytes 與來源資料表
+            dry_run_job = bq_service.dry_run(modified_sql_query)
+            run_result.estimated_bytes_processed = dry_run_job.total_bytes_processed
+            # 立即儲存預估量，同時檢查預算的其他 run 會把它計入 reserved
+            run_result.save(update_fields=["estimated_bytes_processed"])
+            print(f"[TASK] Dry run: estimated {dry_run_job.total_bytes_processed} bytes, tables: {[t.table_id for t in dry_run_job.referenced_tables]}")
+
+            # 3. Result cache: 來源資料表都沒有變動時，沿用上一次的結果檔案
+            # 來源版本在執行查詢「之前」取得，查詢期間若資料表被更新，下次比對一定不會命中
+            if (
+                use_cache
+                and settings.QUERY_RESULT_CACHE_ENABLED
+                and output_type not in ("BIGQUERY_TABLE", "LOOKER_STUDIO")
+                and is_cacheable_sql(modified_sql_query)
+            ):
+                try:
+                    source_table_versions = bq_service.get_source_table_versions(
+                        dry_run_job.referenced_tables
+                    )
+                    if source_table_versions is not None:
+                        run_result.sql_fingerprint = sql_fingerprint(
+                            modified_sql_query, query_def.bigquery_project_id, dataset_id
+                        )
+                        run_result.source_table_versions = source_table_versions
+                        cached_result = find_cached_result(
+                            run_result.sql_fingerprint,
+                            source_table_versions,
+                            result_storage,
+                            exclude_id=run_result.id,
+                        )
+                except Exception as e:
+                    print(f"[TASK] Result cache lookup skipped: {e}")
+
+        if output_type == "BIGQUERY_TABLE":
+            # 4. 檢查預算後以 destination table 執行查詢，只記錄 job 統計
+            maximum_bytes_billed = check_budget(
+                get_client_for_dataset(dataset_id),
+                run_result.estimated_bytes_processed,
+                exclude_run_id=run_result.id,
+            )
+            print(f"[TASK] Executing BigQuery query into {destination_table} ({write_disposition}).")
+            job_stats = bq_service.execute_query_to_table(
+                sql=modified_sql_query,
+                destination_table=destination_table,
+                disposition=write_disposition,
+                partition_field=output_config.get("partition_field"),
+                maximum_bytes_billed=maximum_bytes_billed,
+            )
+            run_result.bigquery_job_id = job_stats["job_id"]
+            run_result.bytes_processed = job_stats["total_bytes_processed"]
+            run_result.bytes_billed = job_stats["total_bytes_billed"]
+            run_result.result_rows_count = job_stats["total_rows"]
+            run_result.destination_table = destination_table
+            print(f"[TASK] Wrote {job_stats['total_rows']} rows to {destination_table}.")
+
+        elif output_type == "LOOKER_STUDIO":
+            # 4. 刷新這個查詢的物化資料表 (只重新計算變動的分區)，資料不經過 worker
+            maximum_bytes_billed = check_budget(
+                get_client_for_dataset(dataset_id),
+                run_result.estimated_bytes_processed,
+                exclude_run_id=run_result.id,
+            )
+            refresh_stats = looker_service.refresh_materialized_table(
+                bq_service, query_def, output_config, maximum_bytes_billed=maximum_bytes_billed
+            )
+            run_result.bigquery_job_id = refresh_stats["job_id"]
+            run_result.bytes_processed = refresh_stats["total_bytes_processed"]
+            run_result.bytes_billed = refresh_stats["total_bytes_billed"]
+            run_result.result_rows_count = refresh_stats["total_rows"]
+            run_result.destination_table = refresh_stats["table"]
+
+        elif cached_result:
+            # 4a. 快取命中：不送出 BigQuery job，直接從結果檔案重送到輸出目標
+            print(f"[TASK] Reusing result of run {cached_result.id} (source tables unchanged).")
+            cached_uri = cached_result.result_storage_path
+            stream_batches_to_sinks(
+                result_storage.iter_batches(cached_uri),
+                result_storage.open_result(cached_uri).schema_arrow,
+                output_sinks,
+            )
+            run_result.result_rows_count = cached_result.result_rows_count
+            run_result.result_storage_path = cached_uri
+            run_result.reused_from = cached_result
+        elif resume_job:
+            # 4c. poll_bigquery_jobs 確認 job 已完成：直接讀取 job 的結果，不需要等待
+            chunk_size = settings.QUERY_RESULT_CHUNK_SIZE
+            query_job = bq_service.get_job(
+                run_result.bigquery_job_id,
+                project_id=query_def.bigquery_project_id,
+                location=run_result.bigquery_job_location,
+            )
+            query_results_iterator, schema_fields, job_stats = bq_service.get_query_results(
+                query_job, page_size=chunk_size
+            )
+        else:
+            # 4b. 檢查 client 的 bytes 預算，剩餘量同時作為 job 的 maximum_bytes_billed 上限
+            maximum_bytes_billed = check_budget(
+                get_client_for_dataset(dataset_id),
+                run_result.estimated_bytes_processed,
+                exclude_run_id=run_result.id,
+            )
+
+            chunk_size = settings.QUERY_RESULT_CHUNK_SIZE
+            print(f"[TASK] Executing BigQuery query: {modified_sql_query}") 
+            if settings.QUERY_ASYNC_JOBS:
+                # Submit-and-poll：送出 job 後立即釋放 worker，結果由 poll_bigquery_jobs 在 job 完成後派發處理
+                query_job = bq_service.submit_query(
+                    modified_sql_query, maximum_bytes_billed=maximum_bytes_billed
+                )
+                run_result.bigquery_job_id = query_job.job_id
+                run_result.bigquery_job_location = query_job.location
+                run_result.bigquery_job_state = query_job.state or "PENDING"
+                awaiting_job = True
+                print(f"[TASK] Submitted BigQuery job {query_job.job_id}; waiting for poll_bigquery_jobs.")
+                return f"Execution {run_result_id} submitted BigQuery job {query_job.job_id}."
+
+            query_results_iterator, schema_fields, job_stats = bq_service.execute_query(
+                sql=modified_sql_query,
+                page_size=chunk_size,
+                maximum_bytes_billed=maximum_bytes_billed,
+            ) 
+
+        if output_type not in ("BIGQUERY_TABLE", "LOOKER_STUDIO") and not cached_result:
+            # 5. 逐頁將查詢結果以固定大小的 chunk 串流到所有 sink
+            print(f"[TASK] BigQuery query job completed successfully. Rows: {job_stats['total_rows']}, Processed Bytes: {job_stats['total_bytes_processed']}") 
+            run_result.bigquery_job_id = job_stats["job_id"]
+            run_result.bytes_processed = job_stats["total_bytes_processed"]
+            run_result.bytes_billed = job_stats["total_bytes_billed"]
+
+            arrow_schema = bigquery_schema_to_arrow(schema_fields)
+            if settings.QUERY_RESULT_ARROW_FETCH:
+                result_batches = bq_service.iter_arrow_batches(query_results_iterator, arrow_schema)
+            else:
+                result_batches = bq_service.iter_record_batches(
+                    query_results_iterator, chunk_size, arrow_schema
+                )
+            sinks = [row_counter, ParquetResultSink(result_storage, result_uri)] + output_sinks
+            stream_batches_to_sinks(result_batches, arrow_schema, sinks)
+
+            run_result.result_rows_count = row_counter.row_count
+            run_result.result_storage_path = result_uri
+            print(f"[TASK] Data processing complete. Rows fetched: {row_counter.row_count}")
+
+        # 6. 處理輸出目標的結果訊息
+        if output_type == "GOOGLE_SHEET":
             run_result.result_output_link = f"https://docs.google.com/spreadsheets/d/{sheet_id}/edit"
             run_result.result_message = f"Successfully exported to Google Sheet: {run_result.result_output_link}"
             print(f"[TASK] Data exported to Google Sheets.")
 
+        elif output_type == "BIGQUERY_TABLE":
+            project_id, table_dataset, table_name = destination_table.split(".")
+            run_result.result_output_link = (
+                f"https://console.cloud.google.com/bigquery?project={project_id}"
+                f"&ws=!1m5!1m4!4m3!1s{project_id}!2s{table_dataset}!3s{table_name}"
+            )
+            run_result.result_message = (
+                f"Wrote {run_result.result_rows_count} rows to BigQuery table "
+                f"{destination_table} ({write_disposition})."
+            )
+
         elif output_type == "LOOKER_STUDIO":
             email_address = output_config.get("email")
-            run_result.result_output_link = f"https://lookerstudio.google.com/reporting/your_report_id"
-            run_result.result_message = f"Data exported for Google Looker Studio (Email: {email_address})."
+            run_result.result_output_link = looker_studio_report_url(refresh_stats["table"])
+            if refresh_stats["mode"] == "SKIPPED":
+                refresh_detail = "source tables unchanged, no refresh needed"
+            elif refresh_stats["mode"] == "INCREMENTAL":
+                refresh_detail = f"refreshed partitions {', '.join(refresh_stats['partitions'])}"
+            else:
+                refresh_detail = f"fully refreshed, {refresh_stats['total_rows']} rows"
+            run_result.result_message = (
+                f"Looker Studio table {refresh_stats['table']} {refresh_detail} (Email: {email_address})."
+            )
             print(f"[TASK] Data exported for Google Looker Studio.")
 
         else:
             run_result.result_message = "No output configured for this query."
             print(f"[TASK] No specific output target configured.")
 
+        if cached_result:
+            run_result.result_message = (
+                f"{run_result.result_message} "
+                f"(Reused result of run #{cached_result.id}; source tables unchanged.)"
+            )
+
         run_result.status = "SUCCESS"
         run_result.query.last_successful_run_result = run_result
         run_result.query.last_run_status = "SUCCESS"
-        run_result.query.save()
+        run_result.query.save(update_fields=_RUN_STATUS_FIELDS)
+
+    except BudgetExceededError as e:
+        # 超過預算不重試，避免持續消耗 slot
+        print(f"[TASK ERROR] Budget exceeded: {e}")
+        run_result.status = "BUDGET_EXCEEDED"
+        run_result.result_message = str(e)
+        run_result.query.last_run_status = "BUDGET_EXCEEDED"
 
     except google_exceptions.GoogleAPIError as e: # 捕獲 Google Cloud API 特定錯誤
         print(f"[TASK ERROR] Google Cloud Error during BigQuery/Output: {e}") #
@@ -122,62 +415,190 @@ def run_bigquery_query_task(self, run_result_id):
         run_result.result_message = f"Query execution failed: {str(e)}"
         self.retry(exc=e, countdown=60) 
     finally:
-        print(f"[TASK END] Execution {run_result_id} for query '{query_def.name}' completed with status {run_result.status}.")
-        run_result.completed_at = timezone.now()
-        run_result.save()
-        run_result.query.save()
-
-    # 如果是定期任務且成功，更新 QueryDefinition 的 next_run_at (如果手動管理排程)
-    # 或者 Celery Beat 會自動處理下一次執行
-    if query_def.schedule_type == "PERIODIC" and run_result.status == "SUCCESS":
-        # 如果您使用 django-celery-beat 的 PeriodicTask，這裡無需額外更新
-        # 如果是自定義的排程器，則需要更新 last_run_at
-        pass
+        slots.release()
+        if awaiting_job:
+            # job 執行中：保留 lock，run 維持 RUNNING，由 poll_bigquery_jobs 接手
+            run_result.save()
+        elif isinstance(sys.exc_info()[1], Retry):
+            # 即將重試時保留 lock，run 維持未結束的 RETRYING，重試完成前不接受新的觸發
+            run_result.status = "RETRYING"
+            run_result.save()
+            print(f"[TASK] RunResult {run_result_id} will be retried.")
+        else:
+            lock.release()
+            print(f"[TASK END] Execution {run_result_id} for query '{query_def.name}' completed with status {run_result.status}.")
+            run_result.completed_at = timezone.now()
+            run_result.save()
+            run_result.query.save(update_fields=_RUN_STATUS_FIELDS)
+
+    # 定期任務的 next_run_at 已由 schedule_periodic_queries 在認領時推算，這裡不需要更新
     print(f"Execution {run_result_id} for query '{query_def.name}' completed with status {run_result.status}.")
     return f"Execution {run_result_id} for query '{query_def.name}' completed with status {run_result.status}."
 
 
-# schedule_periodic_queries 任務保持不變，它會負責根據 cron_schedule 創建 QueryExecution
-# 當 QueryExecution 創建後，會調用 run_bigquery_query_task.delay(run_result.id)
-# 確保這個任務會被 Celery Beat 定期執行
+_PENDING_JOB_STATES = ["PENDING", "RUNNING"]
+
+
+async def _fetch_jobs(bq_service, run_results, concurrency):
+    """以 asyncio 同時查詢多個 job 的狀態 (google-cloud-bigquery 為同步 client，在 thread 中呼叫)。"""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(run_result):
+        async with semaphore:
+            try:
+                query_job = await asyncio.to_thread(
+                    bq_service.get_job,
+                    run_result.bigquery_job_id,
+                    project_id=run_result.query.bigquery_project_id,
+                    location=run_result.bigquery_job_location,
+                )
+                return run_result, query_job, None
+            except Exception as e:
+                return run_result, None, e
+
+    return await asyncio.gather(*(fetch(run_result) for run_result in run_results))
+
+
+def _fail_job_run(run_result, error, query_job=None):
+    """job 失敗或遺失：直接結束 run，不需要再派發任務。失敗的 job 也可能已計費，記錄 bytes_billed。"""
+    run_result.status = "BUDGET_EXCEEDED" if isinstance(error, BudgetExceededError) else "FAILED"
+    run_result.result_message = str(error)
+    run_result.completed_at = timezone.now()
+    run_result.bytes_processed = getattr(query_job, "total_bytes_processed", None)
+    run_result.bytes_billed = getattr(query_job, "total_bytes_billed", None) or 0
+    run_result.save(update_fields=["status", "result_message", "completed_at", "bytes_processed", "bytes_billed"])
+    QueryDefinition.objects.filter(pk=run_result.query_id).update(last_run_status=run_result.status)
+    query_lock(run_result.query_id).release()
+    print(f"[POLLER] Run {run_result.id} finished with status {run_result.status}: {error}")
+
 
 @shared_task
-def schedule_periodic_queries():
+def poll_bigquery_jobs():
     """
-    此任務由 Celery Beat 定期觸發 (例如每分鐘或每五分鐘)。
-    它檢查是否有 QueryDefinition 需要根據其 cron_schedule 執行。
-    注意：如果使用 django-celery-beat，這個手動的排程器就不是必需的，
-    因為 django-celery-beat 會直接根據 PeriodicTask 模型來調度 run_bigquery_query_task。
+    由 Celery Beat 每 QUERY_JOB_POLL_INTERVAL 秒執行一次。
+    查詢所有已送出、尚未完成的 BigQuery job 狀態；job 成功時以 resume_job=True 派發 run_bigquery_query_task
+    處理結果，失敗時直接結束 run。worker 不需要在 job 執行期間等待。
     """
-    from croniter import croniter  # 需要 pip install croniter
+    poll_lock = InflightLock("poller:bigquery_jobs", ttl=settings.QUERY_JOB_POLL_INTERVAL * 6)
+    if not poll_lock.acquire(True):
+        return 0  # 上一次輪詢還在進行中
 
-    now = timezone.now()
-    active_periodic_queries = (
-        QueryDefinition.objects.filter(status="ACTIVE", schedule_type="PERIODIC")
-        .exclude(cron_schedule__isnull=True)
-        .exclude(cron_schedule__exact="")
-    )
+    finished = 0
+    try:
+        pending_runs = list(
+            QueryRunResult.objects.filter(bigquery_job_state__in=_PENDING_JOB_STATES)
+            .select_related("query")
+            .only(
+                "id", "query_id", "query__bigquery_project_id", "triggered_by", "status",
+                "bigquery_job_id", "bigquery_job_location", "bigquery_job_state",
+            )
+            .order_by("executed_at")[: settings.QUERY_JOB_POLL_BATCH_SIZE]
+        )
+        if not pending_runs:
+            return 0
+
+        bq_service = BigQueryService()
+        polled = asyncio.run(_fetch_jobs(bq_service, pending_runs, settings.QUERY_JOB_POLL_CONCURRENCY))
+
+        for run_result, query_job, error in polled:
+            if error is not None:
+                if isinstance(error, google_exceptions.NotFound):
+                    QueryRunResult.objects.filter(pk=run_result.pk).update(bigquery_job_state="DONE")
+                    _fail_job_run(run_result, RuntimeError(f"BigQuery job {run_result.bigquery_job_id} not found."))
+                    finished += 1
+                else:
+                    print(f"[POLLER] Could not poll job {run_result.bigquery_job_id}: {error}")
+                continue
+
+            if query_job.state != "DONE":
+                if query_job.state != run_result.bigquery_job_state:
+                    QueryRunResult.objects.filter(pk=run_result.pk).update(bigquery_job_state=query_job.state)
+                # 長時間執行的 job：延長 in-flight lock 的 lease
+                query_lock(run_result.query_id).set({"run_result_id": run_result.id})
+                continue
+
+            # 以條件式 update 認領，多個輪詢同時執行時只有一個會處理這個 job
+            claimed = QueryRunResult.objects.filter(
+                pk=run_result.pk, bigquery_job_state__in=_PENDING_JOB_STATES
+            ).update(bigquery_job_state="DONE")
+            if not claimed:
+                continue
+            finished += 1
+
+            error = job_error(query_job)
+            if error is not None:
+                _fail_job_run(run_result, error, query_job)
+                continue
+
+            queue = (
+                settings.CELERY_SCHEDULED_QUEUE
+                if run_result.triggered_by == "SCHEDULED"
+                else settings.CELERY_INTERACTIVE_QUEUE
+            )
+            run_bigquery_query_task.apply_async(
+                (run_result.id,), {"resume_job": True}, queue=queue
+            )
+    finally:
+        poll_lock.release()
 
-    for q_def in active_periodic_queries:
-        iter = croniter(q_def.cron_schedule, now)
-        prev_run_time = iter.get_prev(timezone.datetime)
-        if (now - prev_run_time).total_seconds() < 60:  
-            recent_execution = QueryRunResult.objects.filter(
-                query_definition=q_def,
-                triggered_by="SCHEDULED",
-                started_at__gte=prev_run_time,
-            ).exists()
-
-            if not recent_execution:
-                run_result = QueryRunResult.objects.create(
-                    query_definition=q_def,
-                    triggered_by="SCHEDULED",
-                    status="PENDING",
-                    # started_at 不在這裡設定，由 run_bigquery_query_task 設定
-                )
-                run_bigquery_query_task.delay(run_result.id)
-                # q_def.last_run_at = now # 更新 QueryDefinition 上的最後執行時間戳
-                # q_def.save()
+    if finished:
+        print(f"[POLLER] {finished} of {len(pending_runs)} BigQuery jobs finished.")
+    return finished
+
+
+@shared_task
+def schedule_periodic_queries():
+    """
+    此任務由 Celery Beat 每分鐘觸發。
+    以 (schedule_type, next_run_at) 的部分索引找出到期的查詢，並以 SELECT ... FOR UPDATE SKIP LOCKED
+    認領：同時有多個 beat / worker 執行時，同一個查詢只會被其中一個認領。
+    認領的同時把 next_run_at 推算到下一次，因此每次 tick 的成本與查詢總數無關。
+    """
+    now = timezone.now()
+    batch_size = settings.QUERY_SCHEDULER_BATCH_SIZE
+    dispatched = 0
+
+    while True:
+        with transaction.atomic():
+            due_queries = list(
+                QueryDefinition.objects.select_for_update(skip_locked=True)
+                .filter(schedule_type="PERIODIC", next_run_at__lte=now)
+                .order_by("next_run_at")
+                .only("id", "schedule_type", "cron_schedule", "schedule_window_minutes", "next_run_at")[:batch_size]
+            )
+            if not due_queries:
+                break
+
+            # 上一次的 run 仍在排隊或執行中的查詢這一輪跳過，但排程照常往後推
+            claimed_queries = [q_def for q_def in due_queries if claim_query_run(q_def.id)[0]]
+            run_results = QueryRunResult.objects.bulk_create(
+                [
+                    QueryRunResult(query=q_def, triggered_by="SCHEDULED", status="PENDING")
+                    for q_def in claimed_queries
+                ]
+            )
+            for run_result in run_results:
+                query_lock(run_result.query_id).set({"run_result_id": run_result.id})
+            for q_def in due_queries:
+                # 停機期間錯過的執行只補跑一次，下一次從現在往後推算
+                q_def.schedule_next_run(after=now)
+            QueryDefinition.objects.bulk_update(due_queries, ["next_run_at"])
+
+            run_result_ids = [run_result.id for run_result in run_results]
+            # 交易提交後才送出任務，避免 worker 讀不到尚未提交的 QueryRunResult
+            transaction.on_commit(
+                lambda ids=run_result_ids: [
+                    run_bigquery_query_task.apply_async((run_result_id,), queue=settings.CELERY_SCHEDULED_QUEUE)
+                    for run_result_id in ids
+                ]
+            )
+        dispatched += len(run_results)
+        if len(due_queries) < batch_size:
+            break
+
+    if dispatched:
+        print(f"[SCHEDULER] Dispatched {dispatched} scheduled queries at {now.isoformat()}.")
+    return dispatched
 
 
 # @shared_task(bind=True)
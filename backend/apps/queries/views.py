@@ -2,7 +2,7 @@
 # from django.urls import reverse_lazy
 # from django.views.generic import ListView, DetailView, CreateView, UpdateView, DeleteView, View
 # from django.contrib.auth.mixins import LoginRequiredMixin # 如果需要登入
-from django.http import HttpResponse, JsonResponse, Http404
+from django.http import HttpResponse, JsonResponse, Http404, StreamingHttpResponse
 from django.utils import timezone
 
 # from django.views.decorators.http import require_POST, require_http_methods
@@ -40,10 +40,27 @@ from rest_framework_simplejwt.authentication import JWTAuthentication
 from rest_framework.decorators import action
 from rest_framework.pagination import PageNumberPagination
 
-from .tasks import run_bigquery_query_task
-from django_celery_beat.models import PeriodicTask, CrontabSchedule
+from .tasks import trigger_query_run
+from .services.result_storage import ResultStorage
+from .services.result_sinks import output_table, table_rows
+from .services.result_download import (
+    CsvDownload,
+    RangeNotSatisfiable,
+    gzip_chunks,
+    parse_range_header,
+)
+from .services.bq_services import BudgetExceededError, _is_bytes_billed_limit_error
+from .services.budget_services import (
+    check_budget,
+    get_client_for_dataset,
+    record_ad_hoc_usage,
+)
+from .services.sql_compiler import compile_sql, parse_trivial_projection
+from django.core.cache import cache
 from django.db import transaction
+from django.db.models import Prefetch
 from django.conf import settings
+from main.scheduling import parse_window_minutes
 import hashlib
 import re
 
@@ -131,13 +148,27 @@ class QueryDefinitionViewSet(viewsets.ModelViewSet):
                     bigquery_dataset_id__in=list(accessible_dataset_ids)
                 )
 
+        # 舊資料的 result_data_csv 可能有數 MB，列表與明細都不需要讀取它
         queryset = (
             queryset.select_related("last_successful_run_result")
-            .prefetch_related("run_results")
+            .defer("last_successful_run_result__result_data_csv")
+            .prefetch_related(
+                Prefetch(
+                    "run_results",
+                    queryset=QueryRunResult.objects.defer("result_data_csv"),
+                )
+            )
             .order_by("-created_at")
         )
         return queryset
 
+    def _save_and_compile(self, serializer, **save_kwargs):
+        # 透過 API 修改 sql_query 時同樣要重新編譯，排程變更時重新計算 next_run_at
+        query_def = serializer.save(**save_kwargs)
+        query_def.compile_sql()
+        query_def.schedule_next_run()
+        query_def.save(update_fields=["compiled_sql", "referenced_tables", "next_run_at"])
+
     def list(self, request, *args, **kwargs):
         # 這是處理列表請求的方法，需要確保在這裡將 client_datasets 傳回
         queryset = self.filter_queryset(self.get_queryset())
@@ -224,15 +255,20 @@ class QueryDefinitionViewSet(viewsets.ModelViewSet):
                 "sheet_id": self.request.data.get("sheetId"),
                 "tab_name": self.request.data.get("tabName"),
                 "append_mode": self.request.data.get("appendMode", False),
+                "diff_key_columns": _parse_key_columns(self.request.data.get("diffKeyColumns")),
             }
+        elif output_target == "BIGQUERY_TABLE":
+            output_config = _destination_table_config(self.request.data)
         elif output_target == "LOOKER_STUDIO":
             output_config = {
                 "email": self.request.data.get("email"),
+                "partition_field": self.request.data.get("partitionField") or None,
                 # 在 Looker Studio 的情況下，可能需要更多配置，例如目標表名
             }
         
         # 保存到 QueryDefinition
-        serializer.save(
+        self._save_and_compile(
+            serializer,
             owner=user,
             bigquery_dataset_id=dataset_id,
             bigquery_project_id=bigquery_project_id,
@@ -282,15 +318,20 @@ class QueryDefinitionViewSet(viewsets.ModelViewSet):
                 "sheet_id": self.request.data.get("sheetId"),
                 "tab_name": self.request.data.get("tabName"),
                 "append_mode": self.request.data.get("appendMode", False),
+                "diff_key_columns": _parse_key_columns(self.request.data.get("diffKeyColumns")),
             }
+        elif output_target == "BIGQUERY_TABLE":
+            output_config = _destination_table_config(self.request.data)
         elif output_target == "Google Looker Studio":
             output_config = {
                 "email": self.request.data.get("email"),
+                "partition_field": self.request.data.get("partitionField") or None,
                 # 在 Looker Studio 的情況下，可能需要更多配置，例如目標表名
             }
         
         # 保存到 QueryDefinition
-        serializer.save(
+        self._save_and_compile(
+            serializer,
             last_run_status="PENDING",
             bigquery_project_id=new_bigquery_project_id,
             output_target=output_target,
@@ -320,7 +361,9 @@ class QueryDefinitionViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_403_FORBIDDEN,
             )
 
-        executions = query_def.run_results.all().order_by("-executed_at")[:10]
+        executions = (
+            query_def.run_results.defer("result_data_csv").order_by("-executed_at")[:10]
+        )
         serializer = QueryRunResultSerializer(executions, many=True)
 
         return Response({"status": "success", "executions": serializer.data})
@@ -352,9 +395,16 @@ class QueryDefinitionViewSet(viewsets.ModelViewSet):
             )
 
         try:
-            result = QueryRunResult.objects.get(pk=result_pk, query=query_def)
+            result = QueryRunResult.objects.defer("result_data_csv").get(
+                pk=result_pk, query=query_def
+            )
 
-            if not result.result_data_csv:
+            result_storage = ResultStorage()
+            has_result_file = bool(
+                result.result_storage_path
+                and result_storage.exists(result.result_storage_path)
+            )
+            if not has_result_file and not result.result_data_csv:
                 return Response(
                     {"error": "No result data available"},
                     status=status.HTTP_404_NOT_FOUND,
@@ -365,21 +415,168 @@ class QueryDefinitionViewSet(viewsets.ModelViewSet):
                     {"error": "Result has expired"}, status=status.HTTP_404_NOT_FOUND
                 )
 
-            response = HttpResponse(content_type="text/csv")
-            response["Content-Disposition"] = (
-                f'attachment; filename="query_result_{result.query.name}_{result.executed_at.strftime("%Y%m%d_%H%M%S")}.csv"'
+            filename = f'query_result_{result.query.name}_{result.executed_at.strftime("%Y%m%d_%H%M%S")}.csv'
+
+            # 逐個 row group 讀取 Parquet 並轉成 CSV 串流回傳，不需要把整份結果讀進記憶體
+            if has_result_file:
+                download = CsvDownload.from_result_file(
+                    result_storage, result.result_storage_path
+                )
+            else:
+                # 舊資料：結果仍存放在 result_data_csv 欄位
+                download = CsvDownload.from_text(result.result_data_csv)
+
+            return _csv_download_response(request, download, filename, etag=f'"result-{result.id}"')
+
+        except QueryRunResult.DoesNotExist:
+            return Response(
+                {"error": "Result not found"}, status=status.HTTP_404_NOT_FOUND
             )
+        except Exception as e:
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
-            response.write(result.result_data_csv)
-            return response
 
+    @action(
+        detail=True, methods=["get"], url_path="result-preview/(?P<result_pk>[^/.]+)"
+    )
+    def result_preview(self, request, pk=None, result_pk=None):
+        """
+        分頁預覽某次執行的結果，只讀取涵蓋 offset/limit 範圍的 row group。
+        """
+        query_def = self.get_object()
+        user = request.user
+
+        has_permission_to_view = (
+            query_def.owner == user
+            or user.is_superuser
+            or ClientSetting.objects.filter(
+                user=user,
+                client__bigquery_dataset_id=query_def.bigquery_dataset_id,
+                client__is_active=True,
+            ).exists()
+        )
+        if not has_permission_to_view:
+            return Response(
+                {
+                    "status": "error",
+                    "message": "You do not have permission to preview results for this query.",
+                },
+                status=status.HTTP_403_FORBIDDEN,
+            )
+
+        try:
+            offset = max(int(request.query_params.get("offset", 0)), 0)
+            limit = min(max(int(request.query_params.get("limit", 100)), 1), 1000)
+        except ValueError:
+            return Response(
+                {"error": "offset and limit must be integers"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+
+        try:
+            result = QueryRunResult.objects.defer("result_data_csv").get(
+                pk=result_pk, query=query_def
+            )
         except QueryRunResult.DoesNotExist:
             return Response(
                 {"error": "Result not found"}, status=status.HTTP_404_NOT_FOUND
             )
+
+        result_storage = ResultStorage()
+        if not result.result_storage_path or not result_storage.exists(
+            result.result_storage_path
+        ):
+            return Response(
+                {"error": "No result data available"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        try:
+            table = result_storage.read_range(result.result_storage_path, offset, limit)
         except Exception as e:
             return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+        preview_data = [
+            [str(value) if value is not None else "NULL" for value in row]
+            for row in table_rows(output_table(table))
+        ]
+        return Response(
+            {
+                "status": "success",
+                "columns": table.schema.names,
+                "preview_data": preview_data,
+                "offset": offset,
+                "limit": limit,
+                "total_rows": result.result_rows_count,
+            }
+        )
+
+
+def _destination_table_config(data) -> dict:
+    """output_target = BIGQUERY_TABLE：結果直接寫入 client dataset 中的資料表。"""
+    return {
+        "table_name": data.get("destinationTable", ""),
+        "write_disposition": data.get("writeDisposition") or "OVERWRITE",
+        "partition_field": data.get("partitionField") or None,
+    }
+
+
+def _parse_key_columns(value) -> list:
+    """Google Sheets keyed diff 模式的 key 欄位，接受 list 或以逗號分隔的字串。"""
+    if not value:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [str(column).strip() for column in value if str(column).strip()]
+
+
+def _csv_download_response(request, download, filename, etag):
+    """
+    回傳串流的 CSV 下載：
+    - 有 Range header 且大小已知時回傳 206 (可續傳)，Range 一律針對未壓縮的內容
+    - 否則若 client 接受 gzip，邊產生邊壓縮
+    """
+    total_size = download.total_size
+    range_header = request.headers.get("Range")
+    if_range = request.headers.get("If-Range")
+    byte_range = None
+    if range_header and total_size is not None and (not if_range or if_range == etag):
+        try:
+            byte_range = parse_range_header(range_header, total_size)
+        except RangeNotSatisfiable:
+            response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+            response["Content-Range"] = f"bytes */{total_size}"
+            return response
+
+    if byte_range:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            download.iter_range(start, end),
+            status=status.HTTP_206_PARTIAL_CONTENT,
+            content_type="text/csv",
+        )
+        response["Content-Range"] = f"bytes {start}-{end}/{total_size}"
+        response["Content-Length"] = str(end - start + 1)
+    elif "gzip" in request.headers.get("Accept-Encoding", ""):
+        response = StreamingHttpResponse(
+            gzip_chunks(download.iter_all()), content_type="text/csv"
+        )
+        response["Content-Encoding"] = "gzip"
+        etag = f'{etag[:-1]}-gzip"'
+    else:
+        response = StreamingHttpResponse(download.iter_all(), content_type="text/csv")
+        if total_size is not None:
+            response["Content-Length"] = str(total_size)
+
+    response["Content-Disposition"] = f'attachment; filename="{filename}"'
+    response["Vary"] = "Accept-Encoding"
+    response["ETag"] = etag
+    if total_size is not None:
+        response["Accept-Ranges"] = "bytes"
+    # 避免 nginx 等反向代理把整個串流緩衝起來才送出
+    response["X-Accel-Buffering"] = "no"
+    return response
+
 
 @api_view(["GET"])
 @authentication_classes([JWTAuthentication])
@@ -483,27 +680,78 @@ def api_test_query(request):
         else:
             final_query_for_test = modified_sql_with_limit
 
-        # 接下來再處理 FROM/JOIN 替換，這樣確保 LIMIT 總是在最後且被正確處理
-        modified_query = final_query_for_test.replace("FROM ", f"FROM `{dataset_id}`.")
-        modified_query = modified_query.replace("JOIN ", f"JOIN `{dataset_id}`.")
-        modified_query = modified_query.replace(
-            "INNER JOIN ", f"INNER JOIN `{dataset_id}`."
-        )
-        modified_query = modified_query.replace(
-            "LEFT JOIN ", f"LEFT JOIN `{dataset_id}`."
-        )
-        modified_query = modified_query.replace(
-            "RIGHT JOIN ", f"RIGHT JOIN `{dataset_id}`."
-        )
-        modified_query = modified_query.replace(
-            "FULL JOIN ", f"FULL JOIN `{dataset_id}`."
+        # 接下來再補上資料表的 dataset，這樣確保 LIMIT 總是在最後且被正確處理
+        modified_query = compile_sql(
+            final_query_for_test, dataset_id, settings.GOOGLE_CLOUD_PROJECT_ID
+        ).sql
+
+        # 相同的 SQL 在短時間內重複測試時 (編輯器反覆按 Test)，直接回傳快取的預覽結果
+        preview_cache_key = (
+            f"query_preview_{hashlib.sha256(modified_query.encode('utf-8')).hexdigest()}"
         )
+        cached_preview = None
+        try:
+            cached_preview = cache.get(preview_cache_key)
+        except Exception as e:
+            print(f"Preview cache get failed: {e}")
+        if cached_preview:
+            return Response(cached_preview)
 
         client = bigquery.Client()
 
         try:
-            query_job = client.query(modified_query)  # 使用處理過的 modified_query
-            results = query_job.result()
+            # 單一資料表的欄位投影 (SELECT * / SELECT a, b FROM t)：
+            # 改用免費的 list_rows 讀取前幾列，不需要建立 query job
+            projection = parse_trivial_projection(
+                processed_sql_query, dataset_id, settings.GOOGLE_CLOUD_PROJECT_ID
+            )
+            if projection:
+                response_data = _preview_with_list_rows(client, projection, modified_query)
+                if response_data is not None:
+                    _cache_preview(preview_cache_key, response_data)
+                    return Response(response_data)
+
+            # Dry run (不收費)：先取得預估掃描量與來源資料表，LIMIT 不會減少 BigQuery 的掃描量
+            dry_run_job = client.query(
+                modified_query,
+                job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False),
+            )
+            dry_run_info = {
+                "estimated_bytes_processed": dry_run_job.total_bytes_processed or 0,
+                "referenced_tables": [
+                    f"{table.project}.{table.dataset_id}.{table.table_id}"
+                    for table in dry_run_job.referenced_tables
+                ],
+            }
+
+            try:
+                maximum_bytes_billed = check_budget(
+                    get_client_for_dataset(dataset_id),
+                    dry_run_info["estimated_bytes_processed"],
+                )
+            except BudgetExceededError as e:
+                return Response(
+                    {
+                        "success": False,
+                        "status": "budget_exceeded",
+                        "error_message": str(e),
+                        "dry_run": dry_run_info,
+                    },
+                    status=status.HTTP_403_FORBIDDEN,
+                )
+
+            query_job = client.query(
+                modified_query,  # 使用處理過的 modified_query
+                job_config=bigquery.QueryJobConfig(maximum_bytes_billed=maximum_bytes_billed),
+            )
+            try:
+                results = query_job.result()
+            finally:
+                # 不論成功或失敗都記錄實際用量 (失敗的 job 也可能已計費)，讓預算檢查計入 Test Query
+                try:
+                    record_ad_hoc_usage(query_job, dataset_id, request.user)
+                except Exception as e:
+                    print(f"Failed to record test query usage: {e}")
 
             preview_data = []
             columns = []
@@ -540,21 +788,32 @@ def api_test_query(request):
             )
             total_rows_preview = len(preview_data)
 
-            return Response(
-                {
-                    "status": "success",
-                    "message": "Query executed for preview.",
-                    "preview_data": preview_data,
-                    "columns": columns,
-                    "estimated_bytes_processed": total_bytes,
-                    "total_rows_preview": total_rows_preview,
-                    "query_executed": modified_query,
-                    "has_data": len(preview_data) > 0,
-                    "row_count": len(preview_data),
-                }
-            )
+            response_data = {
+                "status": "success",
+                "message": "Query executed for preview.",
+                "preview_data": preview_data,
+                "columns": columns,
+                "estimated_bytes_processed": total_bytes,
+                "total_rows_preview": total_rows_preview,
+                "query_executed": modified_query,
+                "has_data": len(preview_data) > 0,
+                "row_count": len(preview_data),
+                "dry_run": dry_run_info,
+            }
+            _cache_preview(preview_cache_key, response_data)
+            return Response(response_data)
 
         except exceptions.BadRequest as e:
+            if _is_bytes_billed_limit_error(e):
+                # 超過 maximum_bytes_billed (剩餘預算)，與 dry run 預估超過預算時相同的回應
+                return Response(
+                    {
+                        "success": False,
+                        "status": "budget_exceeded",
+                        "error_message": f"BigQuery bytes billed limit exceeded: {str(e)}",
+                    },
+                    status=status.HTTP_403_FORBIDDEN,
+                )
             return Response(
                 {"success": False, "error_message": f"Query syntax error: {str(e)}"},
                 status=status.HTTP_400_BAD_REQUEST,
@@ -578,6 +837,59 @@ def api_test_query(request):
     except Exception as e:
         return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
 
+PREVIEW_ROW_LIMIT = 5
+
+
+def _preview_with_list_rows(client, projection, modified_query):
+    """
+    以 tabledata.list (list_rows) 讀取資料表的前幾列，不收費也不佔用 slot。
+    只適用於一般資料表；VIEW、外部表或欄位名稱對不上時回傳 None，改走一般查詢。
+    """
+    table = client.get_table(projection.table_id)
+    if table.table_type != "TABLE":
+        return None
+
+    selected_fields = None
+    if projection.columns is not None:
+        schema_by_name = {field.name.lower(): field for field in table.schema}
+        selected_fields = [schema_by_name.get(name.lower()) for name in projection.columns]
+        if None in selected_fields:
+            return None
+
+    max_results = PREVIEW_ROW_LIMIT
+    if projection.limit is not None:
+        max_results = min(projection.limit, PREVIEW_ROW_LIMIT)
+    rows = client.list_rows(table, selected_fields=selected_fields, max_results=max_results)
+
+    columns = [field.name for field in (selected_fields or table.schema)]
+    preview_data = [
+        [str(value) if value is not None else "NULL" for value in row.values()]
+        for row in rows
+    ]
+    return {
+        "status": "success",
+        "message": "Table rows read for preview (no query job).",
+        "preview_data": preview_data,
+        "columns": columns,
+        "estimated_bytes_processed": 0,
+        "total_rows_preview": len(preview_data),
+        "query_executed": modified_query,
+        "has_data": len(preview_data) > 0,
+        "row_count": len(preview_data),
+        "dry_run": {
+            "estimated_bytes_processed": 0,
+            "referenced_tables": [projection.table_id],
+        },
+    }
+
+
+def _cache_preview(cache_key, response_data):
+    try:
+        cache.set(cache_key, response_data, settings.QUERY_PREVIEW_CACHE_TTL)
+    except Exception as e:
+        print(f"Preview cache set failed: {e}")
+
+
 @api_view(["POST"])
 @authentication_classes([JWTAuthentication])
 @permission_classes([IsAuthenticated])
@@ -663,6 +975,8 @@ def api_save_draft(request):
             elif schedule_frequency == "Monthly": #
                 day_of_month = data.get("schedule_day_of_month", 1) #
                 cron_schedule_str = f"{schedule_minute} {schedule_hour} {day_of_month} * *"
+        # 時間窗 (分鐘)：例如 02:00 + 120 表示在 02:00~04:00 之間固定的某一分鐘執行
+        schedule_window_minutes = parse_window_minutes(data.get("schedule_window_minutes")) if schedule_type == "PERIODIC" else 0
 
         # 提取 output 相關的設定並儲存為 JSON
         output_target_type = data.get("output_target", "NONE") #
@@ -672,10 +986,14 @@ def api_save_draft(request):
                 "sheet_id": data.get("sheetId", ""),
                 "tab_name": data.get("tabName", ""), 
                 "append_mode": data.get("appendMode", False), 
+                "diff_key_columns": _parse_key_columns(data.get("diffKeyColumns")),
             }
+        elif output_target_type == "BIGQUERY_TABLE":
+            output_config_json = _destination_table_config(data)
         elif output_target_type == "LOOKER_STUDIO": #
             output_config_json = {
                 "email": data.get("email", ""), #
+                "partition_field": data.get("partitionField") or None,
             }
         # 對於 'Download' 類型，模型不需要額外的 output_config 數據，因為 CSV 將存儲在 QueryRunResult 中。
 
@@ -691,6 +1009,7 @@ def api_save_draft(request):
                     "last_run_status": "DRAFT",  # Mark as DRAFT
                     "schedule_type": schedule_type,
                     "cron_schedule": cron_schedule_str,
+                    "schedule_window_minutes": schedule_window_minutes,
                     "output_target": output_target_type,
                     "output_config": json.dumps(output_config_json) if output_config_json else None,
                 },
@@ -705,39 +1024,14 @@ def api_save_draft(request):
                 # 更新排程和輸出設定
                 query_def.schedule_type = schedule_type
                 query_def.cron_schedule = cron_schedule_str
+                query_def.schedule_window_minutes = schedule_window_minutes
                 query_def.output_target = output_target_type
                 query_def.output_config = json.dumps(output_config_json) if output_config_json else None
-                query_def.save() #
-
-            # 如果是排程任務，更新或創建 Celery PeriodicTask
-            if schedule_type == "PERIODIC" and cron_schedule_str:
-                # 創建或獲取 CrontabSchedule
-                schedule, _ = CrontabSchedule.objects.get_or_create(
-                    minute=schedule_minute,
-                    hour=schedule_hour,
-                    day_of_week='*' if schedule_frequency != "Weekly" else cron_schedule_str.split()[-1], # 從cron_schedule_str提取day_of_week
-                    day_of_month='*' if schedule_frequency != "Monthly" else cron_schedule_str.split()[-3], # 從cron_schedule_str提取day_of_month
-                    month_of_year='*',
-                )
-
-                # 創建或更新 PeriodicTask
-                task_name = f"query_definition_{query_def.id}_periodic_task"
-                PeriodicTask.objects.update_or_create(
-                    name=task_name,
-                    defaults={
-                        'task': 'queries.tasks.run_bigquery_query_task', # Celery Task 名稱
-                        'crontab': schedule,
-                        'args': json.dumps([query_def.id]), # 傳遞 query_def.id 給任務
-                        'enabled': True, # 啟用任務
-                        'one_off': False, # 非一次性任務
-                        'description': f"Scheduled run for Query: {query_def.name}"
-                    }
-                )
-            else: # 如果頻率是 "Once" 或者從 "Periodic" 改為 "Once"
-                # 刪除對應的 PeriodicTask (如果存在)
-                task_name = f"query_definition_{query_def.id}_periodic_task"
-                PeriodicTask.objects.filter(name=task_name).delete()
 
+            # 儲存時編譯 SQL，執行時不需要再改寫；排程由 next_run_at 驅動
+            query_def.compile_sql()
+            query_def.schedule_next_run()
+            query_def.save()
 
         return Response(
             {
@@ -838,6 +1132,7 @@ def api_run_query(request):
             elif schedule_frequency == "Monthly":
                 day_of_month = data.get("schedule_day_of_month", 1)
                 cron_schedule_str = f"{schedule_minute} {schedule_hour} {day_of_month} * *"
+        schedule_window_minutes = parse_window_minutes(data.get("schedule_window_minutes")) if schedule_type == "PERIODIC" else 0
 
 
         # 提取 output 相關的設定並儲存為 JSON
@@ -848,10 +1143,14 @@ def api_run_query(request):
                 "sheet_id": data.get("sheetId", ""),
                 "tab_name": data.get("tabName", ""),
                 "append_mode": data.get("appendMode", False),
+                "diff_key_columns": _parse_key_columns(data.get("diffKeyColumns")),
             }
+        elif output_target_type == "BIGQUERY_TABLE":
+            output_config_json = _destination_table_config(data)
         elif output_target_type == "LOOKER_STUDIO":
             output_config_json = {
                 "email": data.get("email"),
+                "partition_field": data.get("partitionField") or None,
             }
 
         print("output_config_json before json.dumps:", output_config_json)
@@ -876,6 +1175,7 @@ def api_run_query(request):
                     "last_run_status": "PENDING",
                     "schedule_type": schedule_type, 
                     "cron_schedule": cron_schedule_str, 
+                    "schedule_window_minutes": schedule_window_minutes,
                     "output_target": output_target_type, 
                     "output_config": json.dumps(output_config_json) if output_config_json else None, 
                     "bigquery_project_id": bigquery_project_id,
@@ -888,6 +1188,7 @@ def api_run_query(request):
                 query_def.last_run_status = "PENDING" 
                 query_def.schedule_type = schedule_type
                 query_def.cron_schedule = cron_schedule_str
+                query_def.schedule_window_minutes = schedule_window_minutes
                 query_def.output_target = output_target_type
                 query_def.output_config = json.dumps(output_config_json) if output_config_json else None
                 query_def.bigquery_project_id = bigquery_project_id
@@ -898,52 +1199,24 @@ def api_run_query(request):
             # 確保 last_successful_test_hash 和 last_tested_at 已更新
             query_def.last_successful_test_hash = current_sql_hash
             query_def.last_tested_at = timezone.now()
+            # 儲存時編譯 SQL，執行時不需要再改寫；排程由 next_run_at 驅動
+            query_def.compile_sql()
+            query_def.schedule_next_run()
             query_def.save()
 
-            # 立即觸發一次 Celery 任務執行
-            run_result = QueryRunResult.objects.create( # 創建 QueryRunResult
-                query=query_def, # QueryRunResult 應該有一個指向 QueryDefinition 的外鍵
-                triggered_by="MANUAL",
-                status="PENDING",
-                executed_at=timezone.now() # 標記為已送入佇列 (這裡應該是 executed_at)
-            )
-            print("Attempting to call run_bigquery_query_task.delay()")
-            run_bigquery_query_task.delay(run_result.id)
-            print("Called run_bigquery_query_task.delay()", run_result.id)
-
-            # 處理 Celery 定期任務 (如果頻率不是 Once)
-            if schedule_type == "PERIODIC" and cron_schedule_str:
-                schedule, _ = CrontabSchedule.objects.get_or_create(
-                    minute=schedule_minute,
-                    hour=schedule_hour,
-                    day_of_week='*' if schedule_frequency != "Weekly" else ','.join(parsed_days),
-                    day_of_month='*' if schedule_frequency != "Monthly" else str(day_of_month),
-                    month_of_year='*',
-                )
-
-                task_name = f"query_definition_{query_def.id}_periodic_task"
-                PeriodicTask.objects.update_or_create(
-                    name=task_name,
-                    defaults={
-                        'task': 'queries.tasks.run_bigquery_query_task',
-                        'crontab': schedule,
-                        'args': json.dumps([query_def.id]),
-                        'enabled': True,
-                        'one_off': False,
-                        'description': f"Scheduled run for Query: {query_def.name}"
-                    }
-                )
-            else: # 如果是 "Once" 或之前是排程但現在改成 "Once"
-                # 禁用或刪除可能的舊的 PeriodicTask
-                task_name = f"query_definition_{query_def.id}_periodic_task"
-                PeriodicTask.objects.filter(name=task_name).delete() # 直接刪除，因為是 Once
+            # 立即觸發一次 Celery 任務執行；已有 run 在排隊或執行中時沿用該 run，不重複執行
+            run_result, created = trigger_query_run(query_def, triggered_by="MANUAL")
 
         return Response(
             {
                 "success": True,
                 "query_id": query_def.id,
-                "message": "Query saved and initiated for execution successfully.",
-                "execution_id": run_result.id,
+                "message": (
+                    "Query saved and initiated for execution successfully."
+                    if created
+                    else "Query saved. A run of this query is already in progress."
+                ),
+                "execution_id": run_result.id if run_result else None,
                 # 您可以提供一個查詢結果的狀態頁面鏈接，讓用戶追蹤進度
                 # "status_url": request.build_absolute_uri(f"/queries/{query_def.id}/executions/")
             }
@@ -1092,10 +1365,6 @@ def api_delete_query(request, pk):
             )
 
         with transaction.atomic():
-            # 刪除 Celery PeriodicTask (如果存在)
-            task_name = f"query_definition_{query_def.id}_periodic_task"
-            PeriodicTask.objects.filter(name=task_name).delete()
-
             # 刪除 QueryDefinition
             query_def.delete()
 
@@ -0,0 +1,214 @@
+# main/concurrency.py
+# 跨 worker 的並行上限 (Redis semaphore)
+# 同一個 Client 或同一個外部服務 (Facebook、Google Ads、Sheets、BigQuery) 同時執行的任務數有上限，
+# 單一客戶的大量連線不會佔滿所有 worker slot 或耗盡外部 API 的配額。
+# 拿不到 slot 的任務不佔用 worker 等待，而是延後重新排入原本的 queue。
+# InflightLock 則避免同一個 Connection / QueryDefinition 被重複觸發時同時執行兩次。
+import logging
+import random
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django_redis import get_redis_connection
+
+logger = logging.getLogger(__name__)
+
+# KEYS[1]: sorted set (member = token, score = lease 到期時間)
+# ARGV: now, expires_at, limit, token, key_ttl
+_ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) < tonumber(ARGV[3]) then
+    redis.call('ZADD', KEYS[1], ARGV[2], ARGV[4])
+    redis.call('EXPIRE', KEYS[1], ARGV[5])
+    return 1
+end
+return 0
+"""
+
+
+# KEYS[1]: lock key
+# ARGV: 預期的 value (序列化後), 新的 value, lease 秒數
+_REPLACE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('SET', KEYS[1], ARGV[2], 'EX', ARGV[3])
+    return 1
+end
+return 0
+"""
+
+
+class ConcurrencyLimitReached(Exception):
+    """semaphore 已滿，任務應該延後執行。"""
+
+
+class RedisSemaphore:
+    """
+    以 sorted set 實作的計數 semaphore。每個持有者有一個 lease，
+    worker 當機沒有釋放時，lease 到期後 slot 會自動回收。
+    """
+
+    def __init__(self, name: str, limit: int, lease_seconds: int = None, redis=None):
+        self.name = name
+        self.key = f"semaphore:{name}"
+        self.limit = limit
+        self.lease_seconds = lease_seconds or settings.TASK_CONCURRENCY_LEASE_SECONDS
+        self._redis = redis
+        self._script = None
+
+    @property
+    def redis(self):
+        if self._redis is None:
+            self._redis = get_redis_connection("default")
+        return self._redis
+
+    def acquire(self):
+        """取得一個 slot，成功時回傳 token，已滿時回傳 None。"""
+        if self._script is None:
+            self._script = self.redis.register_script(_ACQUIRE_SCRIPT)
+        token = uuid.uuid4().hex
+        now = time.time()
+        acquired = self._script(
+            keys=[self.key],
+            args=[now, now + self.lease_seconds, self.limit, token, self.lease_seconds],
+        )
+        return token if acquired else None
+
+    def renew(self, token: str) -> bool:
+        """延長仍持有的 slot 的 lease (長時間執行的任務)；lease 已到期被回收時回傳 False。"""
+        expires_at = time.time() + self.lease_seconds
+        renewed = self.redis.zadd(self.key, {token: expires_at}, xx=True, ch=True)
+        self.redis.expire(self.key, self.lease_seconds)
+        return bool(renewed)
+
+    def release(self, token: str):
+        self.redis.zrem(self.key, token)
+
+
+class ConcurrencySlots:
+    """一次取得多個 semaphore 的 slot；任一個已滿時釋放已取得的並拋出 ConcurrencyLimitReached。"""
+
+    def __init__(self, semaphores):
+        self.semaphores = semaphores
+        self._held = []
+
+    def acquire(self):
+        try:
+            for semaphore in self.semaphores:
+                token = semaphore.acquire()
+                if token is None:
+                    self.release()
+                    raise ConcurrencyLimitReached(
+                        f"Concurrency limit {semaphore.limit} reached for {semaphore.name}"
+                    )
+                self._held.append((semaphore, token))
+        except ConcurrencyLimitReached:
+            raise
+        except Exception as e:
+            # Redis 無法使用時不阻擋任務 (與快取相同，降級為不限制)
+            logger.warning(f"Concurrency semaphore unavailable, running without limits: {e}")
+            self.release()
+        return self
+
+    def renew(self):
+        """延長所有已取得 slot 的 lease。"""
+        for semaphore, token in self._held:
+            try:
+                if not semaphore.renew(token):
+                    logger.warning(f"Lease on semaphore {semaphore.name} had already expired.")
+            except Exception as e:
+                logger.warning(f"Failed to renew semaphore {semaphore.name}: {e}")
+
+    def release(self):
+        while self._held:
+            semaphore, token = self._held.pop()
+            try:
+                semaphore.release(token)
+            except Exception as e:
+                logger.warning(f"Failed to release semaphore {semaphore.name}: {e}")
+
+
+def task_slots(client_id=None, providers=()):
+    """
+    依 settings 建立任務需要的 slot (尚未取得)：
+    - client:<id>：TASK_CONCURRENCY_PER_CLIENT
+    - provider:<name>：TASK_CONCURRENCY_PER_PROVIDER[name]
+    上限為 0 或未設定時不限制。
+    """
+    semaphores = []
+    if client_id and settings.TASK_CONCURRENCY_PER_CLIENT:
+        semaphores.append(RedisSemaphore(f"client:{client_id}", settings.TASK_CONCURRENCY_PER_CLIENT))
+    for provider in providers:
+        limit = settings.TASK_CONCURRENCY_PER_PROVIDER.get(provider)
+        if limit:
+            semaphores.append(RedisSemaphore(f"provider:{provider}", limit))
+    return ConcurrencySlots(semaphores)
+
+
+def defer_task(task):
+    """
+    將目前執行中的任務延後重新排入原本的 queue (保留 task id 與重試次數)，
+    等待 slot 不會消耗任務的 max_retries。
+    """
+    countdown = settings.TASK_CONCURRENCY_RETRY_DELAY * random.uniform(0.5, 1.5)
+    task.signature_from_request(countdown=countdown, retries=task.request.retries).apply_async()
+    return countdown
+
+
+class InflightLock:
+    """
+    以 cache.add (Redis SET NX) 實作的 lease lock，確保同一個 Connection / QueryDefinition 同時只有一個執行。
+    value 記錄目前的執行 (例如 execution id)，重複觸發時可以直接回傳給呼叫端；
+    持有者當機沒有釋放時，lease 到期後自動失效。
+    """
+
+    def __init__(self, key: str, ttl: int = None):
+        self.key = key
+        self.ttl = ttl or settings.INFLIGHT_LOCK_TTL
+
+    def acquire(self, value) -> bool:
+        try:
+            return cache.add(self.key, value, self.ttl)
+        except Exception as e:
+            # 快取無法使用時不阻擋執行
+            logger.warning(f"In-flight lock {self.key} unavailable, proceeding without it: {e}")
+            return True
+
+    def get(self):
+        try:
+            return cache.get(self.key)
+        except Exception as e:
+            logger.warning(f"Failed to read in-flight lock {self.key}: {e}")
+            return None
+
+    def set(self, value):
+        """更新 value 並重新計算 lease。"""
+        try:
+            cache.set(self.key, value, self.ttl)
+        except Exception as e:
+            logger.warning(f"Failed to update in-flight lock {self.key}: {e}")
+
+    def replace(self, expected, value) -> bool:
+        """
+        compare-and-set：目前的 value 仍為 expected 時才換成 value 並重新計算 lease，回傳是否成功。
+        用於接手殘留的 lock，兩個同時到達的觸發只有一個能接手。
+        """
+        try:
+            client = cache.client
+            key = client.make_key(self.key)
+            redis = get_redis_connection("default")
+            current = redis.get(key)
+            if current is None or client.decode(current) != expected:
+                return False
+            script = redis.register_script(_REPLACE_SCRIPT)
+            return bool(script(keys=[key], args=[current, client.encode(value), self.ttl]))
+        except Exception as e:
+            logger.warning(f"In-flight lock {self.key} unavailable, proceeding without it: {e}")
+            return True
+
+    def release(self):
+        try:
+            cache.delete(self.key)
+        except Exception as e:
+            logger.warning(f"Failed to release in-flight lock {self.key}: {e}")
@@ -0,0 +1,28 @@
+# main/scheduling.py
+# 排程時間窗 (load spreading)
+# 大多數使用者都選 00:00 或 09:00，所有同步與查詢會在同一秒湧入 worker 與外部 API。
+# Connection / QueryDefinition 可以設定一個時間窗 (例如 02:00 起 120 分鐘 = 02:00~04:00)，
+# 每個排程依自己的 key 固定落在窗內的某一分鐘：同一個排程每次都在相同時間執行，不同排程則平均散開。
+import hashlib
+from datetime import timedelta
+
+# 時間窗不可超過一天，否則會跨到下一次的執行時間
+MAX_SCHEDULE_WINDOW_MINUTES = 24 * 60 - 1
+
+
+def window_offset(key: str, window_minutes: int) -> timedelta:
+    """依 key 在 [0, window_minutes) 分鐘內取一個固定的偏移；同一個 key 每次結果相同。"""
+    if not window_minutes or window_minutes <= 0:
+        return timedelta(0)
+    window_minutes = min(int(window_minutes), MAX_SCHEDULE_WINDOW_MINUTES)
+    digest = hashlib.sha1(key.encode("utf-8")).digest()
+    return timedelta(minutes=int.from_bytes(digest[:8], "big") % window_minutes)
+
+
+def parse_window_minutes(value) -> int:
+    """將使用者輸入的時間窗長度 (分鐘) 轉成整數；空值或格式錯誤視為 0 (不分散)。"""
+    try:
+        minutes = int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+    return max(0, min(minutes, MAX_SCHEDULE_WINDOW_MINUTES))
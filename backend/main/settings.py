@@ -261,17 +261,163 @@ CELERY_BROKER_TRANSPORT = "redis"
 CELERY_BROKER_TRANSPORT_OPTIONS = {
     "visibility_timeout": 3600,
     "polling_interval": 1,
+    # worker 依 -Q 的順序取任務：interactive 有任務時一定先處理 (見 supervisord_worker.conf)
+    "queue_order_strategy": "priority",
 }
 
-CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
+# Priority lanes
+# - interactive：使用者手動觸發的同步/查詢、建立 dataset 等，使用者正在畫面上等待結果
+# - scheduled：排程器派發的同步與查詢 (批次工作)
+# - default：排程器本身與其他雜項任務
+CELERY_INTERACTIVE_QUEUE = "interactive"
+CELERY_SCHEDULED_QUEUE = "scheduled"
+CELERY_TASK_DEFAULT_QUEUE = "default"
+# 同步/查詢任務預設進 interactive；排程器派發時以 queue=CELERY_SCHEDULED_QUEUE 覆寫
+CELERY_TASK_ROUTES = {
+    "apps.connections.tasks.sync_connection_data_task": {"queue": CELERY_INTERACTIVE_QUEUE},
+    "apps.connections.tasks.sync_facebook_batch_task": {"queue": CELERY_INTERACTIVE_QUEUE},
+    "apps.queries.tasks.run_bigquery_query_task": {"queue": CELERY_INTERACTIVE_QUEUE},
+    "apps.clients.tasks.*": {"queue": CELERY_INTERACTIVE_QUEUE},
+}
+# 每個 worker process 一次只預取一個任務，避免已預取的排程任務擋住後來的手動任務
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# 跨 worker 的並行上限 (Redis semaphore，見 main/concurrency.py)；0 表示不限制
+# 單一 Client 同時執行的同步 + 查詢數
+TASK_CONCURRENCY_PER_CLIENT = env.int("TASK_CONCURRENCY_PER_CLIENT", default=4)
+# 各外部服務同時執行的任務數 (key 與 DataSource.name 相同，BigQuery 為查詢任務)
+TASK_CONCURRENCY_PER_PROVIDER = {
+    "FACEBOOK_ADS": env.int("TASK_CONCURRENCY_FACEBOOK_ADS", default=4),
+    "GOOGLE_ADS": env.int("TASK_CONCURRENCY_GOOGLE_ADS", default=4),
+    "GOOGLE_SHEET": env.int("TASK_CONCURRENCY_GOOGLE_SHEET", default=4),
+    "BIGQUERY": env.int("TASK_CONCURRENCY_BIGQUERY", default=8),
+}
+# 拿不到 slot 時延後多久重新排入 (秒，實際為 0.5~1.5 倍的隨機值)
+TASK_CONCURRENCY_RETRY_DELAY = env.int("TASK_CONCURRENCY_RETRY_DELAY", default=30)
+# slot 的 lease 秒數：worker 當機沒有釋放時，超過此時間自動回收 (需大於最長的任務執行時間)
+TASK_CONCURRENCY_LEASE_SECONDS = env.int("TASK_CONCURRENCY_LEASE_SECONDS", default=3600)
+# 同一個 Connection / QueryDefinition 的 in-flight lock lease 秒數 (排隊 + 執行時間的上限)
+INFLIGHT_LOCK_TTL = env.int("INFLIGHT_LOCK_TTL", default=3600)
 
+CELERY_BEAT_SCHEDULER = 'django_celery_beat.schedulers:DatabaseScheduler'
 
-# CELERY_BEAT_SCHEDULE = {
-#     'schedule-periodic-syncs': {
-#         'task': 'apps.connections.tasks.schedule_periodic_syncs_task',
-#         'schedule': crontab(minute='*'),  # 每分鐘執行一次
-#     },
-# }
+# BigQuery submit-and-poll：查詢任務送出 job 後即釋放 worker，由 poll_bigquery_jobs 追蹤 job 狀態，
+# job 完成後再派發結果處理 (下載結果、寫入輸出目標)
+QUERY_ASYNC_JOBS = env.bool("QUERY_ASYNC_JOBS", default=True)
+# 輪詢間隔 (秒)、同時查詢 job 狀態的請求數、每次輪詢的 job 數上限
+QUERY_JOB_POLL_INTERVAL = env.int("QUERY_JOB_POLL_INTERVAL", default=10)
+QUERY_JOB_POLL_CONCURRENCY = env.int("QUERY_JOB_POLL_CONCURRENCY", default=20)
+QUERY_JOB_POLL_BATCH_SIZE = env.int("QUERY_JOB_POLL_BATCH_SIZE", default=1000)
+
+# 固定的排程器任務 (DatabaseScheduler 啟動時會同步到資料庫)；
+# 每個查詢的執行時間存在 QueryDefinition.next_run_at，不再為每個查詢建立 PeriodicTask
+CELERY_BEAT_SCHEDULE = {
+    "schedule-periodic-queries": {
+        "task": "apps.queries.tasks.schedule_periodic_queries",
+        "schedule": crontab(minute="*"),  # 每分鐘執行一次
+    },
+    "schedule-periodic-syncs": {
+        "task": "apps.connections.tasks.schedule_periodic_syncs_task",
+        "schedule": crontab(minute="*"),  # 每分鐘執行一次
+    },
+    "poll-bigquery-jobs": {
+        "task": "apps.queries.tasks.poll_bigquery_jobs",
+        "schedule": QUERY_JOB_POLL_INTERVAL,  # 每 QUERY_JOB_POLL_INTERVAL 秒執行一次
+    },
+}
+# 每次 tick 在同一個交易中認領的到期查詢數上限
+QUERY_SCHEDULER_BATCH_SIZE = env.int("QUERY_SCHEDULER_BATCH_SIZE", default=500)
+# 同上，到期的 Connection 同步
+CONNECTION_SCHEDULER_BATCH_SIZE = env.int("CONNECTION_SCHEDULER_BATCH_SIZE", default=500)
+
+# Query result pipeline
+# 查詢結果會以固定大小的 chunk 串流到各個輸出 (結果檔案、Google Sheets、計數器)，
+# 不再把整份結果留在 worker 記憶體中
+QUERY_RESULT_CHUNK_SIZE = env.int("QUERY_RESULT_CHUNK_SIZE", default=5000)
+# 結果以 Parquet 檔案儲存：本機路徑 (開發/測試) 或 gs://bucket/prefix (正式環境)
+# web 與 worker 是不同的 image (Dockerfile.web / Dockerfile.worker)，本機路徑彼此看不到，重新部署也會清空，
+# 因此 DEBUG 關閉時必須設定共用的 gs:// 位置
+QUERY_RESULT_STORAGE_URI = env(
+    "QUERY_RESULT_STORAGE_URI",
+    default=str(Path(__file__).resolve().parent.parent / "query_results"),
+)
+if not env.bool("DEBUG", default=True) and not QUERY_RESULT_STORAGE_URI.startswith("gs://"):
+    raise ImproperlyConfigured(
+        "QUERY_RESULT_STORAGE_URI must be a shared gs://bucket/prefix location when DEBUG is off"
+    )
+QUERY_RESULT_PARQUET_COMPRESSION = env("QUERY_RESULT_PARQUET_COMPRESSION", default="zstd")
+# 以 Arrow 格式逐頁讀取結果 (向量化轉換)；關閉時退回逐列讀取
+QUERY_RESULT_ARROW_FETCH = env.bool("QUERY_RESULT_ARROW_FETCH", default=True)
+# 有安裝 google-cloud-bigquery-storage 時使用 Storage Read API
+QUERY_RESULT_USE_STORAGE_API = env.bool("QUERY_RESULT_USE_STORAGE_API", default=True)
+QUERY_RESULT_STORAGE_API_MAX_STREAMS = env.int("QUERY_RESULT_STORAGE_API_MAX_STREAMS", default=1)
+# 來源資料表未變動時沿用上一次的結果 (依 SQL 指紋 + 各資料表 last_modified 判斷)
+QUERY_RESULT_CACHE_ENABLED = env.bool("QUERY_RESULT_CACHE_ENABLED", default=True)
+# api_test_query 預覽結果的快取秒數 (key 為編譯後的 SQL)
+QUERY_PREVIEW_CACHE_TTL = env.int("QUERY_PREVIEW_CACHE_TTL", default=60)
+# Google Sheets 輸出：每批的列數/位元組上限、同時送出的請求數，以及 429/5xx 的重試
+GSHEET_WRITE_MAX_CHUNK_ROWS = env.int("GSHEET_WRITE_MAX_CHUNK_ROWS", default=10000)
+GSHEET_WRITE_MAX_CHUNK_BYTES = env.int("GSHEET_WRITE_MAX_CHUNK_BYTES", default=2 * 1024 * 1024)
+GSHEET_WRITE_CONCURRENCY = env.int("GSHEET_WRITE_CONCURRENCY", default=4)
+GSHEET_WRITE_MAX_RETRIES = env.int("GSHEET_WRITE_MAX_RETRIES", default=5)
+GSHEET_WRITE_BACKOFF_BASE = env.float("GSHEET_WRITE_BACKOFF_BASE", default=1.0)
+
+# 外部 API 限流 (Redis token bucket，見 apps/connections/apis/rate_limiter.py)
+# 每個 provider 與各範圍的 (每秒補充的 token 數, bucket 容量)；一個 token = 一個 HTTP 請求
+API_RATE_LIMIT_ENABLED = env.bool("API_RATE_LIMIT_ENABLED", default=True)
+API_RATE_LIMITS = {
+    "FACEBOOK_ADS": {
+        "provider": (env.float("FACEBOOK_RATE_LIMIT_PER_SECOND", default=20.0), 40),
+        "account": (env.float("FACEBOOK_ACCOUNT_RATE_LIMIT_PER_SECOND", default=2.0), 10),
+    },
+    "GOOGLE_ADS": {
+        "provider": (env.float("GOOGLE_ADS_RATE_LIMIT_PER_SECOND", default=10.0), 20),
+        "customer": (env.float("GOOGLE_ADS_CUSTOMER_RATE_LIMIT_PER_SECOND", default=1.0), 5),
+    },
+    # Sheets API 配額：每個專案每分鐘 300 次讀取 / 300 次寫入
+    "GOOGLE_SHEET": {
+        "provider": (env.float("GOOGLE_SHEET_RATE_LIMIT_PER_SECOND", default=4.0), 10),
+        "sheet": (env.float("GOOGLE_SHEET_SHEET_RATE_LIMIT_PER_SECOND", default=1.0), 5),
+    },
+}
+# 需要等待超過此秒數時不再排隊，直接拋出 RateLimitExceeded (任務會重試)
+API_RATE_LIMIT_MAX_WAIT = env.int("API_RATE_LIMIT_MAX_WAIT", default=300)
+# Google API 回傳 429 / RESOURCE_EXHAUSTED 時，同一個範圍暫停的秒數 (Facebook 使用 FACEBOOK_USAGE_PAUSE_SECONDS)
+API_RATE_LIMIT_PENALTY_SECONDS = env.int("API_RATE_LIMIT_PENALTY_SECONDS", default=60)
+
+# Facebook Ads 同步
+# 預估列數超過此值時改用非同步報表 (AdReportRun)；Connection config 的 insights_async 可強制指定
+FACEBOOK_INSIGHTS_ASYNC_ROW_THRESHOLD = env.int("FACEBOOK_INSIGHTS_ASYNC_ROW_THRESHOLD", default=5000)
+# 非同步報表的輪詢間隔 (秒，每次加倍直到上限) 與等待上限
+FACEBOOK_INSIGHTS_ASYNC_POLL_INTERVAL = env.int("FACEBOOK_INSIGHTS_ASYNC_POLL_INTERVAL", default=5)
+FACEBOOK_INSIGHTS_ASYNC_POLL_MAX_INTERVAL = env.int("FACEBOOK_INSIGHTS_ASYNC_POLL_MAX_INTERVAL", default=60)
+FACEBOOK_INSIGHTS_ASYNC_TIMEOUT = env.int("FACEBOOK_INSIGHTS_ASYNC_TIMEOUT", default=3600)
+# 讀取報表結果時每頁的筆數
+FACEBOOK_INSIGHTS_PAGE_SIZE = env.int("FACEBOOK_INSIGHTS_PAGE_SIZE", default=500)
+# 串流寫入 BigQuery：每個 load job 的 NDJSON 大小上限，以及暫存檔保留在記憶體中的上限 (超過時寫到磁碟)
+FACEBOOK_LOAD_CHUNK_BYTES = env.int("FACEBOOK_LOAD_CHUNK_BYTES", default=64 * 1024 * 1024)
+FACEBOOK_LOAD_SPOOL_MEMORY_BYTES = env.int("FACEBOOK_LOAD_SPOOL_MEMORY_BYTES", default=8 * 1024 * 1024)
+# 單一 API 呼叫遇到暫時性錯誤 (限流、5xx) 的重試次數
+FACEBOOK_API_MAX_RETRIES = env.int("FACEBOOK_API_MAX_RETRIES", default=5)
+# 長日期範圍切成每段幾天並行抓取 (0 表示不切)，以及同時抓取的 slice 數上限
+FACEBOOK_INSIGHTS_SLICE_DAYS = env.int("FACEBOOK_INSIGHTS_SLICE_DAYS", default=7)
+FACEBOOK_INSIGHTS_SLICE_WORKERS = env.int("FACEBOOK_INSIGHTS_SLICE_WORKERS", default=4)
+# 用量 header (x-business-use-case-usage / x-ad-account-usage) 超過 SLOWDOWN 後逐步降低並行數，
+# 超過 PAUSE 時暫停到預估恢復存取的時間 (沒有提供時暫停 FACEBOOK_USAGE_PAUSE_SECONDS 秒)
+FACEBOOK_USAGE_SLOWDOWN_PCT = env.int("FACEBOOK_USAGE_SLOWDOWN_PCT", default=50)
+FACEBOOK_USAGE_PAUSE_PCT = env.int("FACEBOOK_USAGE_PAUSE_PCT", default=90)
+FACEBOOK_USAGE_PAUSE_SECONDS = env.int("FACEBOOK_USAGE_PAUSE_SECONDS", default=60)
+# 排程同步時，同一個 Client 有多個小型報表的 Facebook Connection 以 Graph API batch 一起抓取：
+# 每個 batch 的子請求數上限 (Graph API 上限 50)、每個任務最多合併的 Connection 數與最少需要的數量
+FACEBOOK_BATCH_SYNC_ENABLED = env.bool("FACEBOOK_BATCH_SYNC_ENABLED", default=True)
+FACEBOOK_BATCH_SIZE = env.int("FACEBOOK_BATCH_SIZE", default=50)
+FACEBOOK_BATCH_MAX_CONNECTIONS = env.int("FACEBOOK_BATCH_MAX_CONNECTIONS", default=25)
+FACEBOOK_BATCH_MIN_CONNECTIONS = env.int("FACEBOOK_BATCH_MIN_CONNECTIONS", default=2)
+# 增量同步 (Connection config 的 sync_mode = "incremental")：
+# 每次從上次同步的最後一天往前回補的天數 (轉換歸因期間，可由 config 的 attribution_lookback_days 覆寫)，
+# 以及首次同步往前抓取的天數 (config 的 initial_sync_days)
+FACEBOOK_ATTRIBUTION_LOOKBACK_DAYS = env.int("FACEBOOK_ATTRIBUTION_LOOKBACK_DAYS", default=7)
+INCREMENTAL_SYNC_INITIAL_DAYS = env.int("INCREMENTAL_SYNC_INITIAL_DAYS", default=30)
 
 
 SITE_ID = 1